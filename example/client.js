@@ -41,7 +41,10 @@
 				debug: false,
 
 				/** Use the native browser's built-in WebSocket library or a custom one with the same API. */
-				websocket: WebSocket
+				websocket: WebSocket,
+
+				/** Protocol versions to offer, in order of preference. Servers that support none of them send text base64 encoded. */
+				protocols: ["g4ab.v2.json"]
 			};
 
 			if (!options) {
@@ -64,7 +67,9 @@
 
 				"system": [],
 				"session": [],
-				"chat": []
+				"chat": [],
+				"stream": [],
+				"queue": []
 			};
 			this._sessions = [];
 			this._session = null;
@@ -145,7 +150,7 @@
 			}
 
 			this._url = url;
-			this._ws = new this._settings.websocket(url, [], ...wsParams);
+			this._ws = new this._settings.websocket(url, this._settings.protocols, ...wsParams);
 			this._ws.log = (...x) => console.log("%c[GatewaySocket]%c", "color:#A199FF;font-weight:bold", null, ...x);
 			
 			this._ws.log(`Connecting to ${this._url} ...`);
@@ -203,8 +208,11 @@
 						const cid = this._cids[i];
 						if (data.cid == cid.id) {
 							cid.func(data);
-							var index = this._cids.indexOf(cid);
-							this._cids.splice(index, 1);
+							// Queue updates and streamed responses keep their cid until the final packet
+							if (!(data.content && (data.content.stream == "chunk" || data.content.type == "queue"))) {
+								var index = this._cids.indexOf(cid);
+								this._cids.splice(index, 1);
+							}
 							consumed = true;
 						}
 					}
@@ -220,11 +228,18 @@
 				if (data.msg == Packet.PING) {
 					
 				} else if (data.msg == Packet.SESSION) {
-
+					// Pushed once the model of a created session is loaded ("ready") or failed to ("failed")
+					const type = data.content.type;
+					const error = data.content.error;
+					const sessionId = data.content.session_id;
+					const status = data.content.status;
+					for (var i in this._eventListeners["session"]) {
+						this._eventListeners["session"][i](type, error, sessionId, status);
+					}
 				} else if (data.msg == Packet.CHAT) {
 					const type = data.content.type;
 					const sender = data.content.sender;
-					const message = atob(data.content.data);
+					const message = this._decodeText(data.content.data);
 					const bot = data.content.bot;
 					const error = data.content.error;
 					for (var i in this._eventListeners["chat"]) {
@@ -232,7 +247,7 @@
 					}
 				} else if (data.msg == Packet.SYSTEM) {
 					const type = data.content.type;
-					const message = atob(data.content.data);
+					const message = this._decodeText(data.content.data);
 					for (var i in this._eventListeners["system"]) {
 						this._eventListeners["system"][i](type, message);
 					}
@@ -291,7 +306,8 @@
 					var type = "create";
 					var sessionId = content["session_id"];
 					var error = content["error"];
-					this._eventListeners["session"][i](type, error, sessionId);
+					var status = content["status"];
+					this._eventListeners["session"][i](type, error, sessionId, status);
 				}
 				if (typeof(callback) == "function") {
 					callback(content);
@@ -321,7 +337,8 @@
 				for (var i in this._eventListeners["session"]) {
 					var type = "resume";
 					var error = content["error"];
-					this._eventListeners["session"][i](type, error, sessionId);
+					var status = content["status"];
+					this._eventListeners["session"][i](type, error, sessionId, status);
 				}
 				if (typeof(callback) == "function") {
 					callback(content);
@@ -380,32 +397,84 @@
 			}).bind(this));
 		}
 
-		sendChat(message) {
+		sendChat(message, callback) {
 			if (!this.isConnected()) {
 				this._log("error", "attempted to get the status about a session when not connected")
 				return;
 			}
-			this._send(Packet.CHAT, {
+			return this._send(Packet.CHAT, {
 				"type": "text",
-				"data": btoa(message)
+				"data": this._encodeText(message)
 			}, ((response) => {
 				const msg = response.msg;
 				const contextId = response.cid;
 				const content = response.content;
 				const type = "text";
 				const sender = content.sender;
-				const message = atob(content.data);
 				const bot = content.bot;
 				const error = content.error;
-				for (var i in this._eventListeners["chat"]) {
-					this._eventListeners["chat"][i](type, sender, message, bot, error);
+
+				if (content.type == "queue") {
+					for (var i in this._eventListeners["queue"]) {
+						this._eventListeners["queue"][i](content.position);
+					}
+					return;
+				}
+
+				if (content.stream) {
+					const done = content.stream == "end";
+					const chunk = done ? "" : this._decodeText(content.data);
+					const stats = done ? {
+						"tokens": content.tokens,
+						"timeToFirstToken": content.time_to_first_token,
+						"duration": content.duration
+					} : null;
+					for (var i in this._eventListeners["stream"]) {
+						this._eventListeners["stream"][i](type, sender, chunk, bot, error, done, stats);
+					}
+				} else {
+					const message = content.data ? this._decodeText(content.data) : null;
+					for (var i in this._eventListeners["chat"]) {
+						this._eventListeners["chat"][i](type, sender, message, bot, error);
+					}
 				}
+
 				if (typeof(callback) == "function") {
 					callback(content);
 				}
 			}).bind(this));
 		}
 
+		cancelChat(contextId, callback) {
+			if (!this.isConnected()) {
+				this._log("error", "attempted to cancel a chat message when not connected")
+				return;
+			}
+			this._send(Packet.CHAT, {
+				"type": "cancel",
+				"target": contextId
+			}, ((response) => {
+				if (typeof(callback) == "function") {
+					callback(response.content);
+				}
+			}).bind(this));
+		}
+
+
+		_encodeText(text) {
+			// The original protocol version base64 encodes text, see protocol.md
+			if (this._ws.protocol == "g4ab.v2.json") {
+				return text;
+			}
+			return btoa(String.fromCharCode(...new TextEncoder().encode(text)));
+		}
+
+		_decodeText(data) {
+			if (this._ws.protocol == "g4ab.v2.json") {
+				return data;
+			}
+			return new TextDecoder().decode(Uint8Array.from(atob(data), (c) => c.charCodeAt(0)));
+		}
 
 		_log(level, ...objects) {
 			if (!this._settings.debug) {
@@ -462,6 +531,7 @@
 
 			this._log("debug", `[network] sending ${packet.toUpperCase()} with cid ${contextId}`);
 			this._ws.send(JSON.stringify(json));
+			return contextId;
 		}
 
 	}
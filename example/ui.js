@@ -7,7 +7,8 @@ const SESSION_SETTINGS = {
 	"model": "ggml-gpt4all-l13b-snoozy.bin", // most stable
 	//"model": "ggml-gpt4all-j-v1.3-groovy.bin", // weird behavior, random text response
 	//"model": "ggml-mpt-7b-chat.bin",
-	"temperature": 0.8
+	"temperature": 0.8,
+	"stream": true
 }
 
 const WEBSOCKET_PARAMS = {
@@ -18,6 +19,7 @@ const WEBSOCKET_PARAMS = {
 var sessions = [];
 var statsInterval = null;
 var awaitingResponse = false;
+var streaming = null;
 
 // Note: The chat log is from a trusted source (i.e. the user and the gpt4all-box server, which the client.js scrubs anyway)
 function stripHtml(html) {
@@ -167,7 +169,9 @@ function addToChat(sender, display_name, isBot, message) {
 		if (chat_log != null) {
 			chat_log.push(entry);
 		}
+		return entry;
 	}
+	return null;
 }
 
 function updateStats() {
@@ -185,7 +189,7 @@ function updateStats() {
 		}
 
 		if (sess != null) {
-			client.sessionStatus(sess.id);
+			// The status is pushed by the server once the model is ready, see onSessionState
 
 			// TODO: make this only show once...
 			/*
@@ -294,6 +298,14 @@ function onSessionState(type, error, sessionId, status, settings) {
 	} else if (type == "resume") {
 		//$("#kill").prop("disabled", false);
 		addToChat("client", "Client", false, `<i class="fa fa-info-circle" title="This message was sent by the client."></i>&nbsp;Session resumed. (id:<code>${client.getSessionId()}</code>)`);
+		if (status != undefined) {
+			onSessionState("status", null, sessionId, status);
+		}
+	} else if (type == "ready" || type == "failed") {
+		onSessionState("status", null, sessionId, status);
+		if (type == "failed") {
+			addToChat("client", "Client", false, `<i class="fa fa-info-circle" title="This message was sent by the client."></i>&nbsp;The model of the session failed to load: ${error}`);
+		}
 	} else if (type == "destroy") {
 		$("#kill").prop("disabled", true);
 		$("#send").prop("disabled", true);
@@ -336,6 +348,50 @@ function onChat(type, sender, message, bot, error) {
 	addToChat(sender, name, bot, message);
 }
 
+function onQueue(position) {
+	if (awaitingResponse) {
+		$("#chat-statusbar-status").html(`<i class="fa fa-cog fa-spin fa-fw"></i>Waiting in queue (position ${position}) ...`);
+	}
+}
+
+function onStream(type, sender, chunk, bot, error, done, stats) {
+
+	if (error) {
+		console.error("stream error! ", error);
+	}
+
+	// First chunk of a new response
+	if (streaming == null) {
+		if (awaitingResponse) {
+			awaitingResponse = false;
+			$("#chat-statusbar-status").html(``);
+			$("#chat-statusbar").removeClass("chat-statusbar-awaiting-response");
+		}
+		const name = (bot ? "<i class='fa fa-desktop' title='This user is a bot.'></i>&nbsp;" + sender : sender);
+		const entry = addToChat(sender, name, bot, "");
+		streaming = {
+			"element": $(ELEMENT.chat).children().last().find(".content"),
+			"entry": entry,
+			"text": ""
+		};
+	}
+
+	streaming.text += chunk;
+	const message = marked.parse(streaming.text);
+	streaming.element.html(message);
+	if (streaming.entry != null) {
+		streaming.entry.message = message;
+	}
+
+	if (done) {
+		if (stats != null) {
+			console.log(`response: ${stats.tokens} tokens, ${stats.timeToFirstToken}ms to first token, ${stats.duration}ms total`);
+		}
+		streaming = null;
+		$(ELEMENT.chat).animate({scrollTop: $(ELEMENT.chat).height()}, 1000);
+	}
+}
+
 client = new Gpt4AllBox({
 	debug: true,
 	//websocket: ReconnectingWebSocket
@@ -346,6 +402,8 @@ client.addEventListener("disconnect", onDisconnect);
 client.addEventListener("system", onSysemMessage);
 client.addEventListener("session", onSessionState);
 client.addEventListener("chat", onChat);
+client.addEventListener("stream", onStream);
+client.addEventListener("queue", onQueue);
 
 // On DOM loaded
 window.addEventListener("load", () => {
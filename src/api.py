@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import re
+import json
+import time
+import uuid
+import queue
+import logging
+import threading
+from typing import Callable
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import codec
+from packet import Packet
+
+logger = logging.getLogger(__name__)
+SESSION_PATH = re.compile(r"^/v1/sessions/([0-9a-zA-Z]+)(/chat)?$")
+
+# HTTP status of the errors of chat responses, anything else is a 500
+ERROR_STATUS = {
+    "expired": 404,
+    "too many queued requests": 429,
+    "rate limited": 429,
+    "too many sessions": 503,
+    "too many models loaded": 503,
+    "deadline exceeded": 504,
+    "failed to load model": 503,
+    "server is restarting": 503,
+    "invalid settings": 400,
+    "deadline must be a non-negative integer": 400
+}
+
+class ApiError(Exception):
+
+    def __init__(self, status:int, error:str, retry_after:int=None):
+        super().__init__(error)
+        self.status = status
+        self.error = error
+        # Milliseconds
+        self.retry_after = retry_after
+
+    def to_dict(self):
+        content = {"error": self.error}
+        if self.retry_after != None:
+            content["retry_after"] = self.retry_after
+        return content
+
+class _HttpClient:
+    """
+    Stands in for a WebSocket client for the duration of one HTTP request, collecting
+    the packets sent to it so the request handler can wait for them.
+    """
+
+    def __init__(self, client_id:int, address:str, port:int):
+        self.id = client_id
+        self.address = address
+        self.port = port
+        self.name = f"HTTP client #{client_id} ({address}:{port})"
+        self.session = None
+        self.packets = queue.Queue()
+
+    def __str__(self):
+        return self.name
+
+    def get_protocol(self):
+        # Worker processes send text as is
+        return codec.JSON
+
+    def set_session(self, session):
+        self.session = session
+        if session != None:
+            session.get_gpt()
+
+    def get_session(self):
+        return self.session
+
+    def send(self, packet:Packet, content:dict=None, context_id:str=None):
+        self.packets.put({"msg": str(packet), "cid": context_id, "content": content})
+
+    def send_raw(self, payload):
+        # From worker processes, serialized in the JSON protocol version
+        self.packets.put(json.loads(payload))
+
+    def disconnect(self):
+        # The request was rejected
+        self.packets.put(None)
+
+    def receive(self, context_id:str, timeout:float):
+        """
+        Returns the content of the next packet for context_id, skipping queue positions.
+        """
+        deadline = time.time() + timeout
+        while True:
+            try:
+                msg = self.packets.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                raise ApiError(504, "timed out")
+            if msg == None:
+                raise ApiError(400, "invalid request")
+            if msg["cid"] != context_id or msg["content"].get("type") == "queue":
+                continue
+            return msg["content"]
+
+    def get_id(self):
+        return self.id
+
+    def get_address(self):
+        return self.address
+
+    def get_port(self):
+        return self.port
+
+class _EventStream:
+    """
+    Server-sent events, in chunked transfer encoding so the connection is kept alive.
+    """
+
+    def __init__(self, handler:BaseHTTPRequestHandler):
+        self.handler = handler
+        self.started = False
+
+    def send(self, event:str, data:dict):
+        if not self.started:
+            self.handler.send_response(200)
+            self.handler.send_header("Content-Type", "text/event-stream; charset=utf-8")
+            self.handler.send_header("Cache-Control", "no-cache")
+            self.handler.send_header("Transfer-Encoding", "chunked")
+            self.handler.end_headers()
+            self.started = True
+        self._write(f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+    def close(self):
+        if self.started:
+            self._write(b"")
+
+    def _write(self, body:bytes):
+        self.handler.wfile.write(f"{len(body):x}\r\n".encode("ascii") + body + b"\r\n")
+        self.handler.wfile.flush()
+
+class HttpApi:
+    """
+    Stateless HTTP access to the same sessions and inference slots as the WebSocket server,
+    see the HTTP API section of the README. Every request acts as a short-lived client of
+    the core (or worker pool), so both behave exactly the same.
+    """
+
+    def __init__(self, core, clients, client_ids, timeout:int, max_body_size:int, admission):
+        self.core = core
+        self.admission = admission
+        self.clients = clients
+        self.client_ids = client_ids
+        # Seconds to wait for a response
+        self.timeout = timeout / 1000
+        self.max_body_size = max_body_size
+
+    def serve(self, address:str, port:int, stats:Callable, reuse_port:bool=False):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, every response has a length or is chunked
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                if self.path == "/v1/stats":
+                    self._respond(200, stats())
+                    return
+                self._handle("GET")
+
+            def do_POST(self):
+                self._handle("POST")
+
+            def do_DELETE(self):
+                self._handle("DELETE")
+
+            def _handle(self, method:str):
+                client = _HttpClient(next(api.client_ids), self.client_address[0], self.client_address[1])
+                events = _EventStream(self)
+                api.clients.add(client)
+                try:
+                    body = self._read_body()
+                    status, content = api.handle(client, method, self.path, body, events)
+                    if status != None:
+                        self._respond(status, content)
+                except (BrokenPipeError, ConnectionResetError):
+                    # Gone while streaming, on_disconnect stops the generation
+                    self.close_connection = True
+                except Exception as e:
+                    if not isinstance(e, ApiError):
+                        logger.warning(f"{client} attempted an invalid action ({e})")
+                        e = ApiError(400, str(e))
+                    if events.started:
+                        # Too late for a status, end the stream
+                        self.close_connection = True
+                    else:
+                        self._respond(e.status, e.to_dict())
+                finally:
+                    api.clients.remove(client.get_id())
+                    api.core.on_disconnect(client)
+
+            def _read_body(self):
+                length = int(self.headers.get("Content-Length", 0))
+                if length > api.max_body_size:
+                    # The body is not read, the connection cannot be reused
+                    self.close_connection = True
+                    raise ApiError(413, "request too large")
+                try:
+                    body = json.loads(self.rfile.read(length) or b"{}")
+                except ValueError:
+                    raise ApiError(400, "malformed JSON")
+                if not isinstance(body, dict):
+                    raise ApiError(400, "request must be a JSON object")
+                return body
+
+            def _respond(self, status:int, content:dict):
+                body = json.dumps(content, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                if content.get("retry_after") != None:
+                    # Whole seconds, rounded up
+                    self.send_header("Retry-After", str(-(-content["retry_after"] // 1000)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((address, port), Handler, bind_and_activate=False)
+        # The next instance of the server may listen on the same port while this one drains
+        server.allow_reuse_port = reuse_port
+        server.server_bind()
+        server.server_activate()
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever, name="http-api", daemon=True)
+        thread.start()
+        logger.info(f"HTTP API listening on {address}:{port} ...")
+        return server
+
+    def handle(self, client:_HttpClient, method:str, path:str, body:dict, events:_EventStream):
+        """
+        Returns the HTTP status and JSON content of a request, or None for a status if
+        the response was streamed as events.
+        """
+        path = path.split("?")[0]
+        if method == "POST" and path == "/v1/completions":
+            return self.complete(client, body, events)
+        if method == "POST" and path == "/v1/sessions":
+            return self.create_session(client, body)
+
+        match = SESSION_PATH.match(path)
+        if match == None:
+            raise ApiError(404, "not found")
+        session_id = match.group(1)
+        if method == "POST" and match.group(2) != None:
+            return self.chat(client, session_id, body, events)
+        if match.group(2) != None:
+            raise ApiError(405, "method not allowed")
+        if method == "GET":
+            return 200, self._session_status(client, session_id)
+        if method == "DELETE":
+            self._resume(client, session_id)
+            content = self._session_request(client, {"request": "destroy"})
+            if not content["success"]:
+                raise ApiError(404, content["error"])
+            return 200, {"session_id": session_id}
+        raise ApiError(405, "method not allowed")
+
+    def complete(self, client:_HttpClient, body:dict, events:_EventStream):
+        # A batch of one prompt, it waits for the model and has no history
+        if not isinstance(body.get("prompt"), str):
+            raise ApiError(400, "prompt must be a string")
+        if not isinstance(body.get("settings", {}), dict):
+            raise ApiError(400, "settings must be an object")
+        settings = dict(body.get("settings", {}))
+        settings["stream"] = body.get("stream", False) == True
+        # The batch shares the cid of its prompt, so a rejected batch answers the request too
+        context_id = uuid.uuid4().hex
+        item = {"cid": context_id, "data": body["prompt"]}
+        if "model" in body:
+            item["model"] = body["model"]
+
+        msg = {"msg": str(Packet.BATCH), "cid": context_id, "content": {
+            "settings": settings,
+            "deadline": body.get("deadline"),
+            "items": [item]
+        }}
+        self._admit(client, msg)
+        self.core.on_batch(client, msg)
+        return self._respond_chat(client, item["cid"], events, settings["stream"])
+
+    def create_session(self, client:_HttpClient, body:dict):
+        content = self._session_request(client, {"request": "create", "settings": body.get("settings", {})})
+        if not content["success"]:
+            raise ApiError(ERROR_STATUS.get(content["error"], 500), content["error"], content.get("retry_after"))
+        return 201, {"session_id": content["session_id"]}
+
+    def chat(self, client:_HttpClient, session_id:str, body:dict, events:_EventStream):
+        if not isinstance(body.get("message"), str):
+            raise ApiError(400, "message must be a string")
+        # Messages wait for the model of the session to load
+        self._resume(client, session_id)
+
+        # Streamed per request, whatever the session was created with
+        stream = body.get("stream", False) == True
+        context_id = uuid.uuid4().hex
+        msg = {"msg": str(Packet.CHAT), "cid": context_id, "content": {
+            "type": "text",
+            "data": body["message"],
+            "deadline": body.get("deadline"),
+            "stream": stream
+        }}
+        self._admit(client, msg)
+        self.core.on_chat(client, msg)
+        return self._respond_chat(client, context_id, events, stream, {"session_id": session_id})
+
+    def _respond_chat(self, client:_HttpClient, context_id:str, events:_EventStream, stream:bool, extra:dict={}):
+        chunks = []
+        while True:
+            content = client.receive(context_id, self.timeout)
+            if content.get("stream") == "chunk":
+                chunks.append(content["data"])
+                if stream:
+                    events.send("chunk", {"index": content["index"], "text": content["data"]})
+                continue
+            break
+
+        # Streaming sessions send the text as chunks only
+        text = "".join(chunks) if content.get("stream") == "end" else content.get("data")
+        result = {
+            "id": context_id,
+            "success": content["success"],
+            "error": content["error"],
+            "text": text,
+            "usage": content.get("usage")
+        }
+        if "retry_after" in content:
+            result["retry_after"] = content["retry_after"]
+        result.update(extra)
+        status = 200 if content["success"] else ERROR_STATUS.get(content["error"], 500)
+        # Errors before anything was streamed are answered like any other request
+        if not stream or (not events.started and not content["success"]):
+            return status, result
+
+        events.send("end" if content["success"] else "error", result)
+        events.close()
+        return None, None
+
+    def _resume(self, client:_HttpClient, session_id:str):
+        content = self._session_request(client, {"request": "resume", "session_id": session_id})
+        if not content["success"]:
+            raise ApiError(404, content["error"])
+
+    def _session_status(self, client:_HttpClient, session_id:str):
+        content = self._session_request(client, {"request": "status", "session_id": session_id})
+        if not content["success"]:
+            raise ApiError(404, content["error"])
+        return {"session_id": session_id, "status": content["status"], "settings": content["settings"]}
+
+    def _admit(self, client:_HttpClient, msg:dict):
+        retry_after = self.admission.check(client, msg)
+        if retry_after > 0:
+            raise ApiError(429, "rate limited", retry_after)
+
+    def _session_request(self, client:_HttpClient, content:dict):
+        msg = {"msg": str(Packet.SESSION), "cid": uuid.uuid4().hex, "content": content}
+        self._admit(client, msg)
+        self.core.on_session(client, msg)
+        return client.receive(msg["cid"], self.timeout)
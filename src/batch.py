@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import time
+import logging
+import threading
+
+from packet import Packet
+from session import Session
+from request import ChatRequest
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+BATCH_ITEMS = Counter("g4ab_batch_items_total", "Prompts of batches answered, by whether they succeeded.", ("result",))
+
+class _BatchClient:
+    """
+    Stands in for the client that sent a batch, so the responses to its items are
+    counted before they are passed on.
+    """
+
+    def __init__(self, client, batch):
+        self.client = client
+        self.batch = batch
+
+    def __str__(self):
+        return str(self.client)
+
+    def send(self, packet:Packet, content:dict=None, context_id:str=None):
+        self.client.send(packet=packet, content=content, context_id=context_id)
+        # Queue positions and stream chunks are followed by the actual response
+        if packet == Packet.CHAT and content.get("type") != "queue" and content.get("stream") != "chunk":
+            self.batch.complete(content)
+
+    def get_id(self):
+        return self.client.get_id()
+
+    def get_address(self):
+        return self.client.get_address()
+
+    def get_port(self):
+        return self.client.get_port()
+
+class Batch:
+    """
+    Many independent prompts of one client, each answered without any conversation
+    history and with its own cid. Prompts are grouped into one temporary session per
+    model, so the scheduler runs the models in parallel while the prompts of a model
+    follow each other. The batch ends with a summary of the throughput once every
+    prompt was answered.
+    """
+
+    def __init__(self, client, context_id:str, items:list, settings:dict, deadline:int, core):
+        self.client = client
+        # Responses to the prompts are sent through it
+        self.proxy = _BatchClient(client, self)
+        self.context_id = context_id
+        self.items = items
+        self.settings = settings
+        self.deadline = deadline
+        self.core = core
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+        self.remaining = len(items)
+        self.succeeded = 0
+        self.failed = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.started = time.time()
+
+    def start(self):
+        # Loading the models may take a while, never block the caller
+        thread = threading.Thread(target=self._run, name=f"batch-{self.context_id}", daemon=True)
+        thread.start()
+
+    def complete(self, content:dict):
+        usage = content.get("usage")
+        with self.lock:
+            self.remaining -= 1
+            if content["success"]:
+                self.succeeded += 1
+            else:
+                self.failed += 1
+            if usage != None:
+                self.prompt_tokens += usage["prompt_tokens"]
+                self.completion_tokens += usage["completion_tokens"]
+            finished = self.remaining == 0
+        BATCH_ITEMS.inc(1, "success" if content["success"] else "failure")
+
+        if finished:
+            self._finish()
+
+    def _run(self):
+        # Every model loads at the same time, the models are then waited for in turn
+        for item in self.items:
+            model = item.get("model", self.settings.get("model"))
+            if model not in self.sessions:
+                settings = dict(self.settings)
+                if model != None:
+                    settings["model"] = model
+                # Batches never share responses with sessions that are in flight
+                self.sessions[model] = Session(self.core.max_idle_session_duration, self.core.pool, settings, None, self.core.cache, None)
+
+        gpts = {}
+        for model, session in self.sessions.items():
+            gpt = session.get_gpt()
+            gpt.wait_initialized()
+            gpts[model] = gpt
+
+        for item in self.items:
+            model = item.get("model", self.settings.get("model"))
+            gpt = gpts[model]
+            deadline = self.deadline if self.deadline != None else gpt.get_settings()["deadline"]
+            request = ChatRequest(self.proxy, item["cid"], item["data"], int(deadline), self.core.requests, gpt.get_settings()["stream"])
+            self.core.requests.add(request)
+
+            if gpt.get_status() == "error":
+                request.done()
+                self.proxy.send(packet=Packet.CHAT, content={
+                    "success": False,
+                    "error": "failed to load model"
+                }, context_id=item["cid"])
+                continue
+
+            gpt.enqueue()
+            # No queue positions, they would be sent for every prompt of the batch
+            self.core.scheduler.submit(self.sessions[model].get_id(), gpt.get_model_instance(), lambda gpt=gpt, request=request: self._prompt(gpt, request))
+
+    def _prompt(self, gpt, request:ChatRequest):
+        # Every prompt stands on its own
+        gpt.set_history([])
+        gpt.prompt(request=request)
+
+    def _finish(self):
+        for session in self.sessions.values():
+            session.destroy()
+        self.core.add_batch_sessions(-len(self.sessions))
+
+        duration = time.time() - self.started
+        client = self.client
+        logger.info(f"{client} finished batch {self.context_id} of {len(self.items)} prompts ({self.failed} failed) in {duration:.2f} seconds")
+        client.send(packet=Packet.BATCH, content={
+            "success": True,
+            "error": None,
+            "items": len(self.items),
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "duration": int(duration * 1000),
+            "tokens_per_second": round(self.completion_tokens / duration, 1) if duration > 0 else 0,
+            "prompts_per_second": round(len(self.items) / duration, 2) if duration > 0 else 0
+        }, context_id=self.context_id)
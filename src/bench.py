@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Load test for the gpt4all-box server, with a fake model backend so it runs offline
+without a GPU or model files.
+
+Starts g4ab.py in a subprocess with MODEL_BACKEND=bench.load_fake_model (unless --url is
+given) and drives simulated WebSocket clients through the flows of protocol.md:
+ping, session create, status (until idle), resume and chat.
+
+    python src/bench.py --clients 1000 --chats 2 --tokens 32 --token-latency 5
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import base64
+import signal
+import asyncio
+import argparse
+import resource
+import subprocess
+
+FAKE_TOKEN_LATENCY = 5 # milliseconds per generated token
+FAKE_PROMPT_LATENCY = 0 # milliseconds per 1000 prompt characters
+FAKE_LOAD_TIME = 0 # milliseconds to "load" a model
+
+class FakeModel:
+    """
+    Implements the part of the GPT4All API the server uses, generating n_predict
+    tokens with a fixed per-token latency.
+    """
+
+    class _Backend:
+        def set_thread_count(self, n_threads:int):
+            pass
+
+    def __init__(self, token_latency:int, prompt_latency:int):
+        self.model = self._Backend()
+        self.token_latency = token_latency / 1000
+        self.prompt_latency = prompt_latency / 1000
+        self.n_past = 0
+
+    def generate(self, prompt:str, streaming:bool=False, n_predict:int=128, n_past:int=0, **kwargs):
+        tokens = self._generate(prompt, n_predict, n_past)
+        if streaming:
+            return tokens
+        return "".join(tokens)
+
+    def get_n_past(self):
+        return self.n_past
+
+    def _generate(self, prompt:str, n_predict:int, n_past:int):
+        # A token per 4 prompt characters
+        self.n_past = n_past + len(prompt) // 4
+        time.sleep(len(prompt) / 1000 * self.prompt_latency)
+        for i in range(n_predict):
+            time.sleep(self.token_latency)
+            self.n_past += 1
+            yield f" tok{i}"
+
+def load_fake_model(model_name:str, model_type:str, thread_count:int):
+    time.sleep(int(os.getenv("FAKE_LOAD_TIME", FAKE_LOAD_TIME)) / 1000)
+    return FakeModel(int(os.getenv("FAKE_TOKEN_LATENCY", FAKE_TOKEN_LATENCY)), int(os.getenv("FAKE_PROMPT_LATENCY", FAKE_PROMPT_LATENCY)))
+
+class Stats:
+
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self.tokens = 0
+
+    def add(self, name:str, seconds:float):
+        self.samples.setdefault(name, []).append(seconds * 1000)
+
+    def error(self, name:str):
+        self.errors[name] = self.errors.get(name, 0) + 1
+
+    def summary(self, duration:float):
+        result = {
+            "duration": round(duration, 3),
+            "tokens_per_second": round(self.tokens / duration, 1) if duration > 0 else 0,
+            "errors": self.errors,
+            "operations": {}
+        }
+        for name, samples in sorted(self.samples.items()):
+            samples = sorted(samples)
+            result["operations"][name] = {
+                "count": len(samples),
+                "per_second": round(len(samples) / duration, 1) if duration > 0 else 0,
+                "p50": round(_percentile(samples, 50), 2),
+                "p95": round(_percentile(samples, 95), 2),
+                "p99": round(_percentile(samples, 99), 2),
+                "max": round(samples[-1], 2)
+            }
+        return result
+
+def _percentile(samples:list, percent:int):
+    if len(samples) == 0:
+        return 0
+    index = min(len(samples) - 1, int(round(percent / 100 * (len(samples) - 1))))
+    return samples[index]
+
+class BenchClient:
+
+    def __init__(self, websocket, stats:Stats):
+        self.websocket = websocket
+        self.stats = stats
+
+    async def request(self, msg:str, content:dict, name:str):
+        """
+        Send a packet and return the content of the first response with the same cid,
+        skipping queue position updates.
+        """
+        cid = uuid.uuid4().hex
+        start = time.perf_counter()
+        await self.websocket.send(json.dumps({"msg": msg, "cid": cid, "content": content}))
+        while True:
+            response = json.loads(await self.websocket.recv())
+            if response["cid"] != cid:
+                continue
+            if response["content"] != None and response["content"].get("type") == "queue":
+                continue
+            self.stats.add(name, time.perf_counter() - start)
+            return response["content"]
+
+    async def chat(self, text:str, stream:bool):
+        cid = uuid.uuid4().hex
+        start = time.perf_counter()
+        first_token = None
+        await self.websocket.send(json.dumps({"msg": "chat", "cid": cid, "content": {"type": "text", "data": base64.b64encode(text.encode("utf-8")).decode("utf-8")}}))
+        while True:
+            response = json.loads(await self.websocket.recv())
+            content = response["content"]
+            if response["cid"] != cid or content.get("type") == "queue":
+                continue
+            if not content["success"]:
+                self.stats.error("chat")
+                return
+            if stream and content.get("stream") == "chunk":
+                if first_token == None:
+                    first_token = time.perf_counter()
+                continue
+            end = time.perf_counter()
+            if stream:
+                self.stats.tokens += content["tokens"]
+            else:
+                self.stats.tokens += len(base64.b64decode(content["data"]).decode("utf-8").split(" ")) - 1
+                first_token = end
+            self.stats.add("chat", end - start)
+            self.stats.add("time_to_first_token", (first_token or end) - start)
+            return
+
+async def _simulate(url:str, args, stats:Stats, ready:asyncio.Event, sessions:list):
+    import websockets
+    try:
+        async with websockets.connect(url, max_size=None, open_timeout=60) as websocket:
+            client = BenchClient(websocket, stats)
+
+            for i in range(args.pings):
+                await client.request("ping", None, "ping")
+
+            settings = {"model": args.model, "n_predict": args.tokens, "stream": args.stream, "temperature": args.temperature}
+            content = await client.request("session", {"request": "create", "settings": settings}, "session_create")
+            if not content["success"]:
+                stats.error("session_create")
+                return
+            session_id = content["session_id"]
+            sessions.append(session_id)
+
+            start = time.perf_counter()
+            while True:
+                content = await client.request("session", {"request": "status", "session_id": session_id}, "session_status")
+                if not content["success"]:
+                    stats.error("session_status")
+                    return
+                if content["status"] != "initializing":
+                    break
+                await asyncio.sleep(0.05)
+            stats.add("session_ready", time.perf_counter() - start)
+
+            content = await client.request("session", {"request": "resume", "session_id": session_id}, "session_resume")
+            if not content["success"]:
+                stats.error("session_resume")
+
+            # Wait until every client has a session, so the chats hit the server at once
+            await ready.wait()
+
+            for i in range(args.chats):
+                await client.chat(args.prompt, args.stream)
+    except Exception as e:
+        stats.error(type(e).__name__)
+
+def _rss(pid:int):
+    # Resident set size in KiB, Linux only
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+async def _run(args, url:str, server:subprocess.Popen):
+    stats = Stats()
+    ready = asyncio.Event()
+    sessions = []
+    rss_before = _rss(server.pid) if server != None else None
+
+    start = time.perf_counter()
+    semaphore = asyncio.Semaphore(args.connect_rate)
+
+    async def launch():
+        async with semaphore:
+            await asyncio.sleep(0)
+        await _simulate(url, args, stats, ready, sessions)
+
+    tasks = [asyncio.create_task(launch()) for i in range(args.clients)]
+
+    # Release the chats once all sessions exist (or the clients creating them failed)
+    while len(sessions) + sum(stats.errors.values()) < args.clients and not all(t.done() for t in tasks):
+        await asyncio.sleep(0.05)
+    rss_sessions = _rss(server.pid) if server != None else None
+    ready.set()
+
+    await asyncio.gather(*tasks)
+    summary = stats.summary(time.perf_counter() - start)
+    summary["clients"] = args.clients
+    summary["sessions"] = len(sessions)
+
+    if rss_before != None and rss_sessions != None and len(sessions) > 0:
+        summary["memory_per_session_kib"] = round((rss_sessions - rss_before) / len(sessions), 1)
+
+    return summary
+
+def _start_server(args):
+    env = dict(os.environ)
+    env.update({
+        "PORT": str(args.port),
+        "ADDRESS": "127.0.0.1",
+        "MODEL_BACKEND": "bench.load_fake_model",
+        "FAKE_TOKEN_LATENCY": str(args.token_latency),
+        "FAKE_PROMPT_LATENCY": str(args.prompt_latency),
+        "FAKE_LOAD_TIME": str(args.load_time),
+        "PUBLIC_IP_LOOKUP": "0",
+        "WORKERS": str(args.workers)
+    })
+    server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "g4ab.py")], env=env, stdout=subprocess.DEVNULL, stderr=None if args.verbose else subprocess.DEVNULL)
+
+    # Wait for the port to accept connections
+    import socket
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", args.port), timeout=1).close()
+            return server
+        except OSError:
+            if server.poll() != None:
+                raise Exception(f"server exited with code {server.returncode}")
+            time.sleep(0.1)
+    server.kill()
+    raise Exception("server did not start listening")
+
+def main():
+    parser = argparse.ArgumentParser(description="gpt4all-box load test with a fake model backend")
+    parser.add_argument("--url", help="benchmark an already running server instead of starting one")
+    parser.add_argument("--port", type=int, default=18184)
+    parser.add_argument("--clients", type=int, default=100, help="number of simulated clients")
+    parser.add_argument("--connect-rate", type=int, default=200, help="clients connecting at once")
+    parser.add_argument("--pings", type=int, default=5, help="pings per client")
+    parser.add_argument("--chats", type=int, default=1, help="chat messages per client")
+    parser.add_argument("--prompt", default="What is the capital of France?")
+    parser.add_argument("--model", default="ggml-gpt4all-l13b-snoozy.bin")
+    parser.add_argument("--tokens", type=int, default=32, help="tokens generated per chat")
+    parser.add_argument("--temperature", type=float, default=0.1)
+    parser.add_argument("--stream", action=argparse.BooleanOptionalAction, default=True, help="stream chat responses")
+    parser.add_argument("--token-latency", type=int, default=FAKE_TOKEN_LATENCY, help="fake model milliseconds per token")
+    parser.add_argument("--prompt-latency", type=int, default=FAKE_PROMPT_LATENCY, help="fake model milliseconds per 1000 prompt characters")
+    parser.add_argument("--load-time", type=int, default=FAKE_LOAD_TIME, help="fake model load time in milliseconds")
+    parser.add_argument("--workers", type=int, default=0, help="WORKERS of the started server")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--verbose", action="store_true", help="show the server log")
+    args = parser.parse_args()
+
+    # Every simulated client needs a socket
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    server = None
+    url = args.url
+    if url == None:
+        server = _start_server(args)
+        url = f"ws://127.0.0.1:{args.port}"
+
+    try:
+        summary = asyncio.run(_run(args, url, server))
+    finally:
+        if server != None:
+            server.send_signal(signal.SIGINT)
+            try:
+                server.wait(10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+
+    output = json.dumps(summary, indent=4)
+    print(output)
+    if args.output != None:
+        with open(args.output, "w") as f:
+            f.write(output)
+
+if __name__ == '__main__':
+    main()
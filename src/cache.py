@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from metrics import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+# Settings that change what a model generates for a prompt
+CACHE_SETTINGS = ("seed", "n_ctx", "n_predict", "top_k", "top_p", "temperature", "repeat_penalty", "repeat_last_n", "context_erase")
+CACHE_VERSION = 1
+
+CACHE_REQUESTS = Counter("g4ab_response_cache_requests_total", "Response cache lookups.", ("result",))
+CACHE_ENTRIES = Gauge("g4ab_response_cache_entries", "Responses in the response cache.")
+
+def make_key(model:str, settings:dict, conversation:str):
+    """
+    Cache key of a response, from the model file, the sampling settings and the
+    conversation with its whitespace normalized.
+    """
+    normalized = " ".join(conversation.split())
+    values = [settings[k] for k in CACHE_SETTINGS]
+    # Without sampling the (random by default) seed has no effect
+    if settings["temperature"] == 0:
+        values[CACHE_SETTINGS.index("seed")] = None
+    data = json.dumps([model, values, normalized])
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """
+    LRU cache of generated responses (as their list of tokens) with a maximum number
+    of entries and a time to live. Optionally persisted to a JSON file, which is
+    written from the heartbeat when the cache changed and on shutdown.
+    """
+
+    def __init__(self, max_entries:int, ttl:int, path:str=None):
+        self.max_entries = max_entries
+        self.ttl = ttl / 1000
+        self.path = path
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.dirty = False
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        CACHE_ENTRIES.set_function(lambda: len(self.entries))
+
+        if self.path != None:
+            self.load()
+
+    def get(self, key:str):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry != None and time.time() > entry[0] + self.ttl:
+                del self.entries[key]
+                self.dirty = True
+                entry = None
+
+            if entry == None:
+                self.misses += 1
+                CACHE_REQUESTS.inc(1, "miss")
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            CACHE_REQUESTS.inc(1, "hit")
+            return list(entry[1])
+
+    def put(self, key:str, tokens:list):
+        with self.lock:
+            self.entries[key] = (time.time(), list(tokens))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+            self.dirty = True
+
+    def prune(self):
+        """
+        Drops expired entries and saves the cache if it changed, returns the number dropped.
+        """
+        now = time.time()
+        with self.lock:
+            expired = [k for k, entry in self.entries.items() if now > entry[0] + self.ttl]
+            for key in expired:
+                del self.entries[key]
+            if len(expired) > 0:
+                self.dirty = True
+
+        if self.path != None and self.dirty:
+            self.save()
+        return len(expired)
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"Failed to load response cache from {self.path} ({e})")
+            return
+
+        if data.get("version") != CACHE_VERSION:
+            logger.warning(f"Ignoring response cache {self.path} of version {data.get('version')}")
+            return
+
+        now = time.time()
+        with self.lock:
+            # Stored least recently used first
+            for key, created, tokens in data["entries"]:
+                if now <= created + self.ttl:
+                    self.entries[key] = (created, tokens)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        logger.info(f"Loaded {len(self.entries)} cached responses from {self.path}")
+
+    def save(self):
+        with self.lock:
+            data = {
+                "version": CACHE_VERSION,
+                "entries": [[k, created, tokens] for k, (created, tokens) in self.entries.items()]
+            }
+            self.dirty = False
+
+        # Written next to the cache first, so a crash never leaves a truncated file
+        try:
+            with open(self.path + ".tmp", "w") as f:
+                json.dump(data, f)
+            os.replace(self.path + ".tmp", self.path)
+        except OSError as e:
+            logger.warning(f"Failed to save response cache to {self.path} ({e})")
+            self.dirty = True
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+DEDUPLICATED_REQUESTS = Counter("g4ab_deduplicated_requests_total", "Chat requests answered by an identical request that was already queued or running.")
+
+class _Subscriber:
+
+    def __init__(self, gpt, request):
+        self.gpt = gpt
+        self.request = request
+        # Number of tokens streamed to this subscriber
+        self.sent = 0
+
+class _Flight:
+
+    def __init__(self):
+        self.tokens = []
+        self.subscribers = []
+
+class SingleFlight:
+    """
+    Coalesces identical deterministic chat requests (by their response cache key)
+    that are queued or running into one generation. The session that sent the
+    request first generates, and its tokens and response are passed on to the
+    sessions that subscribed while it was in flight.
+
+    Subscribers are only ever sent to from the generating thread, so they receive
+    the tokens generated before they subscribed first and in order.
+    """
+
+    def __init__(self):
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.deduplicated = 0
+
+    def join(self, key:str, gpt, request):
+        """
+        Returns True if there is no identical request in flight and the caller has to
+        generate (and then finish the flight), False if it subscribed to one.
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight == None:
+                self.flights[key] = _Flight()
+                return True
+            flight.subscribers.append(_Subscriber(gpt, request))
+            gpt.subscribe()
+            self.deduplicated += 1
+        DEDUPLICATED_REQUESTS.inc()
+        return False
+
+    def leave(self, request):
+        """
+        Fails a subscribed request that was stopped, returns False if it is not subscribed.
+        """
+        with self.lock:
+            subscriber = self._remove(lambda s: s.request is request)
+        if subscriber == None:
+            return False
+        subscriber.gpt.fail(request, request.get_error())
+        return True
+
+    def has_subscribers(self, key:str):
+        with self.lock:
+            flight = self.flights.get(key)
+            return flight != None and len(flight.subscribers) > 0
+
+    def publish(self, key:str, token:str):
+        with self.lock:
+            flight = self.flights[key]
+            flight.tokens.append(token)
+            subscribers = list(flight.subscribers)
+        for subscriber in subscribers:
+            # Subscribers past their deadline stop waiting
+            if subscriber.request.get_error() != None:
+                self.leave(subscriber.request)
+                continue
+            self._stream(flight, subscriber)
+
+    def finish(self, key:str, tokens:list=None, start:float=None, first_token:float=None, end:float=None):
+        """
+        Ends the flight, passing the response on to the subscribers, or failing them
+        without tokens. Does nothing if the flight already ended.
+        """
+        with self.lock:
+            flight = self.flights.pop(key, None)
+        if flight == None:
+            return
+
+        for subscriber in flight.subscribers:
+            if tokens == None:
+                subscriber.gpt.fail(subscriber.request, "generation failed")
+                continue
+            flight.tokens = tokens
+            self._stream(flight, subscriber)
+            subscriber.gpt.receive(subscriber.request, tokens, start, first_token, end)
+
+    def count(self):
+        with self.lock:
+            return len(self.flights)
+
+    def _remove(self, match):
+        for flight in self.flights.values():
+            for subscriber in flight.subscribers:
+                if match(subscriber):
+                    flight.subscribers.remove(subscriber)
+                    return subscriber
+        return None
+
+    def _stream(self, flight:_Flight, subscriber:_Subscriber):
+        if not subscriber.request.is_stream():
+            return
+        tokens = flight.tokens
+        while subscriber.sent < len(tokens):
+            subscriber.gpt.send_chunk(subscriber.request, subscriber.sent, tokens[subscriber.sent])
+            subscriber.sent += 1
@@ -1,57 +1,137 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import json
 import uuid
+import asyncio
 import logging
+import threading
 
+import logs
 from packet import Packet
+from codec import Codec
+from metrics import Counter
 
 logger = logging.getLogger(__name__)
+SENT_BYTES = Counter("g4ab_sent_bytes_total", "Bytes queued for sending to clients.")
+SENT_MESSAGES = Counter("g4ab_sent_messages_total", "Messages queued for sending to clients.")
 
 class Client:
 
-    def __init__(self, wsclient, session=None):
-        self.wsclient = wsclient
+    def __init__(self, client_id:int, websocket, loop:asyncio.AbstractEventLoop, send_queue_size:int, session=None, protocol:str=None):
+        self.id = client_id
+        self.websocket = websocket
+        # Protocol version negotiated as the WebSocket subprotocol
+        self.codec = Codec(protocol)
+        self.loop = loop
+        # Clients are created on the event loop thread
+        self.loop_thread = threading.get_ident()
         self.session = session
+        self.closed = False
+        # Outgoing messages, drained by writer() so a slow client never blocks the event loop
+        self.queue = asyncio.Queue(maxsize=send_queue_size)
+        # Formatted once, clients are named in most log messages
+        self.address, self.port = websocket.remote_address[:2]
+        self.name = f"Client #{client_id} ({self.address}:{self.port})"
+        self.verbose = logs.is_verbose(self.address)
 
-        session_string = ""
+        if session != None and logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"{self} initialized with session id {session.get_id()}")
 
-        if session != None:
-            session_string = f" initialized with session id {session.get_id()}"
-
-        logger.debug(f"Client #{self.get_id()} ({self.get_address()}:{self.get_port()}){session_string}")
+    def __str__(self):
+        return self.name
 
     def set_session(self, session):
-        logger.debug(f"Client #{self.get_id()} ({self.get_address()}:{self.get_port()}) session id updated to {session.get_id()}")
         self.session = session
+        if session == None:
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"{self} session cleared")
+            return
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"{self} session id updated to {session.get_id()}")
         session.get_gpt()
 
+    def trace(self):
+        """
+        Returns the level to log a packet of this client at, or None to skip it (most of
+        the time, so check before formatting anything).
+        """
+        if self.verbose:
+            level = logging.INFO
+        elif logger.isEnabledFor(logging.DEBUG):
+            level = logging.DEBUG
+        else:
+            return None
+        return level if logs.sampled() else None
+
     def get_session(self):
         return self.session
 
-    def send(self, packet:Packet, content:dict=None, context_id:str=uuid.uuid4().hex):
-        r = {
-            "msg": str(packet),
-            "cid": context_id,
-            "content": content,
-        }
-        self.send_raw(json.dumps(r))
+    def get_protocol(self):
+        return self.codec.get_protocol()
+
+    def decode(self, message):
+        return self.codec.decode(message)
+
+    def send(self, packet:Packet, content:dict=None, context_id:str=None):
+        if context_id == None:
+            context_id = uuid.uuid4().hex
+        self.send_raw(self.codec.encode(packet, content, context_id))
 
     def send_raw(self, payload):
-        try:
-            logger.debug(f"Client #{self.get_id()} ({self.get_address()}:{self.get_port()}) sending packet {str(payload)}")
-            self.wsclient["handler"].send_message(payload)
-        except BrokenPipeError:
-            pass
+        """
+        Queue a payload for sending, safe to call from any thread and never blocks. Inference
+        workers send while holding the model lock, so a client whose queue is full because it
+        is not reading is disconnected rather than stalling every session of the model.
+        """
+        if self.closed:
+            return
+
+        level = self.trace()
+        if level != None:
+            logger.log(level, f"{self} sending packet {logs.describe_payload(payload)}")
+        # Text is sent UTF-8 encoded
+        SENT_BYTES.inc(len(payload) if isinstance(payload, bytes) or payload.isascii() else len(payload.encode("utf-8")))
+        SENT_MESSAGES.inc()
+
+        if self._on_loop():
+            self._put(payload)
+        else:
+            self.loop.call_soon_threadsafe(self._put, payload)
+
+    async def writer(self):
+        while True:
+            payload = await self.queue.get()
+            await self.websocket.send(payload)
+
+    def closed_by_peer(self):
+        self.closed = True
 
     def disconnect(self):
-        self.wsclient["handler"].send_close(status=1002)
+        if self.closed:
+            return
+        self.closed = True
+        if self._on_loop():
+            self.loop.create_task(self.websocket.close(code=1002))
+        else:
+            asyncio.run_coroutine_threadsafe(self.websocket.close(code=1002), self.loop)
 
     def get_id(self):
-        return self.wsclient["id"]
+        return self.id
 
     def get_address(self):
-        return self.wsclient["address"][0]
+        return self.address
 
     def get_port(self):
-        return self.wsclient["address"][1]
+        return self.port
+
+    def _put(self, payload):
+        # On the event loop
+        if self.closed:
+            return
+        try:
+            self.queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            logger.warning(f"{self} send queue is full, disconnecting")
+            self.disconnect()
+
+    def _on_loop(self):
+        return self.loop_thread == threading.get_ident()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import json
+import logging
+
+from utils import *
+from packet import Packet
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+# WebSocket subprotocols, clients that ask for none speak BASE64
+BASE64 = "g4ab.v1"
+JSON = "g4ab.v2.json"
+MSGPACK = "g4ab.v2.msgpack"
+
+def get_protocols():
+    """
+    Protocol versions this server speaks, MessagePack only if it is installed.
+    """
+    protocols = [BASE64, JSON]
+    if msgpack != None:
+        protocols.append(MSGPACK)
+    return protocols
+
+def select_protocol(connection, offered):
+    # The first one the client offered that is supported, None keeps the original protocol
+    supported = get_protocols()
+    for protocol in offered:
+        if protocol in supported:
+            return protocol
+    return None
+
+class Codec:
+    """
+    Turns packets into WebSocket messages of a protocol version and back. The original
+    version base64 encodes the text of chat, system and batch packets in JSON. Version 2
+    sends it as is, in JSON text frames or in MessagePack binary frames.
+
+    Packets only ever hold plain text inside the server, text is encoded here.
+    """
+
+    def __init__(self, protocol:str=None):
+        self.protocol = protocol if protocol != None else BASE64
+
+    def get_protocol(self):
+        return self.protocol
+
+    def encode(self, packet:Packet, content:dict, context_id:str):
+        if self.protocol == BASE64 and packet in (Packet.CHAT, Packet.SYSTEM) and content != None and isinstance(content.get("data"), str):
+            content = dict(content, data=b64e(content["data"]))
+        r = {
+            "msg": str(packet),
+            "cid": context_id,
+            "content": content,
+        }
+        if self.protocol == MSGPACK:
+            return msgpack.packb(r)
+        if self.protocol == JSON:
+            return json.dumps(r, ensure_ascii=False)
+        return json.dumps(r)
+
+    def decode(self, message):
+        """
+        Returns the packet of a received message, raises ValueError if it is malformed.
+        """
+        if self.protocol == MSGPACK:
+            if not isinstance(message, bytes):
+                raise ValueError("expected a binary message")
+            try:
+                return msgpack.unpackb(message)
+            except Exception as e:
+                raise ValueError(f"invalid MessagePack ({e})")
+
+        msg = json.loads(message)
+        if self.protocol == BASE64 and isinstance(msg, dict) and isinstance(msg.get("content"), dict):
+            self._decode_text(msg.get("msg"), msg["content"])
+        return msg
+
+    def _decode_text(self, packet:str, content:dict):
+        if packet == Packet.CHAT and content.get("type") == "text" and isinstance(content.get("data"), str):
+            content["data"] = b64d(content["data"])
+        elif packet == Packet.BATCH and isinstance(content.get("items"), list):
+            for item in content["items"]:
+                if isinstance(item, dict) and isinstance(item.get("data"), str):
+                    item["data"] = b64d(item["data"])
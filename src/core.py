@@ -0,0 +1,573 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import time
+import logging
+import threading
+
+import host
+import logs
+from utils import *
+from packet import Packet
+from client import Client
+from session import Session
+from gpt import warm_up
+from pool import ModelPool, get_loader
+from scheduler import Scheduler
+from cache import ResponseCache, SingleFlight
+from snapshot import SnapshotStore
+from tuning import Tuner
+from metrics import Counter
+from limits import REJECTED_REQUESTS
+from request import ChatRequest
+from batch import Batch
+from registry import SessionRegistry, RequestRegistry
+
+logger = logging.getLogger(__name__)
+SHUTDOWN_TIMEOUT = 3 # seconds for generations to stop at their next token
+DRAIN_RETRY_AFTER = 1000 # milliseconds, the next instance is expected to listen by then
+EVICTED_SESSIONS = Counter("g4ab_evicted_sessions_total", "Sessions evicted from memory to stay within the memory budget.")
+RESTORED_SESSIONS = Counter("g4ab_restored_sessions_total", "Evicted sessions restored from their snapshot.")
+
+def is_deadline(deadline):
+    # Milliseconds, None for the session's
+    return deadline == None or (isinstance(deadline, int) and not isinstance(deadline, bool) and deadline >= 0)
+
+class Core:
+    """
+    Owns the sessions, the model pool and the inference scheduler, and handles the
+    session and chat packets of clients. Runs in the server process, or in every
+    worker process in multi-process mode.
+    """
+
+    def __init__(self, max_idle_session_duration:int, model_threads:int, model_idle_timeout:int, inference_slots:int, max_queued_requests:int, model_backend:str=None, response_cache_size:int=0, response_cache_ttl:int=0, response_cache_path:str=None, memory_budget:int=0, session_snapshot_dir:str=None, preload_models:list=[], warmup_tokens:int=0, max_batch_size:int=1000, max_sessions:int=0, max_models:int=0, auto_tune:bool=False, cpu_share:int=1, model_instances:int=0):
+        self.max_idle_session_duration = max_idle_session_duration
+        self.max_queued_requests = max_queued_requests
+        self.max_batch_size = max_batch_size
+        # 0 = unlimited
+        self.max_sessions = max_sessions
+        # Temporary sessions of the batches running, counted against max_sessions
+        self.batch_sessions = 0
+        self.batch_lock = threading.Lock()
+        # Bytes, 0 = unlimited
+        self.memory_budget = memory_budget
+        self.snapshots = None
+        if session_snapshot_dir != None:
+            self.snapshots = SnapshotStore(session_snapshot_dir, max_idle_session_duration)
+        self.sessions = SessionRegistry()
+        self.requests = RequestRegistry()
+        # Probes the host, so it is created in the process that generates
+        self.tuner = Tuner(auto_tune, cpu_share)
+        if auto_tune:
+            model_threads = self.tuner.get_threads()
+        # A model instance generates for one session at a time, so by default there are as many as slots
+        self.pool = ModelPool(model_threads, model_idle_timeout, get_loader(model_backend), max_models, self.tuner, model_instances if model_instances > 0 else inference_slots)
+        self.scheduler = Scheduler(inference_slots)
+        self.flights = SingleFlight()
+        self.cache = None
+        if response_cache_size > 0:
+            self.cache = ResponseCache(response_cache_size, response_cache_ttl, response_cache_path)
+
+        # Set once the server drains, new work is left to the next instance
+        self.draining = False
+        # Ids of the sessions saved for the next instance while draining
+        self.saved = set()
+        self.saved_lock = threading.Lock()
+
+        # Leases of preloaded models are never released, so they are never unloaded
+        self.preloaded = []
+        self.ready = threading.Event()
+        thread = threading.Thread(target=self._preload, args=(preload_models, warmup_tokens), name="preload", daemon=True)
+        thread.start()
+
+    def on_session(self, client:Client, msg:dict, session_id:str=None):
+        if msg["content"]["request"] == "create":
+            # Create a new session (expensive...)
+            settings = msg["content"]["settings"]
+            if not isinstance(settings, dict):
+                raise Exception("invalid session settings, must be an object")
+            setting = Session.check_settings(settings)
+            if setting != None:
+                logger.warning(f"{client} could not create a session (invalid setting {setting})")
+                client.send(packet=Packet.SESSION, content={
+                    "success": False,
+                    "error": "invalid settings",
+                    "setting": setting
+                }, context_id=msg["cid"])
+                return
+            error = self._admit_sessions([(settings.get("model", Session.DEFAULT_MODEL), settings.get("model_type"))]) if not self.draining else "server is restarting"
+            if error != None:
+                REJECTED_REQUESTS.inc(1, error)
+                logger.warning(f"{client} could not create a session ({error})")
+                client.send(packet=Packet.SESSION, content={
+                    "success": False,
+                    "error": error,
+                    "retry_after": self._retry_after() if not self.draining else DRAIN_RETRY_AFTER
+                }, context_id=msg["cid"])
+                return
+            session = Session(self.max_idle_session_duration, self.pool, settings, session_id, self.cache, self.flights)
+            logger.info(f"{client} created a new session {session.get_id()}")
+            self.sessions.add(session)
+            client.set_session(session)
+            gpt = session.get_gpt()
+            client.send(packet=Packet.SESSION, content={
+                "session_id": session.get_id(),
+                "success": True,
+                "error": None,
+                "status": gpt.get_status()
+            }, context_id=msg["cid"])
+            # The model loads in the background, tell the client when it is done
+            gpt.when_initialized(lambda: self._send_initialized(client, session.get_id(), gpt, msg["cid"]))
+        elif msg["content"]["request"] == "resume":
+            session = self._find_session(msg["content"]["session_id"])
+            if session == None:
+                client.send(packet=Packet.SESSION, content={
+                    "success": False,
+                    "error": "expired"
+                }, context_id=msg["cid"])
+            else:
+                client.set_session(session)
+                client.send(packet=Packet.SESSION, content={
+                    "success": True,
+                    "error": None,
+                    "status": session.get_gpt().get_status()
+                }, context_id=msg["cid"])
+        elif msg["content"]["request"] == "status":
+            session = self._find_session(msg["content"]["session_id"])
+            if session == None:
+                client.send(packet=Packet.SESSION, content={
+                    "success": False,
+                    "error": "expired"
+                }, context_id=msg["cid"])
+            else:
+                gpt = session.get_gpt()
+                client.send(packet=Packet.SESSION, content={
+                    "success": True,
+                    "error": None,
+                    "status": gpt.get_status(),
+                    "settings": gpt.get_settings()
+                }, context_id=msg["cid"])
+        elif msg["content"]["request"] == "destroy":
+            # TODO: the user should have a list of sessions it created on initial connection
+            # check if the session_id requested for deletion is in that list, otherwise deny
+            session = client.get_session()
+            if session == None:
+                client.send(packet=Packet.SESSION, content={
+                    "success": False,
+                    "error": "session does not exist"
+                }, context_id=msg["cid"])
+            else:
+                client.set_session(None)
+                self.sessions.remove(session.get_id())
+                session.destroy()
+                client.send(packet=Packet.SESSION, content={
+                    "success": True,
+                    "error": None
+                }, context_id=msg["cid"])
+        else:
+            raise Exception("invalid session.content.status type")
+
+    def on_chat(self, client:Client, msg:dict):
+        # Prompts of a batch may be cancelled without a session
+        if msg["content"]["type"] == "cancel":
+            self._cancel_chat(client, msg["content"]["target"], msg["cid"])
+        elif client.get_session() == None:
+            raise Exception("chat without starting or resuming a session")
+        elif msg["content"]["type"] != "text":
+            client.send(packet=Packet.CHAT, content={
+                    "success": False,
+                    "error": "type must be 'text' or 'cancel'"
+                }, context_id=msg["cid"])
+        elif not isinstance(msg["content"].get("stream", False), bool):
+            client.send(packet=Packet.CHAT, content={
+                    "success": False,
+                    "error": "stream must be a boolean"
+                }, context_id=msg["cid"])
+        elif not is_deadline(msg["content"].get("deadline")):
+            client.send(packet=Packet.CHAT, content={
+                    "success": False,
+                    "error": "deadline must be a non-negative integer"
+                }, context_id=msg["cid"])
+        else:
+            self._process_chat(client, msg["content"]["data"], msg["cid"], msg["content"].get("deadline"), msg["content"].get("stream"))
+
+    def on_batch(self, client:Client, msg:dict):
+        items = msg["content"]["items"]
+        if not isinstance(items, list):
+            raise Exception("invalid data-type for batch items, must be list")
+        for item in items:
+            if not isinstance(item, dict) or not isinstance(item.get("cid"), str) or len(item["cid"]) != 32:
+                raise Exception("invalid batch item, cid must be a string of length 32")
+            if not isinstance(item.get("data"), str) or not isinstance(item.get("model", ""), str):
+                raise Exception("invalid batch item, data and model must be strings")
+
+        settings = msg["content"].get("settings", {})
+        deadline = msg["content"].get("deadline")
+
+        error = None
+        retry_after = None
+        if self.draining:
+            error = "server is restarting"
+            retry_after = DRAIN_RETRY_AFTER
+        elif not isinstance(settings, dict):
+            error = "invalid batch settings, must be an object"
+        elif Session.check_settings(settings) != None:
+            error = "invalid settings"
+        elif not is_deadline(deadline):
+            error = "deadline must be a non-negative integer"
+        elif len(items) == 0 or len(items) > self.max_batch_size:
+            error = f"a batch must have 1 to {self.max_batch_size} items"
+        elif len(set([item["cid"] for item in items])) != len(items):
+            error = "duplicate cid in batch items"
+        else:
+            # A session per model, like Batch creates them
+            models = set([item.get("model", settings.get("model")) for item in items])
+            error = self._admit_sessions([(model if model != None else Session.DEFAULT_MODEL, settings.get("model_type")) for model in models])
+            if error != None:
+                REJECTED_REQUESTS.inc(1, error)
+                retry_after = self._retry_after()
+        if error != None:
+            content = {
+                "success": False,
+                "error": error
+            }
+            if retry_after != None:
+                content["retry_after"] = retry_after
+            if error == "invalid settings":
+                content["setting"] = Session.check_settings(settings)
+            client.send(packet=Packet.BATCH, content=content, context_id=msg["cid"])
+            return
+
+        logger.info(f"{client} started batch {msg['cid']} of {len(items)} prompts")
+        self.add_batch_sessions(len(models))
+        batch = Batch(client, msg["cid"], items, settings, deadline, self)
+        batch.start()
+
+    def add_batch_sessions(self, count:int):
+        # Negative once the batch finished
+        with self.batch_lock:
+            self.batch_sessions += count
+
+    def on_disconnect(self, client:Client):
+        # Nobody is left to receive the responses, free the inference slots
+        for request in self.requests.get_client(client.get_id()):
+            request.cancel("disconnected")
+            self.flights.leave(request)
+
+    def heartbeat(self):
+        # Clean-up stale sessions
+        stale_sessions = self.sessions.prune()
+        for session in stale_sessions:
+            session.destroy()
+        logger.debug(f"Cleaned up {len(stale_sessions)} stale sessions, {self.sessions.count()} active sessions")
+
+        if self.snapshots != None:
+            expired_snapshots = self.snapshots.prune()
+            logger.debug(f"Removed {expired_snapshots} expired session snapshots")
+
+        self._enforce_memory_budget()
+
+        # Unload models no session has used for a while
+        unloaded_models = self.pool.prune()
+        stats = self.pool.get_stats()
+        logger.debug(f"Unloaded {unloaded_models} idle models, model pool has {stats['loaded']} loaded ({stats['hits']} hits, {stats['misses']} misses)")
+
+        if self.cache != None:
+            expired_responses = self.cache.prune()
+            stats = self.cache.get_stats()
+            logger.debug(f"Expired {expired_responses} cached responses, response cache has {stats['entries']} entries ({stats['hits']} hits, {stats['misses']} misses)")
+
+        stats = self.scheduler.get_stats()
+        logger.debug(f"Inference queue depth {stats['depth']}, {stats['active']}/{stats['slots']} slots busy, average wait {stats['average_wait']}ms (max {stats['max_wait']}ms)")
+
+    def is_ready(self):
+        return self.ready.is_set() and not self.draining
+
+    def drain(self):
+        """
+        Stops taking new sessions, chat messages and batches, the ones in flight go on. Clients
+        are told to resume their session on the next instance, so every session is saved as soon
+        as its requests are done, the idle ones before this returns.
+        """
+        self.draining = True
+        logger.info(f"Draining, {self.requests.count()} chat requests in flight")
+        if self.snapshots == None:
+            return
+        sessions = self.sessions.all()
+        for session in sessions:
+            session.when_idle(lambda session=session: self._save_session(session))
+        logger.info(f"Saved the idle sessions, {len(sessions) - len(self.saved)} more once their requests are done")
+
+    def is_draining(self):
+        return self.draining
+
+    def is_drained(self):
+        return self.requests.count() == 0
+
+    def stop(self):
+        # Whatever is still generating stops at its next token, so its history is complete
+        for request in self.requests.all():
+            request.cancel("shutdown")
+        self.scheduler.stop(SHUTDOWN_TIMEOUT)
+        self._save_sessions()
+        if self.cache != None and self.cache.path != None:
+            self.cache.save()
+
+    def get_stats(self):
+        return {
+            "ready": self.is_ready(),
+            "draining": self.draining,
+            "sessions": self.sessions.count(),
+            "requests": self.requests.count(),
+            "memory": host.get_memory_usage(),
+            "models": self.pool.get_stats(),
+            "queue": self.scheduler.get_stats(),
+            "cache": self.cache.get_stats() if self.cache != None else None,
+            "tuning": self.tuner.get_stats()
+        }
+
+    def get_metrics(self):
+        # Metrics of this process are collected by the server itself
+        return []
+
+    def _preload(self, models:list, warmup_tokens:int):
+        for model_name in models:
+            start = time.time()
+            try:
+                lease = self.pool.acquire(model_name, pinned=True)
+                self.preloaded.append(lease)
+                if warmup_tokens > 0:
+                    warm_up(lease, warmup_tokens)
+            except Exception as e:
+                # Stays not ready, something is wrong with the configuration
+                logger.error(f"Failed to preload model {model_name} ({e})")
+                return
+            logger.info(f"Preloaded model {model_name} in {time.time() - start:.2f} seconds")
+
+        self.ready.set()
+        if len(models) > 0:
+            logger.info(f"Ready, preloaded {len(models)} models")
+
+    def _find_session(self, session_id:str):
+        """
+        Returns the session, restored from its snapshot if it was evicted, or None if it expired.
+        """
+        session = self.sessions.get(session_id)
+        if session != None or self.snapshots == None:
+            return session
+
+        snapshot = self.snapshots.load(session_id)
+        if snapshot == None:
+            return None
+
+        # Another request may have restored it meanwhile
+        session = self.sessions.get(session_id)
+        if session != None:
+            return session
+
+        session = Session(self.max_idle_session_duration, self.pool, snapshot["settings"], session_id, self.cache, self.flights)
+        session.restore(snapshot)
+        self.sessions.add(session)
+        RESTORED_SESSIONS.inc()
+        logger.info(f"Restored session {session_id} from its snapshot")
+        return session
+
+    def _send_initialized(self, client:Client, session_id:str, gpt, context_id:str):
+        # Destroyed while its model loaded, the client already got the destroy response
+        if gpt.is_destroyed():
+            logger.debug(f"{client} session {session_id} was destroyed before its model loaded")
+            return
+        load_time = int(gpt.get_load_time() * 1000)
+        failed = gpt.get_status() == "error"
+        if failed:
+            logger.warning(f"{client} session {session_id} failed to load its model")
+        else:
+            logger.info(f"{client} session {session_id} is ready after {load_time}ms")
+        client.send(packet=Packet.SESSION, content={
+            "session_id": session_id,
+            "success": not failed,
+            "error": "failed to load model" if failed else None,
+            "type": "failed" if failed else "ready",
+            "status": gpt.get_status(),
+            "load_time": load_time
+        }, context_id=context_id)
+
+    def _admit_sessions(self, models:list):
+        """
+        Returns why sessions of these models (name and type, one session each) cannot be
+        created right now, or None.
+        """
+        # Evicting sessions does not unload their models, so never evict for nothing
+        for model, model_type in models:
+            if not self.pool.can_acquire(model, model_type):
+                return "too many models loaded"
+
+        if self.max_sessions <= 0:
+            return None
+        with self.batch_lock:
+            over = self.sessions.count() + self.batch_sessions + len(models) - self.max_sessions
+        if over <= 0:
+            return None
+        # Idle sessions make room if they can be restored later
+        idle = [session for session in self.sessions.least_recently_used() if session.is_idle()]
+        if self.snapshots == None or len(idle) < over:
+            return "too many sessions"
+        for session in idle[:over]:
+            self._evict(session)
+        return None
+
+    def _retry_after(self):
+        # Milliseconds until the next session expires, which frees its place and model
+        sessions = self.sessions.least_recently_used()
+        if len(sessions) == 0:
+            return 1000
+        return max(1000, int((sessions[0].get_expiry() - time.time()) * 1000))
+
+    def _enforce_memory_budget(self):
+        """
+        Evicts the least recently used idle sessions (to their snapshot if enabled) and
+        unloads the models nobody uses anymore, until the process is within the budget.
+        """
+        if self.memory_budget <= 0:
+            return
+        usage = host.get_memory_usage()
+        if usage == None or usage <= self.memory_budget:
+            return
+
+        evicted = 0
+        for session in self.sessions.least_recently_used():
+            if not session.is_idle():
+                continue
+            self._evict(session)
+            evicted += 1
+            # Models are only freed once their last session is gone
+            self.pool.prune(0)
+            usage = host.get_memory_usage()
+            if usage == None or usage <= self.memory_budget:
+                break
+
+        if evicted == 0:
+            logger.debug(f"Memory usage over budget, no idle sessions to evict")
+            return
+        if usage == None:
+            logger.warning(f"Memory usage over budget, evicted {evicted} sessions, memory usage is no longer available")
+            return
+        logger.warning(f"Memory usage over budget, evicted {evicted} sessions, now using {usage // 1024 // 1024} MiB of {self.memory_budget // 1024 // 1024} MiB")
+
+    def _save_sessions(self):
+        """
+        Saves every session to its snapshot, so the next instance restores them when they are resumed.
+        """
+        if self.snapshots == None:
+            if self.sessions.count() > 0:
+                logger.warning(f"Discarding {self.sessions.count()} sessions, set SESSION_SNAPSHOT_DIR to keep them across restarts")
+            return
+        saved = 0
+        for session in self.sessions.all():
+            # Not saved again if it was while draining, the next instance may have restored it already
+            if self._save_session(session):
+                saved += 1
+            session.destroy()
+        logger.info(f"Saved {saved} sessions to {self.snapshots.path}")
+
+    def _save_session(self, session:Session):
+        """
+        Saves a session for the next instance, unless it expired or was saved before.
+        """
+        with self.saved_lock:
+            if session.get_id() in self.saved:
+                return False
+            self.saved.add(session.get_id())
+        return not session.has_expired() and self.snapshots.save(session.get_id(), session.get_snapshot())
+
+    def _evict(self, session:Session):
+        self.sessions.remove(session.get_id())
+        if self.snapshots != None:
+            self.snapshots.save(session.get_id(), session.get_snapshot())
+        session.destroy()
+        EVICTED_SESSIONS.inc()
+
+    def _cancel_chat(self, client:Client, target:str, context_id:str):
+        request = self.requests.get(client.get_id(), target)
+        if request == None:
+            client.send(packet=Packet.CHAT, content={
+                "success": False,
+                "error": "no such request"
+            }, context_id=context_id)
+            return
+
+        logger.info(f"{client} cancelled chat {target}")
+        request.cancel()
+        self.flights.leave(request)
+        client.send(packet=Packet.CHAT, content={
+            "success": True,
+            "error": None
+        }, context_id=context_id)
+
+    def _process_chat(self, client:Client, message:str, context_id:str, deadline:int=None, stream:bool=None):
+        logger.info(f"{client} prompt: {logs.describe_text(message)}")
+        
+        # Left to the next instance, the session is resumed there
+        if self.draining:
+            REJECTED_REQUESTS.inc(1, "server is restarting")
+            client.send(packet=Packet.CHAT, content={
+                "success": False,
+                "error": "server is restarting",
+                "retry_after": DRAIN_RETRY_AFTER
+            }, context_id=context_id)
+            return
+
+        gpt = client.get_session().get_gpt()
+
+        # Evicted sessions are restored transparently
+        if gpt == None:
+            session = self._find_session(client.get_session().get_id())
+            if session != None:
+                client.set_session(session)
+                gpt = session.get_gpt()
+
+        # session expired, get a new one
+        if gpt == None:
+            client.send(packet=Packet.SESSION, content={
+                "success": False,
+                "error": "expired"
+            }, context_id=context_id)
+            return
+
+        session = client.get_session()
+
+        # Limit how many requests a single session may have waiting
+        if self.scheduler.pending(session.get_id()) + gpt.get_waiting() >= self.max_queued_requests:
+            client.send(packet=Packet.CHAT, content={
+                "success": False,
+                "error": "too many queued requests"
+            }, context_id=context_id)
+            return
+
+        def notify(position):
+            client.send(packet=Packet.CHAT, content={
+                "success": True,
+                "error": None,
+                "type": "queue",
+                "position": position
+            }, context_id=context_id)
+
+        if deadline == None:
+            deadline = gpt.get_settings()["deadline"]
+        if stream == None:
+            stream = gpt.get_settings()["stream"]
+        request = ChatRequest(client, context_id, message, int(deadline), self.requests, stream)
+        self.requests.add(request)
+
+        key = gpt.get_request_key(message)
+        gpt.enqueue()
+
+        # An identical request is already queued or running, share its response
+        if key != None and not self.flights.join(key, gpt, request):
+            return
+
+        def submit():
+            self.scheduler.submit(session.get_id(), gpt.get_model_instance(), lambda: gpt.prompt(request=request, flight=key), notify)
+
+        # Messages sent while the model loads are queued in order until it is ready
+        if not gpt.defer(submit):
+            gpt.when_initialized(submit)
@@ -1,126 +1,330 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import os
-import sys
-import platform
-import json
-import threading
+import ssl
+import time
+import signal
+import asyncio
 import logging
+import itertools
 
-from websocket_server import WebsocketServer
+import websockets
+import logs
+import metrics
 from utils import *
 from timer import Timer
 from packet import Packet
 from client import Client
-from session import Session
+from codec import select_protocol
+from core import Core
+from worker import WorkerPool
+from api import HttpApi
+from limits import Admission
+from template import load_templates
+from registry import ClientRegistry
+import host
+import tuning
 
 ADDRESS = "0.0.0.0"
 PORT = 8184
 HEARTBEAT_INTERVAL = 1000 * 5 # 5 seconds
 MAX_IDLE_SESSION_DURATION = 1000 * 60 * 3 # 30 minutes
 MODEL_THREADS = 4
+MODEL_IDLE_TIMEOUT = 1000 * 60 * 5 # 5 minutes
+INFERENCE_SLOTS = 0 # 0 = CPU cores / MODEL_THREADS
+MAX_QUEUED_REQUESTS = 4
+PUBLIC_IP_LOOKUP = 1
+PUBLIC_IP_TIMEOUT = 1000 * 3 # 3 seconds
+SEND_QUEUE_SIZE = 256
+WORKERS = 0 # 0 = run everything in this process
+WORKER_CPUS = ""
+MODEL_BACKEND = "gpt4all"
+MAX_MESSAGE_SIZE = 1024 * 1024 # 1 MiB
+METRICS_PORT = 0 # 0 = disabled
+RESPONSE_CACHE_SIZE = 0 # 0 = disabled
+RESPONSE_CACHE_TTL = 1000 * 60 * 60 # 1 hour
+MEMORY_BUDGET = 0 # MiB, 0 = unlimited
+PRELOAD_MODELS = ""
+WARMUP_TOKENS = 4
+MAX_BATCH_SIZE = 1000
+WEBSOCKET_COMPRESSION = 1
+LOG_LEVEL = "INFO"
+LOG_FORMAT = "text" # text or json
+LOG_SAMPLE_RATE = 1 # log 1 in N packets
+LOG_PROMPTS = 0
+DEBUG_CLIENTS = ""
+HTTP_PORT = 0 # 0 = disabled
+HTTP_TIMEOUT = 1000 * 60 * 5 # 5 minutes
+RATE_LIMIT_SESSIONS = 0 # per minute and address, 0 = unlimited
+RATE_LIMIT_CHATS = 0 # per minute and address, 0 = unlimited
+RATE_LIMIT_BURST = 10
+MAX_SESSIONS = 0 # 0 = unlimited
+MAX_LOADED_MODELS = 0 # per process, 0 = unlimited
+MODEL_INSTANCES = 0 # per model and process, 0 = one per inference slot
+DRAIN_TIMEOUT = 1000 * 30 # 30 seconds, 0 = stop immediately
+REUSE_PORT = 0
+AUTO_TUNE = 0
+DRAIN_INTERVAL = 0.1 # seconds between checks for requests in flight while draining
 
 logger = logging.getLogger(__name__)
+PACKET_SECONDS = metrics.Histogram("g4ab_packet_handling_seconds", "Time spent handling a received packet, excluding inference.", ("msg",))
+CLIENTS = metrics.Gauge("g4ab_clients", "Connected clients.")
+SESSIONS = metrics.Gauge("g4ab_sessions", "Active sessions.")
 
 class Server():
 
     def __init__(self, address:str, port:int):
-        self.clients = []
-        self.sessions = []
+        self.clients = ClientRegistry()
 
         self.motd = os.getenv("SYSTEM_MESSAGE", None)
-        self.heartbeat_interval = os.getenv("HEARTBEAT_INTERVAL", HEARTBEAT_INTERVAL)
-        self.max_idle_session_duration = os.getenv("MAX_IDLE_SESSION_DURATION", MAX_IDLE_SESSION_DURATION)
+        self.heartbeat_interval = int(os.getenv("HEARTBEAT_INTERVAL", HEARTBEAT_INTERVAL))
+        self.max_idle_session_duration = int(os.getenv("MAX_IDLE_SESSION_DURATION", MAX_IDLE_SESSION_DURATION))
         self.model_threads = int(os.getenv("MODEL_THREADS", MODEL_THREADS))
+        self.model_idle_timeout = int(os.getenv("MODEL_IDLE_TIMEOUT", MODEL_IDLE_TIMEOUT))
+        self.inference_slots = int(os.getenv("INFERENCE_SLOTS", INFERENCE_SLOTS))
+        self.max_queued_requests = int(os.getenv("MAX_QUEUED_REQUESTS", MAX_QUEUED_REQUESTS))
+        self.send_queue_size = int(os.getenv("SEND_QUEUE_SIZE", SEND_QUEUE_SIZE))
+        self.max_message_size = int(os.getenv("MAX_MESSAGE_SIZE", MAX_MESSAGE_SIZE))
+        self.websocket_compression = int(os.getenv("WEBSOCKET_COMPRESSION", WEBSOCKET_COMPRESSION)) == 1
         self.ssl_key = os.getenv("SSL_KEY", None)
         self.ssl_cert = os.getenv("SSL_CERT", None)
-
-        self.server = WebsocketServer(host=address, port=port, loglevel=logging.WARNING, key=self.ssl_key, cert=self.ssl_cert)
-        self.server.set_fn_new_client(self.on_connect)
-        self.server.set_fn_client_left(self.on_disconnect)
-        self.server.set_fn_message_received(self.on_message)
-
-        self.heartbeat = Timer(self._heartbeat, self.heartbeat_interval)
+        self.prompt_templates = os.getenv("PROMPT_TEMPLATES", None)
+        self.public_ip_lookup = int(os.getenv("PUBLIC_IP_LOOKUP", PUBLIC_IP_LOOKUP)) == 1
+        self.public_ip_timeout = int(os.getenv("PUBLIC_IP_TIMEOUT", PUBLIC_IP_TIMEOUT))
+        self.workers = int(os.getenv("WORKERS", WORKERS))
+        self.worker_cpus = os.getenv("WORKER_CPUS", WORKER_CPUS)
+        self.model_backend = os.getenv("MODEL_BACKEND", MODEL_BACKEND)
+        self.metrics_port = int(os.getenv("METRICS_PORT", METRICS_PORT))
+        self.response_cache_size = int(os.getenv("RESPONSE_CACHE_SIZE", RESPONSE_CACHE_SIZE))
+        self.response_cache_ttl = int(os.getenv("RESPONSE_CACHE_TTL", RESPONSE_CACHE_TTL))
+        self.response_cache_path = os.getenv("RESPONSE_CACHE_PATH", None)
+        self.memory_budget = int(os.getenv("MEMORY_BUDGET", MEMORY_BUDGET)) * 1024 * 1024
+        self.session_snapshot_dir = os.getenv("SESSION_SNAPSHOT_DIR", None)
+        self.preload_models = [m.strip() for m in os.getenv("PRELOAD_MODELS", PRELOAD_MODELS).split(",") if m.strip() != ""]
+        self.warmup_tokens = int(os.getenv("WARMUP_TOKENS", WARMUP_TOKENS))
+        self.max_batch_size = int(os.getenv("MAX_BATCH_SIZE", MAX_BATCH_SIZE))
+        self.http_port = int(os.getenv("HTTP_PORT", HTTP_PORT))
+        self.http_timeout = int(os.getenv("HTTP_TIMEOUT", HTTP_TIMEOUT))
+        self.rate_limit_sessions = int(os.getenv("RATE_LIMIT_SESSIONS", RATE_LIMIT_SESSIONS))
+        self.rate_limit_chats = int(os.getenv("RATE_LIMIT_CHATS", RATE_LIMIT_CHATS))
+        self.rate_limit_burst = int(os.getenv("RATE_LIMIT_BURST", RATE_LIMIT_BURST))
+        self.max_sessions = int(os.getenv("MAX_SESSIONS", MAX_SESSIONS))
+        self.max_loaded_models = int(os.getenv("MAX_LOADED_MODELS", MAX_LOADED_MODELS))
+        self.model_instances = int(os.getenv("MODEL_INSTANCES", MODEL_INSTANCES))
+        self.drain_timeout = int(os.getenv("DRAIN_TIMEOUT", DRAIN_TIMEOUT))
+        self.reuse_port = int(os.getenv("REUSE_PORT", REUSE_PORT)) == 1
+        self.auto_tune = int(os.getenv("AUTO_TUNE", AUTO_TUNE)) == 1
+
+        # Addresses are rate limited here, sessions and models by the core(s)
+        self.admission = Admission(self.rate_limit_sessions, self.rate_limit_chats, self.rate_limit_burst)
+
+        # Slots are per process, so the cores are split between the workers
+        if self.inference_slots <= 0 and self.auto_tune:
+            self.inference_slots = tuning.get_slots(tuning.probe(), self.workers)
+        elif self.inference_slots <= 0:
+            self.inference_slots = max(1, (os.cpu_count() or self.model_threads) // self.model_threads // max(1, self.workers))
+
+        if self.workers > 0:
+            self.core = WorkerPool(self.workers, {
+                "max_idle_session_duration": self.max_idle_session_duration,
+                "model_threads": self.model_threads,
+                "model_idle_timeout": self.model_idle_timeout,
+                "inference_slots": self.inference_slots,
+                "max_queued_requests": self.max_queued_requests,
+                "model_backend": self.model_backend,
+                "response_cache_size": self.response_cache_size,
+                "response_cache_ttl": self.response_cache_ttl,
+                "response_cache_path": self.response_cache_path,
+                # The budget is per process, so it is split between the workers
+                "memory_budget": self.memory_budget // self.workers,
+                "session_snapshot_dir": self.session_snapshot_dir,
+                "preload_models": self.preload_models,
+                "warmup_tokens": self.warmup_tokens,
+                "max_batch_size": self.max_batch_size,
+                # Sessions are split between the workers like the memory budget
+                "max_sessions": -(-self.max_sessions // self.workers),
+                "max_models": self.max_loaded_models,
+                "model_instances": self.model_instances,
+                "auto_tune": self.auto_tune,
+                # Workers pinned to CPUs have them to themselves
+                "cpu_share": self.workers if self.worker_cpus == "" else 1,
+                "prompt_templates": self.prompt_templates,
+                "public_ip_lookup": self.public_ip_lookup,
+                "public_ip_timeout": self.public_ip_timeout
+            }, self.worker_cpus, self.heartbeat_interval, self.clients)
+        else:
+            load_templates(self.prompt_templates)
+            host.resolve(self.public_ip_lookup, self.public_ip_timeout)
+            self.core = Core(self.max_idle_session_duration, self.model_threads, self.model_idle_timeout, self.inference_slots, self.max_queued_requests, self.model_backend, self.response_cache_size, self.response_cache_ttl, self.response_cache_path, self.memory_budget, self.session_snapshot_dir, self.preload_models, self.warmup_tokens, self.max_batch_size, self.max_sessions, self.max_loaded_models, self.auto_tune, 1, self.model_instances)
+
+        self.heartbeat = Timer(self._heartbeat, self.heartbeat_interval / 1000)
+        self.heartbeat.start()
+
+        CLIENTS.set_function(self.clients.count)
+        SESSIONS.set_function(lambda: self.core.get_stats()["sessions"])
+        if self.metrics_port > 0:
+            metrics.serve(address, self.metrics_port, self.get_metrics, self.core.is_ready, self.reuse_port)
+
+        # HTTP requests act as clients too, so they share the ids
+        self.client_ids = itertools.count()
+        self.http_server = None
+        if self.http_port > 0:
+            self.http_server = HttpApi(self.core, self.clients, self.client_ids, self.http_timeout, self.max_message_size, self.admission).serve(address, self.http_port, self.get_stats, self.reuse_port)
+
+        logging.getLogger("websockets").setLevel(logging.WARNING)
 
         try:
+            asyncio.run(self._serve(address, port))
+        except KeyboardInterrupt:
+            pass
+
+        logger.info(f"Shutting down!")
+        self.heartbeat.stop()
+        self.core.stop()
+
+    async def _serve(self, address:str, port:int):
+        self.loop = asyncio.get_running_loop()
+        stop = self.loop.create_future()
+        # A second signal while draining stops right away
+        self.drain_skipped = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self.loop.add_signal_handler(sig, lambda: self.drain_skipped.set() if stop.done() else stop.set_result(None))
+            except (NotImplementedError, RuntimeError, ValueError):
+                # Not on the main thread (or not supported by the platform)
+                pass
+
+        ssl_context = None
+        if self.ssl_key != None and self.ssl_cert != None:
+            ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            ssl_context.load_cert_chain(self.ssl_cert, self.ssl_key)
+
+        # permessage-deflate is used if the client offers it too
+        compression = "deflate" if self.websocket_compression else None
+        # With reuse_port the next instance can listen on the same port while this one drains
+        async with websockets.serve(self._handle, address, port, ssl=ssl_context, max_size=self.max_message_size, select_subprotocol=select_protocol, compression=compression, reuse_port=self.reuse_port) as server:
             if address=="0.0.0.0":
                 address = "*"
             logger.info(f"Server listening on {address}:{port} ...")
-            self.server.run_forever()
-        except KeyboardInterrupt:
-            pass
+            await stop
 
-        print("") # get rid of annoying '^C' print
-        logger.info(f"Sending shutdown broadcast to all clients ...")
-        for c in self.clients:
+            print("") # get rid of annoying '^C' print
+            if self.drain_timeout > 0:
+                await self._drain(server)
+                return
+
+            logger.info(f"Sending shutdown broadcast to all clients ...")
+            for c in self.clients.all():
+                c.send(packet=Packet.SYSTEM, content={
+                    "type": "text",
+                    "data": "The server is going offline immediately!"
+                })
+            # Give the writers a moment to flush the broadcast
+            await asyncio.sleep(0.1)
+
+    async def _drain(self, server):
+        """
+        Hands over to the next instance: stops accepting connections and new work, lets the
+        chat requests in flight finish until the drain timeout, then closes the connections.
+        Idle sessions are saved before clients are told to reconnect, the others once their
+        requests are done, so clients resume them on the next instance.
+        """
+        logger.info(f"Draining for up to {self.drain_timeout}ms, signal again to stop right away ...")
+        # New connections are left to the next instance listening on the same port
+        server.server.close()
+        if self.http_server != None:
+            await self.loop.run_in_executor(None, self.http_server.shutdown)
+            self.http_server.server_close()
+        self.core.drain()
+
+        deadline = time.time() + self.drain_timeout / 1000
+        # Workers save their idle sessions before they report back
+        while not self.core.is_draining() and time.time() < deadline and not self.drain_skipped.is_set():
+            await asyncio.sleep(DRAIN_INTERVAL)
+
+        for c in self.clients.all():
             c.send(packet=Packet.SYSTEM, content={
                 "type": "text",
-                "data": b64e("The server is going offline immediately!")
+                "data": "The server is restarting, reconnect to resume your session."
             })
-        
-        logger.info(f"Shutting down!")
-        self.heartbeat.stop()
-        self.server.shutdown_gracefully()
 
-    def on_connect(self, client, server):
-        client = Client(client)
-        logger.info(f"Client #{client.get_id()} ({client.get_address()}:{client.get_port()}) connected")
+        while not self.core.is_drained() and time.time() < deadline and not self.drain_skipped.is_set():
+            await asyncio.sleep(DRAIN_INTERVAL)
+
+        if self.core.is_drained():
+            logger.info(f"Drained, closing {self.clients.count()} connections")
+        else:
+            logger.warning(f"Stopping {self.core.get_stats()['requests']} chat requests still in flight, closing {self.clients.count()} connections")
+        # 1012 (service restart) tells clients to reconnect
+        server.close(code=1012, reason="service restart")
+
+    async def _handle(self, websocket):
+        client = Client(next(self.client_ids), websocket, self.loop, self.send_queue_size, protocol=websocket.subprotocol)
+        writer = asyncio.create_task(client.writer())
+        self.on_connect(client)
+        try:
+            async for message in websocket:
+                self.on_message(client, message)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            writer.cancel()
+            client.closed_by_peer()
+            self.on_disconnect(client)
+
+    def on_connect(self, client:Client):
+        logger.info(f"{client} connected with protocol {client.get_protocol()}")
 
         if self.motd != None:
             msgs = self.motd.split("|")
             for msg in msgs:
                 client.send(packet=Packet.SYSTEM, content={
                     "type": "text",
-                    "data": b64e(msg)
+                    "data": msg
                 })
 
         # broadcast to all other clients that this client connected
         #for c in self.clients:
         #    c.send("session_add", {"id": client.get_id(), "address": client.get_address(), "port": client.get_port()})
         
-        self.clients.append(client)
-
+        self.clients.add(client)
 
-    def on_disconnect(self, client, server):
 
-        # Get client from local clients list by its handler id
-        for c in self.clients:
-            if c.get_id() == client["id"]:
-                client = c
-                break
+    def on_disconnect(self, client:Client):
 
         # Instance is already deleted
-        if isinstance(client, dict):
+        client = self.clients.remove(client.get_id())
+        if client == None:
             return
 
-        logger.info(f"Client #{client.get_id()} ({client.get_address()}:{client.get_port()}) disconnected")
+        logger.info(f"{client} disconnected")
+        self.core.on_disconnect(client)
 
-        self.clients.remove(client)
-        del client
 
-
-    def on_message(self, client, server, message):
-        
-        # Get client from local clients list by its handler id
-        for c in self.clients:
-            if c.get_id() == client["id"]:
-                client = c
-                break
+    def on_message(self, client:Client, message):
 
         # Instance is already deleted
-        if isinstance(client, dict):
+        if self.clients.get(client.get_id()) == None:
             return
 
         # Invalid message, disconnect client
         if message == None:
-            logger.warning(f"Client #{client.get_id()} ({client.get_address()}:{client.get_port()}) attempted to send NULL data!")
+            logger.warning(f"{client} attempted to send NULL data!")
             client.disconnect()
             return
         
-        # Invalid non-JSON message, disconnect client
+        # Malformed message, disconnect client
+        try:
+            msg = client.decode(message)
+        except ValueError:
+            logger.warning(f"{client} attempted to send malformed data")
+            client.disconnect()
+            return
+
         try:
-            msg = json.loads(message)
-            logger.debug(f"Client #{client.get_id()} ({client.get_address()}:{client.get_port()}) received packet {message}")
+            level = client.trace()
+            if level != None:
+                logger.log(level, f"{client} received packet {logs.describe_payload(message)}")
 
 
             # Ensure cid (context_id) is set
@@ -135,153 +339,55 @@ class Server():
                 
 
 
+            # Rejected before anything is allocated for it
+            retry_after = self.admission.check(client, msg)
+            if retry_after > 0:
+                self.admission.reject(client, msg, retry_after)
+                return
+
+            start = time.perf_counter()
             if (msg["msg"] == Packet.PING):
                 client.send(packet=Packet.PING, content=None, context_id=msg["cid"])
             elif (msg["msg"] == Packet.SESSION):
-                if msg["content"]["request"] == "create":
-                    # Create a new session (expensive...)
-                    settings = msg["content"]["settings"]
-                    session = Session(self.max_idle_session_duration, self.model_threads, settings)
-                    logger.info(f"Client #{client.get_id()} ({client.get_address()}:{client.get_port()}) created a new session {session.get_id()}")
-                    self.sessions.append(session)
-                    client.set_session(session)
-                    client.send(packet=Packet.SESSION, content={
-                        "session_id": session.get_id(),
-                        "success": True,
-                        "error": None
-                    }, context_id=msg["cid"])
-                elif msg["content"]["request"] == "resume":
-                    session = self._get_session(msg["content"]["session_id"])
-                    if session == None:
-                        client.send(packet=Packet.SESSION, content={
-                            "success": False,
-                            "error": "expired"
-                        }, context_id=msg["cid"])
-                    else:
-                        client.set_session(session)
-                        client.send(packet=Packet.SESSION, content={
-                            "success": True,
-                            "error": None
-                        }, context_id=msg["cid"])
-                elif msg["content"]["request"] == "status":
-                    session = None
-                    for sess in self.sessions:
-                        if sess.get_id() == msg["content"]["session_id"]:
-                            if sess.has_expired():
-                                sess.destroy()
-                                client.send(packet=Packet.SESSION, content={
-                                    "success": False,
-                                    "error": "expired"
-                                }, context_id=msg["cid"])
-                                return
-                            session = sess
-                            break
-                    if session == None:
-                        client.set_session(None)
-                        session.destroy()
-                        client.send(packet=Packet.SESSION, content={
-                            "success": False,
-                            "error": "unknown session id"
-                        }, context_id=msg["cid"])
-                    else:
-                        gpt = session.get_gpt()
-                        client.send(packet=Packet.SESSION, content={
-                            "success": True,
-                            "error": None,
-                            "status": gpt.get_status(),
-                            "settings": gpt.get_settings()
-                        }, context_id=msg["cid"])
-                elif msg["content"]["request"] == "destroy":
-                    # TODO: the user should have a list of sessions it created on initial connection
-                    # check if the session_id requested for deletion is in that list, otherwise deny
-                    session = client.get_session()
-                    if session == None:
-                        client.send(packet=Packet.SESSION, content={
-                            "success": False,
-                            "error": "session does not exist"
-                        }, context_id=msg["cid"])
-                    else:
-                        client.set_session(None)
-                        session.destroy()
-                        client.send(packet=Packet.SESSION, content={
-                            "success": True,
-                            "error": None
-                        }, context_id=msg["cid"])
-                else:
-                    raise Exception("invalid session.content.status type")
+                self.core.on_session(client, msg)
             elif (msg["msg"] == Packet.CHAT):
-                if client.get_session() == None:
-                    raise Exception("chat without starting or resuming a session")
-                if msg["content"]["type"] != "text":
-                    client.send(packet=Packet.CHAT, content={
-                            "success": False,
-                            "error": "type must be 'text'"
-                        }, context_id=msg["cid"])
-                else:
-                    self._process_chat(client, msg["content"]["data"], msg["cid"])
+                self.core.on_chat(client, msg)
+            elif (msg["msg"] == Packet.BATCH):
+                self.core.on_batch(client, msg)
+            elif (msg["msg"] == Packet.STATS):
+                client.send(packet=Packet.STATS, content=self.get_stats(), context_id=msg["cid"])
             else:
                 raise Exception("send invalid msg type")
+            PACKET_SECONDS.observe(time.perf_counter() - start, str(msg["msg"]))
 
-        except json.decoder.JSONDecodeError:
-            logger.warning(f"Client #{client.get_id()} ({client.get_address()}:{client.get_port()}) attempted to send bad JSON data")
-            client.disconnect()
-            return
         except Exception as e:
             err = e
             if hasattr(e, 'message'):
                 err = e.message
-            logger.warning(f"Client #{client.get_id()} ({client.get_address()}:{client.get_port()}) attempted an invalid action ({err})")
+            logger.warning(f"{client} attempted an invalid action ({err})")
             client.disconnect()
             return
 
     def _heartbeat(self):
-        # Clean-up stale sessions
-        stale_sessions = 0
-        for session in self.sessions:
-            if session.has_expired():
-                self.sessions.remove(session)
-                stale_sessions += 1
-        logger.debug(f"Cleaned up {stale_sessions} stale sessions")
-
-    def _get_session(self, session_id:str):
-        for session in self.sessions:
-            if session.get_id() == session_id and not session.has_expired():
-                return session
-        return None
-
-    def _process_chat(self, client:Client, message:str, context_id:str):
-        message = b64d(message)
-
-        logger.info(f"Client #{client.get_id()} ({client.get_address()}:{client.get_port()}) prompt: {message}")
-        
-        gpt = client.get_session().get_gpt()
-
-        # session expired, get a new one
-        if gpt == None:
-            client.send(packet=Packet.SESSION, content={
-                "success": False,
-                "error": "expired"
-            }, context_id=context_id)
-            return
+        self.core.heartbeat()
+        limited = self.admission.prune()
+        logger.debug(f"{self.clients.count()} connected clients, {limited} rate limited addresses")
 
-        # Check if an existing job is already running
-        if gpt.get_status() == "processing":
-            client.send(packet=Packet.CHAT, content={
-                "success": False,
-                "error": "still processing prior request"
-            }, context_id=context_id)
-            return
+    def get_stats(self):
+        stats = self.core.get_stats()
+        stats["clients"] = self.clients.count()
+        return stats
 
-        gpt.prompt(client=client, context_id=context_id, input=message)
+    def get_metrics(self):
+        # Worker processes report their own metrics, labelled with their index
+        return metrics.REGISTRY.collect() + self.core.get_metrics()
 
 
 if __name__ == '__main__':
-    formatter = logging.Formatter(fmt='%(asctime)s [%(levelname)s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-    handler = logging.StreamHandler()
-    handler.setFormatter(formatter)
-    root_logger = logging.getLogger("root")
-    root_logger.setLevel(logging.INFO)
-    #root_logger.setLevel(logging.DEBUG)
-    root_logger.handlers.clear()
-    root_logger.addHandler(handler)
-    Server(ADDRESS, PORT)
+    log_format = os.getenv("LOG_FORMAT", LOG_FORMAT)
+    listener = logs.setup(os.getenv("LOG_LEVEL", LOG_LEVEL).upper(), log_format)
+    logs.configure(os.getenv("DEBUG_CLIENTS", DEBUG_CLIENTS), int(os.getenv("LOG_SAMPLE_RATE", LOG_SAMPLE_RATE)), int(os.getenv("LOG_PROMPTS", LOG_PROMPTS)) == 1)
+    try:
+        Server(os.getenv("ADDRESS", ADDRESS), int(os.getenv("PORT", PORT)))
+    finally:
+        listener.stop()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Answers a file of prompts with a gpt4all-box server, for offline and bulk workloads.
+
+Reads one prompt per line from a JSONL file, either a JSON string or an object with a
+"prompt" and optionally an "id" and a "model". The prompts are sent in batch packets (see
+protocol.md) and every answer is written as one JSON line as soon as it arrives, so the
+output is in completion order. The throughput is printed when all prompts are answered.
+Batches the server rejects for now, with a retry_after, are sent again once it has passed.
+
+    python src/g4ab_batch.py --url ws://127.0.0.1:8184 --input prompts.jsonl --output answers.jsonl
+
+With --resume, prompts already answered successfully in the output file are skipped and
+the new answers are appended, so an interrupted run can be continued.
+"""
+import sys
+import json
+import time
+import uuid
+import base64
+import asyncio
+import argparse
+
+MAX_BATCH_SIZE = 1000 # prompts per batch packet, see MAX_BATCH_SIZE of the server
+MAX_BATCH_BYTES = 1024 * 512 # batch packets must stay below MAX_MESSAGE_SIZE of the server
+# Sends text as is, servers that do not speak it fall back to base64, see protocol.md
+PROTOCOL = "g4ab.v2.json"
+
+def read_prompts(path:str):
+    prompts = []
+    f = sys.stdin if path == "-" else open(path, "r")
+    try:
+        for number, line in enumerate(f, start=1):
+            if line.strip() == "":
+                continue
+            record = json.loads(line)
+            if isinstance(record, str):
+                record = {"prompt": record}
+            if not isinstance(record, dict) or not isinstance(record.get("prompt"), str):
+                raise ValueError(f"line {number} is neither a string nor an object with a prompt")
+            record.setdefault("id", number)
+            prompts.append(record)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+    return prompts
+
+def read_answered(path:str):
+    answered = set()
+    try:
+        with open(path, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Cut off by the interruption
+                    continue
+                if record.get("success"):
+                    answered.add(record["id"])
+    except FileNotFoundError:
+        pass
+    return answered
+
+def encode_text(text:str, raw:bool):
+    return text if raw else base64.b64encode(text.encode("utf-8")).decode("utf-8")
+
+def decode_text(data:str, raw:bool):
+    return data if raw else base64.b64decode(data).decode("utf-8")
+
+def split(prompts:list, max_items:int, max_bytes:int, raw:bool):
+    """
+    Groups the prompts into batches of at most max_items and roughly max_bytes encoded.
+    """
+    batches = []
+    batch = []
+    size = 0
+    for record in prompts:
+        item = {
+            "cid": uuid.uuid4().hex,
+            "data": encode_text(record["prompt"], raw)
+        }
+        if "model" in record:
+            item["model"] = record["model"]
+        item_size = len(json.dumps(item, ensure_ascii=False).encode("utf-8"))
+        if len(batch) > 0 and (len(batch) >= max_items or size + item_size > max_bytes):
+            batches.append(batch)
+            batch = []
+            size = 0
+        batch.append((item, record))
+        size += item_size
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+class Summary:
+
+    def __init__(self):
+        self.prompts = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def add(self, content:dict):
+        self.prompts += content["items"]
+        self.succeeded += content["succeeded"]
+        self.failed += content["failed"]
+        self.prompt_tokens += content["prompt_tokens"]
+        self.completion_tokens += content["completion_tokens"]
+
+    def to_dict(self, duration:float):
+        return {
+            "prompts": self.prompts,
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "duration": round(duration, 3),
+            "tokens_per_second": round(self.completion_tokens / duration, 1) if duration > 0 else 0,
+            "prompts_per_second": round(self.prompts / duration, 2) if duration > 0 else 0
+        }
+
+async def _run(args, prompts:list, output):
+    import websockets
+    settings = json.loads(args.settings) if args.settings != None else {}
+    # Answers are written whole, chunks would only add packets
+    settings["stream"] = False
+    if args.model != None:
+        settings["model"] = args.model
+
+    summary = Summary()
+    # Prompts of the batches in flight by their cid
+    records = {}
+    pending = {}
+
+    async with websockets.connect(args.url, max_size=None, open_timeout=60, subprotocols=[PROTOCOL]) as websocket:
+        raw = websocket.subprotocol == PROTOCOL
+        queued = split(prompts, args.batch_size, args.batch_bytes, raw)
+
+        # Batches waiting to be resent, referenced so they are not garbage collected
+        retries = set()
+
+        def send_batch(batch:list=None, delay:float=0):
+            # Returns the coroutine sending the batch, which is pending right away, also while
+            # it waits to be resent, so the loop below goes on until it is answered
+            if batch == None:
+                batch = queued.pop(0)
+            cid = uuid.uuid4().hex
+            content = {"settings": settings, "items": [item for item, record in batch]}
+            if args.deadline != None:
+                content["deadline"] = args.deadline
+            for item, record in batch:
+                records[item["cid"]] = record
+            pending[cid] = batch
+            payload = json.dumps({"msg": "batch", "cid": cid, "content": content}, ensure_ascii=False)
+
+            async def send():
+                await asyncio.sleep(delay)
+                await websocket.send(payload)
+            return send()
+
+        while len(queued) > 0 and len(pending) < args.parallel:
+            await send_batch()
+
+        while len(pending) > 0:
+            response = json.loads(await websocket.recv())
+            content = response["content"]
+
+            if response["msg"] == "chat" and response["cid"] in records:
+                record = records.pop(response["cid"])
+                answer = {
+                    "id": record["id"],
+                    "prompt": record["prompt"],
+                    "response": decode_text(content["data"], raw) if content.get("data") != None else None,
+                    "success": content["success"],
+                    "error": content["error"]
+                }
+                if "model" in record:
+                    answer["model"] = record["model"]
+                if "usage" in content:
+                    answer["usage"] = content["usage"]
+                output.write(json.dumps(answer) + "\n")
+                output.flush()
+            elif response["msg"] == "batch" and response["cid"] in pending:
+                batch = pending.pop(response["cid"])
+                if not content["success"] and content.get("retry_after") != None:
+                    # Rejected for now (rate limited, too many sessions or models), the same prompts are sent again
+                    print(f"Batch of {len(batch)} prompts was rejected ({content['error']}), retrying in {content['retry_after']}ms", file=sys.stderr)
+                    task = asyncio.create_task(send_batch(batch, content["retry_after"] / 1000))
+                    retries.add(task)
+                    task.add_done_callback(retries.discard)
+                    continue
+                if not content["success"]:
+                    raise Exception(f"batch of {len(batch)} prompts was rejected ({content['error']})")
+                summary.add(content)
+                print(f"Batch of {content['items']} prompts done, {content['tokens_per_second']} tokens/s", file=sys.stderr)
+                if len(queued) > 0:
+                    await send_batch()
+
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description="Answers a JSONL file of prompts with a gpt4all-box server")
+    parser.add_argument("--url", default="ws://127.0.0.1:8184")
+    parser.add_argument("--input", default="-", help="JSONL file of prompts, - for stdin")
+    parser.add_argument("--output", default="-", help="JSONL file to write the answers to, - for stdout")
+    parser.add_argument("--resume", action="store_true", help="skip the prompts already answered in the output file and append to it")
+    parser.add_argument("--model", help="model of the prompts that do not name one")
+    parser.add_argument("--settings", help="session settings as JSON, for example '{\"temperature\": 0, \"n_predict\": 256}'")
+    parser.add_argument("--deadline", type=int, help="milliseconds to answer each prompt in")
+    parser.add_argument("--batch-size", type=int, default=MAX_BATCH_SIZE, help="prompts per batch packet")
+    parser.add_argument("--batch-bytes", type=int, default=MAX_BATCH_BYTES, help="approximate size limit of a batch packet")
+    parser.add_argument("--parallel", type=int, default=2, help="batches in flight at once")
+    args = parser.parse_args()
+
+    prompts = read_prompts(args.input)
+    mode = "w"
+    if args.resume:
+        if args.output == "-":
+            parser.error("--resume needs an --output file")
+        answered = read_answered(args.output)
+        prompts = [record for record in prompts if record["id"] not in answered]
+        mode = "a"
+        print(f"Skipping {len(answered)} answered prompts", file=sys.stderr)
+
+    output = sys.stdout if args.output == "-" else open(args.output, mode)
+    start = time.perf_counter()
+    try:
+        summary = asyncio.run(_run(args, prompts, output))
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    print(json.dumps(summary.to_dict(time.perf_counter() - start), indent=4), file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
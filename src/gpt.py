@@ -1,28 +1,103 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import sys
-import platform
+import re
 import time
 import logging
 import threading
+import host
 from utils import *
 from packet import Packet
-from client import Client
-from gpt4all import GPT4All
+from request import ChatRequest
+from pool import ModelPool, ModelLease
+from template import get_template
+from history import History
+from cache import ResponseCache, SingleFlight, make_key
+from metrics import Counter, Histogram, RATE_BUCKETS
 
 logger = logging.getLogger(__name__)
 DEFAULT_NAME = "Alice"
-CMD_PREFIX = "#!#CMD_START#!#"
-CMD_SUFFIX = "#!#CMD_END#!#"
+# Rough approximation of a BPE tokenizer, for backends that don't expose theirs
+TOKEN_ESTIMATE = re.compile(r"\w{1,4}|\s+|[^\w\s]")
+
+TIME_TO_FIRST_TOKEN = Histogram("g4ab_time_to_first_token_seconds", "Time from starting a generation to its first token, mostly prompt evaluation.", ("model",))
+PROMPT_TOKENS_PER_SECOND = Histogram("g4ab_prompt_tokens_per_second", "Prompt evaluation speed per generation.", ("model",), RATE_BUCKETS)
+GENERATION_TOKENS_PER_SECOND = Histogram("g4ab_generation_tokens_per_second", "Token generation speed per generation.", ("model",), RATE_BUCKETS)
+PROMPT_TOKENS = Counter("g4ab_prompt_tokens_total", "Prompt tokens evaluated.", ("model",))
+GENERATED_TOKENS = Counter("g4ab_generated_tokens_total", "Tokens generated.", ("model",))
 
 def new_print(*args, **kwargs):
     return logger.debug(*args, **kwargs)
 
+def count_tokens(model, text:str):
+    tokenize = getattr(model, "tokenize", None)
+    if tokenize != None:
+        return len(tokenize(text))
+    return len(TOKEN_ESTIMATE.findall(text))
+
+def get_context_tokens(model):
+    # Tokens in the model context after its last generation, None if the backend doesn't tell
+    get_n_past = getattr(model, "get_n_past", None)
+    if get_n_past != None:
+        return get_n_past()
+    return None
+
+def can_continue(model):
+    """
+    Whether the position in the model context is known exactly after a generation, which
+    continuing a context (the new turn only, or after the shared prefix) depends on.
+    Estimated token counts would make the backend skip or overwrite tokens.
+    """
+    return hasattr(model, "get_n_past") or hasattr(model, "tokenize")
+
+def evaluate_prefix(model, prefix:str, **kwargs):
+    """
+    Evaluates the static prompt prefix alone into the model context, returns its token count.
+    """
+    for token in model.generate(prompt=prefix, streaming=True, n_past=0, n_predict=0, **kwargs):
+        pass
+    prefix_tokens = get_context_tokens(model)
+    return prefix_tokens if prefix_tokens != None else count_tokens(model, prefix)
+
+def warm_up(lease:ModelLease, n_predict:int):
+    """
+    Generates a few tokens after the static prompt prefix of a model so the weights are paged
+    in, then leaves the prefix alone in its context so new sessions start from it.
+    """
+    model_name = lease.get_key()[0]
+    prefix, prefix_hash = get_template(model_name).get_prefix(DEFAULT_NAME, model_name)
+    model = lease.get_model()
+    with lease.get_lock():
+        for token in model.generate(prompt=prefix, streaming=True, n_past=0, n_predict=n_predict):
+            pass
+        if can_continue(model):
+            lease.set_context_prefix(prefix_hash, evaluate_prefix(model, prefix))
+
 class Gpt:
 
-    def __init__(self, thread_count:int, agent_settings:dict):
-        self.threads = thread_count
+    def __init__(self, pool:ModelPool, agent_settings:dict, cache:ResponseCache=None, flights:SingleFlight=None):
+        self.pool = pool
         self.settings = agent_settings
+        # Only set for sessions that generate deterministically, see Session
+        self.cache = cache
+        self.flights = flights
+        self.template = get_template(self.settings["model"])
+        self.lease = None
+        self.gpt4all = None
+        self.status = "initializing"
+        self.initialized = threading.Event()
+        # Called in order once the model is loaded (or failed to), see when_initialized
+        self.on_initialized = []
+        # Called once nothing is pending anymore, see when_idle
+        self.on_idle = []
+        self.created = time.time()
+        self.load_time = None
+        self.pending = 0
+        # Set once the session is gone, a model that is still loading is released right away
+        self.destroyed = False
+        self.lock = threading.Lock()
+        # Waiting for the response of an identical request, see SingleFlight
+        self.subscribed = False
+        self.deferred = []
 
         if self.settings["name"] == None:
             self.settings["name"] = DEFAULT_NAME
@@ -30,193 +105,464 @@ class Gpt:
         thread = threading.Thread(target=self._init, daemon=True)
         thread.start()
 
-        self.local_ip = self._get_local_ip()
-        self.public_ip = self._get_public_ip()
-        self.history = []
+        self.history = History(self.template.render_message, self._count_tokens)
+        # Number of tokens of this conversation already evaluated into the model context
+        self.n_past = 0
+        # Token count of the static prompt prefix, by its hash
+        self.prefix_tokens = (None, 0)
     
     def get_settings(self):
         return self.settings
 
+    def get_history(self):
+        return self.history.to_list()
+
+    def set_history(self, history:list):
+        # The model context does not hold it, it is evaluated with the next prompt
+        self.history = History(self.template.render_message, self._count_tokens)
+        self.history.extend(history)
+        self.n_past = 0
+
+    def is_idle(self):
+        with self.lock:
+            return self.pending == 0 and self.status != "initializing"
+
     def get_status(self):
         return self.status
 
-    def prompt(self, client:Client, context_id:str, input:str):
-        thread = threading.Thread(target=self._prompt, args=(client, context_id, input), daemon=True)
-        thread.start()
+    def wait_initialized(self, timeout:float=None):
+        # Returns False if the model is still loading after timeout seconds
+        return self.initialized.wait(timeout)
+
+    def when_initialized(self, callback):
+        """
+        Calls callback once the model is loaded or failed to load, right away if it
+        already is. Callbacks are called in the order they were added.
+        """
+        with self.lock:
+            if not self.initialized.is_set():
+                self.on_initialized.append(callback)
+                return
+        callback()
+
+    def when_idle(self, callback):
+        """
+        Calls callback once the requests sent so far are done, right away if there are none.
+        """
+        with self.lock:
+            if self.pending > 0:
+                self.on_idle.append(callback)
+                return
+        callback()
+
+    def is_destroyed(self):
+        return self.destroyed
+
+    def get_load_time(self):
+        # Seconds from creating the session until its model was ready, None while loading
+        return self.load_time
+
+    def get_model_instance(self):
+        if self.lease == None:
+            return None
+        return self.lease.get_instance()
+
+    def get_request_key(self, input:str):
+        """
+        Returns the key identical requests share, or None if this session's requests
+        cannot be shared. The key depends on the history, so it is only known while
+        nothing is queued.
+        """
+        if self.flights == None:
+            return None
+        with self.lock:
+            if self.pending > 0:
+                return None
+        return self._cache_key(input)
+
+    def get_waiting(self):
+        # Requests not in the scheduler's queue
+        with self.lock:
+            return len(self.deferred) + len(self.on_initialized) + (1 if self.subscribed else 0)
+
+    def enqueue(self):
+        with self.lock:
+            self.pending += 1
+            if self.status == "idle":
+                self.status = "queued"
+
+    def subscribe(self):
+        with self.lock:
+            self.subscribed = True
+
+    def defer(self, submit):
+        """
+        Holds back submitting a request until the shared response this session is
+        waiting for has been added to the history. Returns False if not waiting.
+        """
+        with self.lock:
+            if not self.subscribed:
+                return False
+            self.deferred.append(submit)
+            return True
+
+    def prompt(self, request:ChatRequest, flight:str=None):
+        # Runs on an inference scheduler worker, see Gpt.enqueue
+        try:
+            self._prompt(request, flight)
+        except Exception as e:
+            logger.error(f"Generation failed for {request.get_client()} ({e})")
+            # Whatever the model context holds now, rebuild it on the next prompt
+            self.n_past = 0
+            request.get_client().send(packet=Packet.CHAT, content={
+                "success": False,
+                "error": "generation failed"
+            }, context_id=request.get_context_id())
+        finally:
+            if flight != None:
+                # Fails the subscribers if the response was not passed on
+                self.flights.finish(flight)
+            self._done(request)
+
+    def receive(self, request:ChatRequest, tokens:list, start:float, first_token:float, end:float):
+        # Response of an identical request of another session, see SingleFlight
+        self._add_history(int(start), request.get_input(), "".join(tokens))
+        # The model context does not hold this turn, rebuild it on the next prompt
+        self.n_past = 0
+        self.send_response(request, tokens, start, first_token, end)
+        self._done(request, True)
+
+    def fail(self, request:ChatRequest, error:str):
+        request.get_client().send(packet=Packet.CHAT, content={
+            "success": False,
+            "error": error
+        }, context_id=request.get_context_id())
+        self._done(request, True)
+
+    def destroy(self):
+        with self.lock:
+            self.destroyed = True
+            lease = self.lease
+            self.lease = None
+            self.gpt4all = None
+        if lease != None:
+            lease.release()
 
     def _init(self):
-        self.status = "initializing"
         model_type = None
         if "model_type" in self.settings:
             model_type = self.settings["model_type"]
-        
-        self.gpt4all = GPT4All(model_name=self.settings["model"], model_path=None, model_type=model_type)
-        self.gpt4all.model.set_thread_count(self.threads)
-        self.status = "idle"
-
-    def _prompt(self, client:Client, context_id:str, input:str):
 
-        if self.gpt4all == None:
+        lease = None
+        try:
+            lease = self.pool.acquire(self.settings["model"], model_type)
+        except Exception as e:
+            logger.error(f"Failed to load model {self.settings['model']} ({e})")
+
+        with self.lock:
+            if self.destroyed:
+                # Nobody would release the lease of a session destroyed while loading
+                discarded = lease
+            else:
+                discarded = None
+                if lease != None:
+                    self.lease = lease
+                    self.gpt4all = lease.get_model()
+            if self.gpt4all == None:
+                self.status = "error"
+            else:
+                self.status = "queued" if self.pending > 0 else "idle"
+            self.load_time = time.time() - self.created
+            self.initialized.set()
+            callbacks = self.on_initialized
+            self.on_initialized = []
+        if discarded != None:
+            discarded.release()
+        for callback in callbacks:
+            callback()
+
+    def _done(self, request:ChatRequest, shared:bool=False):
+        request.done()
+        with self.lock:
+            self.pending -= 1
+            if self.status in ("queued", "processing"):
+                self.status = "queued" if self.pending > 0 else "idle"
+            deferred = []
+            if shared:
+                # The shared response arrived, submit what was held back
+                self.subscribed = False
+                deferred = self.deferred
+                self.deferred = []
+            idle = []
+            if self.pending == 0:
+                idle = self.on_idle
+                self.on_idle = []
+        for submit in deferred:
+            submit()
+        for callback in idle:
+            callback()
+
+    def _prompt(self, request:ChatRequest, flight:str=None):
+        client = request.get_client()
+        input = request.get_input()
+
+        # Requests wait for the model, so it failed to load (or the session was destroyed).
+        # The session may also be destroyed during the generation, which releases the lease
+        lease = self.lease
+        if lease == None:
             client.send(packet=Packet.CHAT, content={
                 "success": False,
-                "error": "model is not done initializing",
-                "sender": self.name,
+                "error": "failed to load model",
+                "sender": self.settings["name"],
                 "bot": True,
                 "type": "text",
                 "data": None
-            })
+            }, context_id=request.get_context_id())
             return
 
+        # Stopped while queued, unless other sessions wait for the response
+        error = request.get_error()
+        if error != None and not self._shared(flight):
+            self._send_stopped(request, error)
+            return
+        # Tokens generated when the request was stopped while others still waited for the
+        # response, it gets no more of it but the generation goes on for them
+        stopped = 0 if error != None else None
+        stopped_early = False
+
         self.status = "processing"
         unix_time = int(time.time())
-        current_date = time.strftime("%A %B %d %Y")
-        current_time = time.strftime("%H:%M:%S %Z (UTC%z)")
-        messages = []
-        system_prompt = f"""Your name is {self.settings["name"]}.
-You are a LLM model.
-Your model file is {self.settings["model"]}.
-Your model seed is {self.settings["seed"]}.
-The current date is {current_date}.
-The current time is {current_time}.
-You are running on {sys.platform.title()} {platform.release()}.
-The current prompt software is running on Python {sys.version_info.major}.{sys.version_info.minor}.{sys.version_info.micro}.
-Your local IP Address is {self.local_ip} and public IP Address is {self.public_ip}.
-You have no direct access to the file-system or internet.
-gpt4all-box is a gpt4all User Interface and Command-Line Interface service packaged in a containerized environment.
-"""
-
-        supplemental_prompt = f"""If the user requests that you:
-
-1. Make a HTTP GET request to a URL.
-2. Change your name.
-
-You may do so by responding in the following format,
-by first responding with the string `{CMD_PREFIX}`,
-then insert a new-line, then write `URL ` (notice the space) and then the URL the user specified.
-Or if the user wants you to change your name, instead of `WEB `, write `NAME ` and then the desired
-name the user specified. Finally insert a new line, and then write `{CMD_SUFFIX}`
-and insert a new-line again. You can then type out your response to the user.
-An example of this would look like:
-
-```
-{CMD_PREFIX}
-URL https://example.com
-{CMD_SUFFIX}
-
-I have successfully made a HTTP GET request to [https://example.com](https://example.com).
-```
-
-or for a name change to Bob:
-
-```
-{CMD_PREFIX}
-NAME Bob
-{CMD_SUFFIX}
-```
-
-My name is now Bob.
-"""
-
-        messages.append({
-            "role": "system",
-            "content": system_prompt
-        })
-        #messages.append({
-        #    "role": "system",
-        #    "content": supplemental_prompt
-        #})
 
-        #for message in self.history:
-        #    messages.append(message)
-
-        messages.append({
-            "role": "user",
-            "content": input
-        })
-
-        ###############################################################
-        
-        prompt = self._build_prompt(messages)
-
-        output = self.gpt4all.generate(
-            prompt=prompt,
-            # kwargs
-            logits_size=self.settings["logits_size"],       # int = 0
-            tokens_size=self.settings["tokens_size"],       # int = 0
-            n_past=self.settings["n_past"],                 # int = 0, 
-            n_ctx=self.settings["n_ctx"],                   # int = 1024, 
-            n_predict=self.settings["n_predict"],           # int = 128, 
-            top_k=self.settings["top_k"],                   # int = 40, 
-            top_p=self.settings["top_p"],                   # float = .9, 
-            temp=self.settings["temperature"],              # float = .1, 
-            n_batch=self.settings["n_batch"],               # int = 8, 
-            repeat_penalty=self.settings["repeat_penalty"], # float = 1.2, 
-            repeat_last_n=self.settings["repeat_last_n"],   # int = 10,    last n tokens to penalize
-            context_erase=self.settings["context_erase"]    # float = .5,  percent of context to erase if we exceed the context window
-        )
-
-        self.history.append({
-            "time": unix_time,
-            "role": "user",
-            "content": input
-        })
+        stream = request.is_stream()
+        tokens = []
+        start = time.time()
+        first_token = None
+
+        cache_key = None
+        if self.cache != None:
+            cache_key = flight if flight != None else self._cache_key(input)
+            cached = self.cache.get(cache_key)
+            if cached != None:
+                end = time.time()
+                if stopped != None:
+                    self._send_stopped(request, error)
+                else:
+                    self._add_history(unix_time, input, "".join(cached))
+                    # The model context does not hold this turn, rebuild it on the next prompt
+                    self.n_past = 0
+                    if stream:
+                        for i, token in enumerate(cached):
+                            self.send_chunk(request, i, token)
+                    self.send_response(request, cached, start, end, end)
+                if flight != None:
+                    self.flights.finish(flight, cached, start, end, end)
+                return
+
+        tuner = self.pool.get_tuner()
+        with lease.get_lock(), tuner.generating(self.settings["model"], self.settings["n_batch"], self.settings["n_ctx"]) as (threads, n_batch):
+            lease.set_thread_count(threads)
+            prompt, n_past, prompt_tokens = self._prepare_context(lease, input, n_batch)
+
+            generator = lease.get_model().generate(
+                prompt=prompt,
+                streaming=True,
+                # kwargs
+                logits_size=self.settings["logits_size"],       # int = 0
+                tokens_size=self.settings["tokens_size"],       # int = 0
+                n_past=n_past,                                  # tokens already in the model context
+                n_ctx=self.settings["n_ctx"],                   # int = 1024, 
+                n_predict=self.settings["n_predict"],           # int = 128, 
+                top_k=self.settings["top_k"],                   # int = 40, 
+                top_p=self.settings["top_p"],                   # float = .9, 
+                temp=self.settings["temperature"],              # float = .1, 
+                n_batch=n_batch,                                # int = 0,     0 = picked by the tuner
+                repeat_penalty=self.settings["repeat_penalty"], # float = 1.2, 
+                repeat_last_n=self.settings["repeat_last_n"],   # int = 10,    last n tokens to penalize
+                context_erase=self.settings["context_erase"]    # float = .5,  percent of context to erase if we exceed the context window
+            )
+
+            for token in generator:
+                if first_token == None:
+                    first_token = time.time()
+                tokens.append(token)
+
+                if stream and stopped == None:
+                    self.send_chunk(request, len(tokens) - 1, token)
+                if flight != None:
+                    self.flights.publish(flight, token)
+
+                if stopped == None:
+                    error = request.get_error()
+                    if error != None:
+                        stopped = len(tokens)
+                # Stop at the token boundary once nobody waits for the rest
+                if stopped != None and not self._shared(flight):
+                    stopped_early = True
+                    break
+
+            # Ends the backend's generation if it was stopped early
+            close = getattr(generator, "close", None)
+            if close != None:
+                close()
+
+            # The prompt and every token the backend evaluated (more than were passed on if it
+            # was stopped early) are now part of the model context
+            context_tokens = get_context_tokens(lease.get_model())
+            self.n_past = context_tokens if context_tokens != None else n_past + prompt_tokens + len(tokens)
+            lease.set_context_owner(lease)
+
+        end = time.time()
+        # What this session got of the response
+        response = tokens if stopped == None else tokens[:stopped]
+        self._add_history(unix_time, input, "".join(response))
+        if len(response) < len(tokens):
+            # The model context holds more of the response than the history, rebuild it on the next prompt
+            self.n_past = 0
+
+        if cache_key != None and not stopped_early:
+            self.cache.put(cache_key, tokens)
+
+        if first_token == None:
+            first_token = end
+
+        model = self.settings["model"]
+        TIME_TO_FIRST_TOKEN.observe(first_token - start, model)
+        PROMPT_TOKENS.inc(prompt_tokens, model)
+        GENERATED_TOKENS.inc(len(tokens), model)
+        if first_token > start:
+            PROMPT_TOKENS_PER_SECOND.observe(prompt_tokens / (first_token - start), model)
+        if len(tokens) > 1 and end > first_token:
+            GENERATION_TOKENS_PER_SECOND.observe((len(tokens) - 1) / (end - first_token), model)
+        tuner.record(model, threads, n_batch, prompt_tokens, first_token - start, len(tokens), end - first_token)
+
+        self.send_response(request, response, start, first_token, end, error, prompt_tokens)
+        if flight != None:
+            self.flights.finish(flight, tokens, start, first_token, end)
+
+    def _send_stopped(self, request:ChatRequest, error:str):
+        client = request.get_client()
+        logger.info(f"{client} chat {request.get_context_id()} stopped ({error})")
+        client.send(packet=Packet.CHAT, content={
+            "success": False,
+            "error": error
+        }, context_id=request.get_context_id())
 
-        self.history.append({
-            "time": int(time.time()),
-            "role": "assistant",
-            "content": output
-        })
+    def _shared(self, flight:str):
+        return flight != None and self.flights.has_subscribers(flight)
 
-        self.status = "idle"
+    def _add_history(self, unix_time:int, input:str, output:str):
+        self.history.append("user", input, unix_time)
+        self.history.append("assistant", output, int(time.time()))
 
-        client.send(packet=Packet.CHAT, content={
+    def send_chunk(self, request:ChatRequest, index:int, token:str):
+        request.get_client().send(packet=Packet.CHAT, content={
             "success": True,
             "error": None,
             "sender": self.settings["name"],
             "bot": True,
             "type": "text",
-            "data": b64e(output)
-        }, context_id=context_id)
-
-
-
-    def _build_prompt(self, messages:dict[str]):
-        full_prompt = ""
-
-        for message in messages:
-            if message["role"] == "system":
-                full_prompt += "### System:\n" + message["content"] + "\n"
-
-        
-        full_prompt += """### Instruction: 
-The prompt below is a question to answer, a task to complete, or a conversation 
-to respond to; decide which and write an appropriate response.
-
-### Prompt: \n"""
-
-        for message in messages:
-            if message["role"] == "user":
-                full_prompt += message["content"] + "\n"
-            if message["role"] == "assistant":
-                full_prompt += "### Response: " + message["content"] + "\n"
-
-        full_prompt += "### Response: "
-
-        return full_prompt
-
-    def _get_local_ip(self):
-        import socket
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(("1.1.1.1", 80))
-        local_ip = s.getsockname()[0]
-        s.close()
-        return local_ip
-
-    def _get_public_ip(self):
-        import requests
-        endpoint = 'https://checkip.amazonaws.com/'
-        response = requests.get(endpoint)
-        if response.status_code != 200:
-            return "0.0.0.0"
-        
-        return response.text.replace("\n","").strip()
\ No newline at end of file
+            "stream": "chunk",
+            "index": index,
+            "data": token
+        }, context_id=request.get_context_id())
+
+    def send_response(self, request:ChatRequest, tokens:list, start:float, first_token:float, end:float, error:str=None, prompt_tokens:int=0):
+        # A stopped generation still sends what was generated until then, along with the error
+        client = request.get_client()
+        context_id = request.get_context_id()
+        # Tokens evaluated for this turn (0 if the response was reused), generated, and now in the model context
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(tokens),
+            "context_tokens": self.n_past,
+            "history_tokens": self.history.get_tokens()
+        }
+        if request.is_stream():
+            # Final packet only carries the totals, the text was already sent as chunks
+            client.send(packet=Packet.CHAT, content={
+                "success": error == None,
+                "error": error,
+                "sender": self.settings["name"],
+                "bot": True,
+                "type": "text",
+                "stream": "end",
+                "data": "",
+                "tokens": len(tokens),
+                "time_to_first_token": int((first_token - start) * 1000),
+                "duration": int((end - start) * 1000),
+                "usage": usage
+            }, context_id=context_id)
+        else:
+            client.send(packet=Packet.CHAT, content={
+                "success": error == None,
+                "error": error,
+                "sender": self.settings["name"],
+                "bot": True,
+                "type": "text",
+                "data": "".join(tokens),
+                "usage": usage
+            }, context_id=context_id)
+
+    def _prepare_context(self, lease:ModelLease, input:str, n_batch:int):
+        """
+        Returns the prompt text to evaluate, the number of tokens it continues from and its
+        own token count. If the model context still holds this conversation only the new turn
+        is fed, otherwise the conversation is rebuilt from the most recent history that fits.
+        """
+        model = lease.get_model()
+        if self.n_past > 0 and lease.get_context_owner() is lease and can_continue(model):
+            turn = self.template.render_turn(input)
+            turn_tokens = self._count_tokens(turn)
+            if self.n_past + turn_tokens + self.settings["n_predict"] <= self.settings["n_ctx"]:
+                return turn, self.n_past, turn_tokens
+
+        # Model context was used by another session or the window is full, erase
+        # context_erase of it by keeping only the newest history that fits
+        prefix, prefix_hash = self.template.get_prefix(self.settings["name"], self.settings["model"])
+        context = self._render_context()
+        turn = self.template.render_message("user", input) + self.template.response
+        own_prefix_tokens = self._count_prefix_tokens(prefix, prefix_hash)
+        turn_tokens = self._count_tokens(context + turn)
+        budget = int(self.settings["n_ctx"] * (1 - self.settings["context_erase"]))
+        budget -= own_prefix_tokens + turn_tokens
+        start = self.history.window(budget)
+
+        self.n_past = 0
+        prompt = prefix + context + self.history.render(start) + turn
+        # Counted per part, the history by the counts kept for each message
+        prompt_tokens = turn_tokens + self.history.get_tokens(start)
+
+        if not can_continue(model):
+            return prompt, 0, prompt_tokens + own_prefix_tokens
+
+        # The static prefix is shared, skip it if the model context already starts with it,
+        # otherwise evaluate it alone first so its exact length is known to the next sessions
+        context_prefix, prefix_tokens = lease.get_context_prefix()
+        if context_prefix != prefix_hash:
+            prefix_tokens = evaluate_prefix(model, prefix, n_ctx=self.settings["n_ctx"], n_batch=n_batch)
+            lease.set_context_prefix(prefix_hash, prefix_tokens)
+            prompt_tokens += prefix_tokens
+        return prompt[len(prefix):], prefix_tokens, prompt_tokens
+
+    def _cache_key(self, input:str):
+        # The whole conversation, leaving out the volatile context (date, time, addresses)
+        prefix, prefix_hash = self.template.get_prefix(self.settings["name"], self.settings["model"])
+        conversation = prefix + self.history.render() + self.template.render_message("user", input)
+        return make_key(self.settings["model"], self.settings, conversation)
+
+    def _count_tokens(self, text:str):
+        return count_tokens(self.gpt4all, text)
+
+    def _count_prefix_tokens(self, prefix:str, prefix_hash:str):
+        if self.prefix_tokens[0] != prefix_hash:
+            self.prefix_tokens = (prefix_hash, self._count_tokens(prefix))
+        return self.prefix_tokens[1]
+
+    def _render_context(self):
+        return self.template.render_context({
+            "seed": self.settings["seed"],
+            "date": time.strftime("%A %B %d %Y"),
+            "time": time.strftime("%H:%M:%S %Z (UTC%z)"),
+            "local_ip": host.get_local_ip(),
+            "public_ip": host.get_public_ip()
+        })
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import bisect
+import logging
+from array import array
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+ROLES = ("user", "assistant")
+
+class History:
+    """
+    Append-only conversation history of a session.
+
+    Every message is rendered with the prompt template and its tokens counted once,
+    when it is appended. A running total of the token counts finds the newest messages
+    that fit a token budget with a binary search, so building a prompt never re-scans
+    or re-tokenizes the conversation.
+    """
+
+    def __init__(self, render:Callable, count_tokens:Callable):
+        self.render_message = render
+        self.count_tokens = count_tokens
+        self.times = array("q")
+        self.roles = array("b")
+        self.contents = []
+        self.rendered = []
+        # totals[i] is the number of tokens of the first i messages
+        self.totals = array("q", [0])
+
+    def append(self, role:str, content:str, time:int):
+        rendered = self.render_message(role, content)
+        self.times.append(time)
+        self.roles.append(ROLES.index(role))
+        self.contents.append(content)
+        self.rendered.append(rendered)
+        self.totals.append(self.totals[-1] + self.count_tokens(rendered))
+
+    def extend(self, messages:list):
+        for message in messages:
+            self.append(message["role"], message["content"], message["time"])
+
+    def window(self, budget:int):
+        """
+        Returns the index of the oldest message such that it and all newer messages fit
+        in budget tokens, never starting with a response.
+        """
+        total = self.totals[-1]
+        start = min(bisect.bisect_left(self.totals, total - budget), len(self.contents))
+        if start < len(self.contents) and ROLES[self.roles[start]] == "assistant":
+            start += 1
+        return start
+
+    def render(self, start:int=0):
+        return "".join(self.rendered[start:])
+
+    def get_tokens(self, start:int=0):
+        return self.totals[-1] - self.totals[start]
+
+    def get_message_tokens(self, index:int):
+        return self.totals[index + 1] - self.totals[index]
+
+    def to_list(self):
+        return [{
+            "time": self.times[i],
+            "role": ROLES[self.roles[i]],
+            "content": self.contents[i]
+        } for i in range(len(self.contents))]
+
+    def __len__(self):
+        return len(self.contents)
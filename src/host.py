@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import socket
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+UNKNOWN_IP = "0.0.0.0"
+PUBLIC_IP_ENDPOINT = "https://checkip.amazonaws.com/"
+
+_facts = {
+    "local_ip": UNKNOWN_IP,
+    "public_ip": UNKNOWN_IP
+}
+
+def resolve(lookup_public_ip:bool=True, timeout:int=3000):
+    """
+    Resolve the host facts once for the whole process, in the background so nothing waits on the network.
+    """
+    thread = threading.Thread(target=_resolve, args=(lookup_public_ip, timeout), name="host-facts", daemon=True)
+    thread.start()
+    return thread
+
+def get_local_ip():
+    return _facts["local_ip"]
+
+def get_public_ip():
+    return _facts["public_ip"]
+
+def get_memory_usage():
+    """
+    Resident set size of this process in bytes, or None where it cannot be measured (Linux only).
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+def _resolve(lookup_public_ip:bool, timeout:int):
+    _facts["local_ip"] = _get_local_ip()
+    if lookup_public_ip:
+        _facts["public_ip"] = _get_public_ip(timeout)
+    logger.info(f"Host local IP Address is {_facts['local_ip']} and public IP Address is {_facts['public_ip']}")
+
+def _get_local_ip():
+    # Connecting a UDP socket sends nothing, it only picks the interface of the default route
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        s.connect(("1.1.1.1", 80))
+        return s.getsockname()[0]
+    except OSError:
+        return UNKNOWN_IP
+    finally:
+        s.close()
+
+def _get_public_ip(timeout:int):
+    import requests
+    try:
+        response = requests.get(PUBLIC_IP_ENDPOINT, timeout=timeout / 1000)
+    except requests.RequestException as e:
+        logger.warning(f"Could not look up public IP Address ({e})")
+        return UNKNOWN_IP
+
+    if response.status_code != 200:
+        return UNKNOWN_IP
+
+    return response.text.replace("\n","").strip()
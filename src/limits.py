@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import time
+import logging
+import threading
+
+from packet import Packet
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+REJECTED_REQUESTS = Counter("g4ab_rejected_requests_total", "Requests rejected to protect the inference capacity, by reason.", ("reason",))
+
+class TokenBucket:
+    """
+    Allows rate requests per second on average, and bursts of up to burst requests.
+    """
+
+    def __init__(self, rate:float, burst:int):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+
+    def take(self, cost:int=1):
+        """
+        Returns 0 if the request may pass, otherwise the seconds until it would.
+        """
+        current = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (current - self.updated) * self.rate)
+        self.updated = current
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0
+        return (cost - self.tokens) / self.rate
+
+    def is_full(self):
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.burst
+
+class RateLimiter:
+    """
+    A token bucket per client address. rate is in requests per minute, 0 = unlimited.
+    """
+
+    def __init__(self, rate:int, burst:int):
+        self.rate = rate / 60
+        self.burst = burst
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def take(self, address:str):
+        """
+        Returns 0 if the address may make a request, otherwise the milliseconds until it may.
+        """
+        if self.rate <= 0:
+            return 0
+        with self.lock:
+            bucket = self.buckets.get(address)
+            if bucket == None:
+                bucket = TokenBucket(self.rate, self.burst)
+                self.buckets[address] = bucket
+            wait = bucket.take()
+        return int(wait * 1000) + 1 if wait > 0 else 0
+
+    def prune(self):
+        # Full buckets are the same as new ones
+        with self.lock:
+            for address, bucket in list(self.buckets.items()):
+                if bucket.is_full():
+                    del self.buckets[address]
+            return len(self.buckets)
+
+class Admission:
+    """
+    Rate limits the expensive packets per client address before they reach the core: session
+    creates (which load a model) and batches against one limit, chat messages against another.
+    Sessions and models are capped globally by the core itself.
+    """
+
+    def __init__(self, session_rate:int, chat_rate:int, burst:int):
+        self.sessions = RateLimiter(session_rate, burst)
+        self.chats = RateLimiter(chat_rate, burst)
+
+    def check(self, client, msg:dict):
+        """
+        Returns 0 if the packet may be handled, otherwise the milliseconds to retry after.
+        """
+        content = msg.get("content")
+        if not isinstance(content, dict):
+            return 0
+        if msg["msg"] == Packet.SESSION and content.get("request") == "create":
+            limiter = self.sessions
+        elif msg["msg"] == Packet.BATCH:
+            # Batches create sessions of their own
+            limiter = self.sessions
+        elif msg["msg"] == Packet.CHAT and content.get("type") == "text":
+            limiter = self.chats
+        else:
+            return 0
+
+        retry_after = limiter.take(client.get_address())
+        if retry_after > 0:
+            REJECTED_REQUESTS.inc(1, "rate limited")
+            logger.debug(f"{client} is rate limited, retry after {retry_after}ms")
+        return retry_after
+
+    def reject(self, client, msg:dict, retry_after:int):
+        client.send(packet=Packet(msg["msg"]), content={
+            "success": False,
+            "error": "rate limited",
+            "retry_after": retry_after
+        }, context_id=msg["cid"])
+
+    def prune(self):
+        return self.sessions.prune() + self.chats.prune()
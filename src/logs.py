@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import json
+import queue
+import hashlib
+import logging
+import itertools
+import logging.handlers
+
+# Set by setup() and configure(), per process
+log_format = "text"
+verbose_addresses = set()
+sample_rate = 1
+log_prompts = False
+samples = itertools.count()
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line, for log collectors.
+    """
+
+    def __init__(self, fields:dict=None):
+        super().__init__(datefmt='%Y-%m-%dT%H:%M:%S%z')
+        self.fields = fields if fields != None else {}
+
+    def format(self, record:logging.LogRecord):
+        entry = {
+            "time": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        entry.update(self.fields)
+        return json.dumps(entry, ensure_ascii=False)
+
+def setup(level:str, format:str="text", prefix:str="", fields:dict=None):
+    """
+    Logs to stderr from a background thread, so a slow terminal or log collector never
+    blocks the event loop or an inference worker. Records are only formatted once they
+    passed the level of their logger. Returns the listener, stop it to flush.
+    """
+    global log_format
+    log_format = format
+    if format == "json":
+        formatter = JsonFormatter(fields)
+    else:
+        formatter = logging.Formatter(fmt=f'%(asctime)s [%(levelname)s] {prefix}%(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    handler = logging.StreamHandler()
+    handler.setFormatter(formatter)
+
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+
+    root_logger = logging.getLogger()
+    root_logger.setLevel(level)
+    root_logger.handlers.clear()
+    root_logger.addHandler(logging.handlers.QueueHandler(records))
+    return listener
+
+def configure(debug_clients:str, log_sample_rate:int, log_prompts_enabled:bool):
+    global verbose_addresses, sample_rate, log_prompts
+    verbose_addresses = set([a.strip() for a in debug_clients.split(",") if a.strip() != ""])
+    sample_rate = max(1, log_sample_rate)
+    log_prompts = log_prompts_enabled
+
+def get_config():
+    # For worker processes to log the same way
+    return {
+        "format": log_format,
+        "debug_clients": ",".join(verbose_addresses),
+        "sample_rate": sample_rate,
+        "prompts": log_prompts
+    }
+
+def is_verbose(address:str):
+    # Clients whose packets are logged even without debug logging
+    return address in verbose_addresses
+
+def sampled():
+    return sample_rate == 1 or next(samples) % sample_rate == 0
+
+def describe_text(text:str):
+    """
+    A prompt or response as it may be logged, only its length and hash unless LOG_PROMPTS is set.
+    """
+    if log_prompts:
+        return text
+    digest = hashlib.sha256(text.encode("utf-8")).hexdigest()[:12]
+    return f"<{len(text)} characters, sha256 {digest}>"
+
+def describe_payload(payload):
+    if log_prompts:
+        return str(payload)
+    return f"<{len(payload)} bytes>"
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import bisect
+import logging
+import threading
+from typing import Callable
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+logger = logging.getLogger(__name__)
+# Seconds, from a fast packet to a long generation
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+RATE_BUCKETS = (0.5, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+
+    def collect(self):
+        """
+        Returns a list of (name, type, help, samples) families, samples being
+        (name, labels, value) tuples. The result can be pickled, to collect the
+        metrics of worker processes.
+        """
+        with self.lock:
+            metrics = list(self.metrics)
+        return [(m.name, m.type, m.help, m.samples()) for m in metrics]
+
+REGISTRY = Registry()
+
+class _Metric:
+    type = None
+
+    def __init__(self, name:str, help:str, labels:tuple=(), registry:Registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.register(self)
+
+    def _labels(self, label_values:tuple):
+        return dict(zip(self.labels, label_values))
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount:float=1, *label_values):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, self._labels(k), v) for k, v in self.values.items()]
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def __init__(self, name:str, help:str, labels:tuple=(), registry:Registry=REGISTRY):
+        super().__init__(name, help, labels, registry)
+        self.function = None
+
+    def set(self, value:float, *label_values):
+        with self.lock:
+            self.values[label_values] = value
+
+    def set_function(self, function:Callable):
+        # Evaluated on every collect instead of being set
+        self.function = function
+
+    def samples(self):
+        if self.function != None:
+            return [(self.name, {}, self.function())]
+        with self.lock:
+            return [(self.name, self._labels(k), v) for k, v in self.values.items()]
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name:str, help:str, labels:tuple=(), buckets:tuple=BUCKETS, registry:Registry=REGISTRY):
+        super().__init__(name, help, labels, registry)
+        self.buckets = buckets
+
+    def observe(self, value:float, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            values = self.values.get(label_values)
+            if values == None:
+                # bucket counts (last one is +Inf), sum
+                values = [[0] * (len(self.buckets) + 1), 0.0]
+                self.values[label_values] = values
+            values[0][index] += 1
+            values[1] += value
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            values = [(k, list(v[0]), v[1]) for k, v in self.values.items()]
+        for label_values, counts, total in values:
+            labels = self._labels(label_values)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                samples.append((self.name + "_bucket", dict(labels, le=_format_value(bound)), cumulative))
+            samples.append((self.name + "_sum", labels, total))
+            samples.append((self.name + "_count", labels, cumulative))
+        return samples
+
+def render(families:list):
+    """
+    Render collected families in the Prometheus text exposition format, merging
+    families with the same name (e.g. from several worker processes).
+    """
+    merged = {}
+    for name, type, help, samples in families:
+        if name not in merged:
+            merged[name] = (type, help, [])
+        merged[name][2].extend(samples)
+
+    lines = []
+    for name, (type, help, samples) in merged.items():
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {type}")
+        for sample, labels, value in samples:
+            if len(labels) > 0:
+                label_string = ",".join([f'{k}="{_escape(v)}"' for k, v in labels.items()])
+                lines.append(f"{sample}{{{label_string}}} {_format_value(value)}")
+            else:
+                lines.append(f"{sample} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+def label(families:list, name:str, value:str):
+    # Add a label to every sample, e.g. the worker process they were collected in
+    return [(n, t, h, [(s, dict(l, **{name: value}), v) for s, l, v in samples]) for n, t, h, samples in families]
+
+def serve(address:str, port:int, collect:Callable, ready:Callable=None, reuse_port:bool=False):
+    """
+    Serve render(collect()) on /metrics from a background thread, and a readiness
+    check on /ready answering 200 once ready() is true and 503 before. With reuse_port,
+    the next instance of the server can listen on the same port while this one drains.
+    """
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            path = self.path.split("?")[0]
+            if path == "/ready" and ready != None:
+                is_ready = ready()
+                body = b"ready\n" if is_ready else b"not ready\n"
+                self.send_response(200 if is_ready else 503)
+                self.send_header("Content-Type", "text/plain; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+            if path != "/metrics":
+                self.send_error(404)
+                return
+            body = render(collect()).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((address, port), Handler, bind_and_activate=False)
+    server.allow_reuse_port = reuse_port
+    server.server_bind()
+    server.server_activate()
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    logger.info(f"Metrics available on http://{address}:{port}/metrics")
+    return server
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
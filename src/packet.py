@@ -6,4 +6,6 @@ class Packet(StrEnum):
     PING = "ping",
     SYSTEM = "system",
     SESSION = "session",
-    CHAT = "chat"
+    CHAT = "chat",
+    STATS = "stats",
+    BATCH = "batch"
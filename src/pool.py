@@ -0,0 +1,399 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import time
+import queue
+import codecs
+import logging
+import importlib
+import threading
+from typing import Callable
+from metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+MODEL_LOAD_SECONDS = Histogram("g4ab_model_load_seconds", "Time to load a model into the pool.", ("model",))
+POOL_REQUESTS = Counter("g4ab_model_pool_requests_total", "Model leases by whether the model was already loaded.", ("result",))
+
+# The wrapper below calls into the internals of exactly this version of the bindings
+GPT4ALL_VERSION = "0.3.0"
+# Defaults of LLModel.generate in the gpt4all bindings
+GENERATE_DEFAULTS = {
+    "logits_size": 0,
+    "tokens_size": 0,
+    "n_past": 0,
+    "n_ctx": 1024,
+    "n_predict": 128,
+    "top_k": 40,
+    "top_p": .9,
+    "temp": .1,
+    "n_batch": 8,
+    "repeat_penalty": 1.2,
+    "repeat_last_n": 10,
+    "context_erase": .5
+}
+
+class _StreamingGPT4All:
+    """
+    A GPT4All model whose generate(streaming=True) yields the tokens as they are generated.
+    The bindings only print them to a swapped sys.stdout and return the finished response,
+    so the prompt runs on a thread of its own and the tokens are passed on by the response
+    callback. Closing the generator stops the backend at its next token.
+    """
+
+    def __init__(self, gpt4all):
+        self.gpt4all = gpt4all
+        # Backend, see ModelLease.set_thread_count
+        self.model = gpt4all.model
+        # Tokens in the model context, as the backend counted them
+        self.n_past = 0
+
+    def generate(self, prompt:str, streaming:bool=False, **kwargs):
+        tokens = self._stream(prompt, dict(GENERATE_DEFAULTS, **kwargs))
+        if streaming:
+            return tokens
+        return "".join(tokens)
+
+    def get_n_past(self):
+        # After the last generation, including tokens evaluated but not passed on
+        return self.n_past
+
+    def _stream(self, prompt:str, settings:dict):
+        from gpt4all import pyllmodel
+
+        tokens = queue.Queue()
+        stopped = threading.Event()
+        # Tokens are bytes, a character may be split between two of them
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+        def on_prompt(token_id):
+            return not stopped.is_set()
+
+        def on_response(token_id, response):
+            tokens.put(decoder.decode(response))
+            return not stopped.is_set()
+
+        def on_recalculate(is_recalculating):
+            return is_recalculating
+
+        # Referenced until the prompt returns, ctypes does not keep them alive
+        callbacks = (pyllmodel.PromptCallback(on_prompt), pyllmodel.ResponseCallback(on_response), pyllmodel.RecalculateCallback(on_recalculate))
+        context = pyllmodel.LLModelPromptContext(**settings)
+
+        def run():
+            try:
+                pyllmodel.llmodel.llmodel_prompt(self.model.model, prompt.encode("utf-8"), *callbacks, context)
+            except Exception as e:
+                logger.error(f"Generation failed ({e})")
+            finally:
+                tokens.put(None)
+
+        thread = threading.Thread(target=run, name="generate", daemon=True)
+        thread.start()
+        try:
+            while True:
+                token = tokens.get()
+                if token == None:
+                    break
+                if token != "":
+                    yield token
+            # A character split at the end of the response
+            token = decoder.decode(b"", final=True)
+            if token != "":
+                yield token
+        finally:
+            # The model lock is held until the backend is done with the model context
+            stopped.set()
+            thread.join()
+            self.n_past = context.n_past
+
+def _load_gpt4all(model_name:str, model_type:str, thread_count:int):
+    from importlib.metadata import version, PackageNotFoundError
+    try:
+        installed = version("gpt4all")
+    except PackageNotFoundError:
+        installed = "none"
+    if installed != GPT4ALL_VERSION:
+        raise RuntimeError(f"gpt4all {GPT4ALL_VERSION} is required, {installed} is installed (see requirements.txt)")
+    from gpt4all import GPT4All
+    model = GPT4All(model_name=model_name, model_path=None, model_type=model_type)
+    model.model.set_thread_count(thread_count)
+    return _StreamingGPT4All(model)
+
+def get_loader(backend:str=None) -> Callable:
+    """
+    Returns the model loader for a backend, "gpt4all" or the import path of a
+    function with the same signature as _load_gpt4all (e.g. "bench.load_fake_model").
+    """
+    if backend == None or backend == "gpt4all":
+        return _load_gpt4all
+    module, function = backend.rsplit(".", 1)
+    return getattr(importlib.import_module(module), function)
+
+class _PooledModel:
+
+    def __init__(self, key:tuple, instance:int):
+        self.key = key
+        # Number of the instance of the model, for the logs
+        self.instance = instance
+        self.model = None
+        self.error = None
+        self.references = 0
+        # References that only keep the model loaded, see ModelPool.acquire
+        self.pinned = 0
+        self.last_released = time.time()
+        self.load_time = 0.0
+        self.ready = threading.Event()
+        # Only one generation may run on a model instance at a time
+        self.lock = threading.Lock()
+        # Whoever last evaluated tokens into the model context (KV cache)
+        self.context_owner = None
+        # Hash and token count of the static prompt prefix the model context starts with
+        self.context_prefix = (None, 0)
+        # Threads the backend currently generates with
+        self.threads = key[2]
+
+class ModelLease:
+
+    def __init__(self, pool, entry:_PooledModel, pinned:bool=False):
+        self.pool = pool
+        self.entry = entry
+        self.pinned = pinned
+        self.released = False
+
+    def get_model(self):
+        return self.entry.model
+
+    def get_lock(self):
+        return self.entry.lock
+
+    def get_key(self):
+        return self.entry.key
+
+    def get_instance(self):
+        # Identifies the model instance, only one generation runs on it at a time
+        return self.entry
+
+    def get_context_owner(self):
+        return self.entry.context_owner
+
+    def set_context_owner(self, owner):
+        # Must be called with the model lock held
+        self.pool.set_context_owner(self.entry, owner)
+
+    def get_context_prefix(self):
+        return self.entry.context_prefix
+
+    def set_context_prefix(self, prefix_hash:str, tokens:int):
+        # Must be called with the model lock held
+        self.entry.context_prefix = (prefix_hash, tokens)
+
+    def set_thread_count(self, threads:int):
+        # Must be called with the model lock held
+        if threads == None or threads == self.entry.threads:
+            return
+        backend = getattr(self.entry.model, "model", None)
+        if backend != None and hasattr(backend, "set_thread_count"):
+            backend.set_thread_count(threads)
+        self.entry.threads = threads
+
+    def release(self):
+        self.pool.release(self)
+
+class ModelPoolFull(Exception):
+    pass
+
+class ModelPool:
+
+    def __init__(self, model_threads:int, idle_timeout:int, loader:Callable=_load_gpt4all, max_models:int=0, tuner=None, max_instances:int=1):
+        self.model_threads = model_threads
+        self.idle_timeout = idle_timeout
+        self.loader = loader
+        # Threads and batch size of each generation, see Tuner
+        self.tuner = tuner
+        # Loaded at once, 0 = unlimited
+        self.max_models = max_models
+        # Instances of each model, so sessions of the same model can generate at the same time.
+        # The weights are memory mapped and shared, every instance has a context of its own
+        self.max_instances = max(1, max_instances)
+        # Instances by model
+        self.models = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.unloads = 0
+
+    def acquire(self, model_name:str, model_type:str=None, pinned:bool=False) -> ModelLease:
+        """
+        Lease an instance of a model, loading it on the calling thread if no other session has
+        it yet. Sessions are spread over up to max_instances instances, a new one is loaded once
+        every instance is leased. Blocks while another thread is still loading the instance.
+        Raises ModelPoolFull if the model is not loaded and max_models are, all of them leased.
+        A pinned lease keeps the model loaded without counting as a session of the instance.
+        """
+        key = (model_name, model_type, self.model_threads)
+        load = False
+        unloaded = []
+
+        with self.lock:
+            instances = self.models.get(key)
+            if instances == None:
+                if not self._has_room():
+                    raise ModelPoolFull("too many models loaded")
+                unloaded = self._make_room()
+                instances = []
+                self.models[key] = instances
+            entry = self._pick(instances)
+            if entry == None:
+                entry = _PooledModel(key, len(instances) + 1)
+                instances.append(entry)
+                self.misses += 1
+                load = True
+            else:
+                self.hits += 1
+            entry.references += 1
+            if pinned:
+                entry.pinned += 1
+        POOL_REQUESTS.inc(1, "miss" if load else "hit")
+
+        for instance in unloaded:
+            logger.info(f"Unloading idle model {instance.key[0]} to load {model_name}")
+            instance.model = None
+
+        if load:
+            logger.info(f"Loading model {model_name} (instance {entry.instance}) ...")
+            start = time.time()
+            try:
+                entry.model = self.loader(model_name, model_type, self.model_threads)
+            except Exception as e:
+                entry.error = e
+                with self.lock:
+                    self._remove(entry)
+            entry.load_time = time.time() - start
+            entry.ready.set()
+            if entry.error == None:
+                MODEL_LOAD_SECONDS.observe(entry.load_time, model_name)
+                logger.info(f"Model {model_name} (instance {entry.instance}) loaded in {entry.load_time:.2f} seconds")
+        else:
+            entry.ready.wait()
+
+        if entry.error != None:
+            with self.lock:
+                entry.references -= 1
+                if pinned:
+                    entry.pinned -= 1
+            raise entry.error
+
+        return ModelLease(self, entry, pinned)
+
+    def get_tuner(self):
+        return self.tuner
+
+    def can_acquire(self, model_name:str, model_type:str=None):
+        """
+        Whether acquire() would not raise ModelPoolFull right now.
+        """
+        with self.lock:
+            return (model_name, model_type, self.model_threads) in self.models or self._has_room()
+
+    def set_context_owner(self, entry:_PooledModel, owner:ModelLease):
+        with self.lock:
+            # A lease released during the generation never continues its context
+            entry.context_owner = owner if owner == None or not owner.released else None
+
+    def release(self, lease:ModelLease):
+        # Does not take the model lock, the model may be generating for another session
+        with self.lock:
+            if lease.released:
+                return
+            lease.released = True
+            entry = lease.entry
+            if entry.context_owner is lease:
+                entry.context_owner = None
+            entry.references -= 1
+            if lease.pinned:
+                entry.pinned -= 1
+            if entry.references <= 0:
+                entry.references = 0
+                entry.last_released = time.time()
+
+    def prune(self, idle_timeout:int=None):
+        """
+        Unload models which have not been leased by any session for longer than the idle timeout
+        (milliseconds, defaults to the pool's).
+        """
+        if idle_timeout == None:
+            idle_timeout = self.idle_timeout
+        current = time.time()
+        unloaded = []
+
+        with self.lock:
+            for instances in list(self.models.values()):
+                for entry in list(instances):
+                    if not entry.ready.is_set() or entry.references > 0:
+                        continue
+                    if (current - entry.last_released) * 1000 >= idle_timeout:
+                        self._remove(entry)
+                        unloaded.append(entry)
+            self.unloads += len(unloaded)
+
+        for entry in unloaded:
+            logger.info(f"Unloading idle model {entry.key[0]} (instance {entry.instance})")
+            entry.model = None
+
+        return len(unloaded)
+
+    def _pick(self, instances:list):
+        """
+        Returns the instance to lease, one no session uses or else the least used one, or None
+        if a new one should be loaded. Must be called with the pool lock held.
+        """
+        sessions = lambda entry: entry.references - entry.pinned
+        unused = [entry for entry in instances if sessions(entry) == 0]
+        if len(unused) > 0:
+            return unused[0]
+        if len(instances) < self.max_instances:
+            return None
+        return min(instances, key=sessions)
+
+    def _remove(self, entry:_PooledModel):
+        # Must be called with the pool lock held
+        instances = self.models.get(entry.key)
+        if instances == None or entry not in instances:
+            return
+        instances.remove(entry)
+        if len(instances) == 0:
+            del self.models[entry.key]
+
+    def _is_idle(self, instances:list):
+        return all([entry.ready.is_set() and entry.references == 0 for entry in instances])
+
+    def _has_room(self):
+        # Must be called with the pool lock held
+        if self.max_models <= 0 or len(self.models) < self.max_models:
+            return True
+        return any([self._is_idle(instances) for instances in self.models.values()])
+
+    def _make_room(self):
+        """
+        Removes the least recently released idle model (all of its instances) if the pool is
+        full and returns its instances, must be called with the pool lock held.
+        """
+        if self.max_models <= 0 or len(self.models) < self.max_models:
+            return []
+        idle = [instances for instances in self.models.values() if self._is_idle(instances)]
+        instances = min(idle, key=lambda instances: max([entry.last_released for entry in instances]))
+        del self.models[instances[0].key]
+        self.unloads += len(instances)
+        return instances
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "loaded": len(self.models),
+                "max": self.max_models,
+                "instances": sum([len(instances) for instances in self.models.values()]),
+                "max_instances": self.max_instances,
+                "references": sum([e.references for instances in self.models.values() for e in instances]),
+                "hits": self.hits,
+                "misses": self.misses,
+                "unloads": self.unloads
+            }
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import time
+import heapq
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+class ClientRegistry:
+    """
+    Connected clients indexed by their websocket handler id.
+    """
+
+    def __init__(self):
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def add(self, client):
+        with self.lock:
+            self.clients[client.get_id()] = client
+
+    def remove(self, client_id):
+        with self.lock:
+            return self.clients.pop(client_id, None)
+
+    def get(self, client_id):
+        with self.lock:
+            return self.clients.get(client_id)
+
+    def all(self):
+        with self.lock:
+            return list(self.clients.values())
+
+    def count(self):
+        with self.lock:
+            return len(self.clients)
+
+class SessionRegistry:
+    """
+    Sessions indexed by session id, with a min-heap of expiry times so pruning only
+    touches sessions that are due.
+
+    Heap entries are not updated when a session is used, instead a popped entry that is
+    no longer due is pushed back with the session's current expiry time.
+    """
+
+    def __init__(self):
+        self.sessions = {}
+        self.expiry = []
+        self.lock = threading.Lock()
+
+    def add(self, session):
+        with self.lock:
+            self.sessions[session.get_id()] = session
+            heapq.heappush(self.expiry, (session.get_expiry(), session.get_id()))
+
+    def remove(self, session_id:str):
+        # The heap entry is dropped lazily by prune()
+        with self.lock:
+            return self.sessions.pop(session_id, None)
+
+    def get(self, session_id:str):
+        """
+        Returns the session, or None if it does not exist or has expired.
+        """
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session == None or time.time() <= session.get_expiry():
+                return session
+            del self.sessions[session_id]
+
+        # Destroying waits for a running generation, don't hold the lock for it
+        session.destroy()
+        return None
+
+    def prune(self):
+        """
+        Remove and return all expired sessions.
+        """
+        current = time.time()
+        expired = []
+
+        with self.lock:
+            while len(self.expiry) > 0 and self.expiry[0][0] <= current:
+                expires, session_id = heapq.heappop(self.expiry)
+                session = self.sessions.get(session_id)
+                if session == None:
+                    continue
+                if session.get_expiry() > current:
+                    heapq.heappush(self.expiry, (session.get_expiry(), session_id))
+                    continue
+                del self.sessions[session_id]
+                expired.append(session)
+
+        return expired
+
+    def least_recently_used(self):
+        """
+        Returns all sessions, least recently used first.
+        """
+        with self.lock:
+            sessions = list(self.sessions.values())
+        return sorted(sessions, key=lambda session: session.get_last_used())
+
+    def all(self):
+        with self.lock:
+            return list(self.sessions.values())
+
+    def count(self):
+        with self.lock:
+            return len(self.sessions)
+
+class RequestRegistry:
+    """
+    Chat requests being answered, indexed by client id and context id so they can be
+    cancelled by their client.
+    """
+
+    def __init__(self):
+        self.requests = {}
+        self.lock = threading.Lock()
+
+    def add(self, request):
+        with self.lock:
+            client_id = request.get_client().get_id()
+            if client_id not in self.requests:
+                self.requests[client_id] = {}
+            self.requests[client_id][request.get_context_id()] = request
+
+    def remove(self, request):
+        with self.lock:
+            client_id = request.get_client().get_id()
+            requests = self.requests.get(client_id)
+            if requests == None or requests.get(request.get_context_id()) is not request:
+                return
+            del requests[request.get_context_id()]
+            if len(requests) == 0:
+                del self.requests[client_id]
+
+    def get(self, client_id, context_id:str):
+        with self.lock:
+            return self.requests.get(client_id, {}).get(context_id)
+
+    def get_client(self, client_id):
+        with self.lock:
+            return list(self.requests.get(client_id, {}).values())
+
+    def all(self):
+        with self.lock:
+            return [request for requests in self.requests.values() for request in requests.values()]
+
+    def count(self):
+        with self.lock:
+            return sum([len(r) for r in self.requests.values()])
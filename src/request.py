@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import time
+import logging
+
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+STOPPED_REQUESTS = Counter("g4ab_stopped_requests_total", "Chat requests cancelled, abandoned by a disconnect or past their deadline.", ("reason",))
+
+class ChatRequest:
+    """
+    A chat message of a client that is being answered. It can be cancelled by the
+    client (or its disconnect) and expires after its deadline, both of which stop
+    it while queued or at the next generated token.
+    """
+
+    def __init__(self, client, context_id:str, input:str, deadline:int=0, registry=None, stream:bool=False):
+        self.client = client
+        self.context_id = context_id
+        self.input = input
+        # Whether the response is sent as chunks, see Gpt.send_chunk
+        self.stream = stream
+        # Absolute time, deadline is in milliseconds from now (0 = none)
+        self.deadline = time.time() + deadline / 1000 if deadline > 0 else None
+        self.registry = registry
+        self.cancelled = None
+
+    def get_client(self):
+        return self.client
+
+    def get_context_id(self):
+        return self.context_id
+
+    def get_input(self):
+        return self.input
+
+    def is_stream(self):
+        return self.stream
+
+    def cancel(self, reason:str="cancelled"):
+        if self.cancelled == None:
+            self.cancelled = reason
+
+    def get_error(self):
+        """
+        Returns why the request was stopped, or None if it should still be answered.
+        """
+        if self.cancelled == None and self.deadline != None and time.time() > self.deadline:
+            self.cancelled = "deadline exceeded"
+        return self.cancelled
+
+    def done(self):
+        if self.cancelled != None:
+            STOPPED_REQUESTS.inc(1, self.cancelled)
+        if self.registry != None:
+            self.registry.remove(self)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import time
+import logging
+import threading
+from collections import OrderedDict, deque
+from typing import Callable
+from metrics import Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+QUEUE_WAIT_SECONDS = Histogram("g4ab_queue_wait_seconds", "Time chat requests waited for an inference slot.")
+QUEUE_DEPTH = Gauge("g4ab_queue_depth", "Chat requests waiting for an inference slot.")
+ACTIVE_SLOTS = Gauge("g4ab_inference_slots_active", "Inference slots running a chat request.")
+
+class _Job:
+
+    def __init__(self, owner:str, resource, func:Callable, notify:Callable=None):
+        self.owner = owner
+        self.resource = resource
+        self.func = func
+        self.notify = notify
+        self.position = 0
+        self.enqueued = time.time()
+
+class Scheduler:
+    """
+    Runs inference jobs on a fixed number of worker threads (slots).
+
+    Jobs are queued per owner (session) and owners are served round-robin, so a session
+    that submits many requests cannot starve the others. A job is only started once no
+    other job is running on the same resource (model instance).
+    """
+
+    def __init__(self, slots:int):
+        self.slots = max(1, slots)
+        self.queues = OrderedDict()
+        self.busy = set()
+        self.condition = threading.Condition()
+        self.running = True
+
+        self.depth = 0
+        self.active = 0
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+        self.workers = []
+        for i in range(self.slots):
+            worker = threading.Thread(target=self._work, name=f"inference-{i}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, owner:str, resource, func:Callable, notify:Callable=None) -> int:
+        """
+        Queue func to be run on a worker. notify(position) is called whenever the job's
+        position in the queue changes, as long as it has to wait for a slot.
+        Returns the initial queue position (0 if it can start right away).
+        """
+        job = _Job(owner, resource, func, notify)
+
+        with self.condition:
+            if owner not in self.queues:
+                self.queues[owner] = deque()
+            self.queues[owner].append(job)
+            self.depth += 1
+            QUEUE_DEPTH.set(self.depth)
+
+            if self.active < self.slots and resource not in self.busy and len(self.queues[owner]) == 1:
+                updates = []
+            else:
+                updates = self._positions()
+
+            self.condition.notify()
+
+        self._notify(updates)
+        return job.position
+
+    def pending(self, owner:str) -> int:
+        with self.condition:
+            if owner not in self.queues:
+                return 0
+            return len(self.queues[owner])
+
+    def stop(self, timeout:float=0):
+        """
+        Stops the workers once their current job is done, waiting up to timeout seconds
+        for them. Jobs still queued are never run.
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        deadline = time.time() + timeout
+        for worker in self.workers:
+            worker.join(max(0, deadline - time.time()))
+
+    def get_stats(self):
+        with self.condition:
+            return {
+                "slots": self.slots,
+                "active": self.active,
+                "depth": self.depth,
+                "completed": self.completed,
+                "average_wait": int(self.total_wait / self.completed * 1000) if self.completed > 0 else 0,
+                "max_wait": int(self.max_wait * 1000)
+            }
+
+    def _next(self):
+        # Round-robin over owners, skipping jobs whose resource is in use
+        for owner, queue in self.queues.items():
+            job = queue[0]
+            if job.resource != None and job.resource in self.busy:
+                continue
+            queue.popleft()
+            del self.queues[owner]
+            if len(queue) > 0:
+                self.queues[owner] = queue
+            return job
+        return None
+
+    def _positions(self):
+        # Position each waiting job would have if owners keep being served round-robin
+        updates = []
+        position = 0
+        queues = list(self.queues.values())
+        depth = max([len(q) for q in queues], default=0)
+        for i in range(depth):
+            for queue in queues:
+                if i >= len(queue):
+                    continue
+                position += 1
+                job = queue[i]
+                if job.position != position:
+                    job.position = position
+                    updates.append((job, position))
+        return updates
+
+    def _notify(self, updates):
+        for job, position in updates:
+            if job.notify == None:
+                continue
+            try:
+                job.notify(position)
+            except Exception as e:
+                logger.warning(f"Failed to send queue position to session {job.owner} ({e})")
+
+    def _work(self):
+        while True:
+            with self.condition:
+                job = None
+                while self.running:
+                    if self.active < self.slots:
+                        job = self._next()
+                        if job != None:
+                            break
+                    self.condition.wait()
+
+                if not self.running:
+                    return
+
+                wait = time.time() - job.enqueued
+                QUEUE_WAIT_SECONDS.observe(wait)
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+                self.depth -= 1
+                self.active += 1
+                QUEUE_DEPTH.set(self.depth)
+                ACTIVE_SLOTS.set(self.active)
+                if job.resource != None:
+                    self.busy.add(job.resource)
+                updates = self._positions()
+
+            self._notify(updates)
+
+            try:
+                job.func()
+            except Exception as e:
+                logger.exception(f"Inference job for session {job.owner} failed ({e})")
+            finally:
+                with self.condition:
+                    if job.resource != None:
+                        self.busy.discard(job.resource)
+                    self.active -= 1
+                    self.completed += 1
+                    ACTIVE_SLOTS.set(self.active)
+                    self.condition.notify_all()
@@ -5,48 +5,71 @@ import uuid
 import logging
 import random
 from gpt import Gpt
+from pool import ModelPool
+from cache import ResponseCache, SingleFlight
 
 logger = logging.getLogger(__name__)
 
-class Session:
+# Types of the settings a client may set, a float setting also takes an int
+SETTING_TYPES = {
+    "model": (str,),
+    "name": (str, type(None)),
+    "seed": (int,),
+    "logits_size": (int,),
+    "tokens_size": (int,),
+    "n_ctx": (int,),
+    "n_predict": (int,),
+    "top_k": (int,),
+    "top_p": (int, float),
+    "temperature": (int, float),
+    "n_batch": (int,),
+    "repeat_penalty": (int, float),
+    "repeat_last_n": (int,),
+    "context_erase": (int, float),
+    "stream": (bool,),
+    "deadline": (int,)
+}
 
-    def __init__(self, max_idle_session_duration:int, model_threads:int, model_settings:dict=None):
-        # TODO: possibly store the ip addr of who created this session, that way it can be rate-limited by ip addr
+class Session:
+    DEFAULT_MODEL = "ggml-gpt4all-l13b-snoozy.bin"
 
+    def __init__(self, max_idle_session_duration:int, pool:ModelPool, model_settings:dict=None, session_id:str=None, cache:ResponseCache=None, flights:SingleFlight=None):
         self.max_idle_session_duration = max_idle_session_duration
-        self.model_threads = model_threads
+        self.pool = pool
 
         """
         logits_size    =self.settings["logits_size"],       # int = 0
         tokens_size    =self.settings["tokens_size"],       # int = 0
-        n_past         =self.settings["n_past"],            # int = 0, 
         n_ctx          =self.settings["n_ctx"],             # int = 1024, 
         n_predict      =self.settings["n_predict"],         # int = 128, 
         top_k          =self.settings["top_k"],             # int = 40, 
         top_p          =self.settings["top_p"],             # float = .9, 
         temp           =self.settings["temperature"],       # float = .1, 
-        n_batch        =self.settings["n_batch"],           # int = 8, 
+        n_batch        =self.settings["n_batch"],           # int = 0,     prompt tokens evaluated at once, 0 = picked by the server (see Tuner)
         repeat_penalty =self.settings["repeat_penalty"],    # float = 1.2, 
         repeat_last_n  =self.settings["repeat_last_n"],     # int = 10,    last n tokens to penalize
         context_erase  =self.settings["context_erase"]      # float = .5,  percent of context to erase if we exceed the context window
+        stream         =self.settings["stream"]             # bool = False, send the response as chunks while it is generated
+        deadline       =self.settings["deadline"]           # int = 0,     milliseconds to answer a chat message in, 0 for no limit
         """
 
         default_model_settings = {
-            "model": "ggml-gpt4all-l13b-snoozy.bin",
+            "model": Session.DEFAULT_MODEL,
             "name": None,
             "seed": random.randint(-2147483647, 2147483647),
             "logits_size": 0,
             "tokens_size": 0,
-            "n_past": 0,
             "n_ctx": 2048,
             "n_predict": 128,
             "top_k": 40,
             "top_p": 0.9,
             "temperature": 0.1,
-            "n_batch": 8,
+            "n_batch": 0,
             "repeat_penalty": 1.2,
             "repeat_last_n": 10,
-            "context_erase": 0.5
+            "context_erase": 0.5,
+            "stream": False,
+            "deadline": 0
         }
 
         self.model_settings = default_model_settings
@@ -55,11 +78,35 @@ class Session:
             if k in model_settings:
                 self.model_settings[k] = model_settings[k]
         
-        self.id = uuid.uuid4().hex
+        self.id = session_id if session_id != None else uuid.uuid4().hex
         logger.debug(f"Creating new session id {self.id} ...")
-        self.gpt = Gpt(self.model_threads, self.model_settings)
-        self.last_used = int(time.time())
-        logger.debug(f"Session id {self.id} created! Valid for {max_idle_session_duration} seconds")
+
+        # Responses can only be reused if the same conversation generates the same output, which
+        # takes greedy sampling: the bindings do not pass the seed on, so sampling is never repeatable
+        self.deterministic = self.model_settings["temperature"] == 0
+        if not self.deterministic:
+            cache = None
+            flights = None
+
+        self.gpt = Gpt(self.pool, self.model_settings, cache, flights)
+        self.last_used = time.time()
+        logger.debug(f"Session id {self.id} created! Valid for {max_idle_session_duration} milliseconds")
+
+    @staticmethod
+    def check_settings(model_settings:dict):
+        """
+        Returns the name of the first setting with a value of the wrong type, None if
+        they are all valid. Checked before a session is created, the model would only
+        fail on them once it generates.
+        """
+        for k, types in SETTING_TYPES.items():
+            if k not in model_settings:
+                continue
+            value = model_settings[k]
+            # bool is an int too
+            if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+                return k
+        return None
 
     def get_id(self):
         return self.id
@@ -67,20 +114,49 @@ class Session:
     def get_gpt(self):
         if self.has_expired():
             return None
-        self.last_used = int(time.time())
+        self.last_used = time.time()
         return self.gpt
 
+    def get_expiry(self):
+        return self.last_used + self.max_idle_session_duration / 1000
+
     def has_expired(self):
-        current = int(time.time())
+        if self.gpt == None:
+            return True
 
-        if current - self.last_used > self.max_idle_session_duration:
+        if time.time() > self.get_expiry():
             self.destroy()
             return True
 
         return False
 
     def destroy(self):
-        del self.gpt
+        if self.gpt != None:
+            self.gpt.destroy()
+            self.gpt = None
 
     def get_last_used(self):
         return self.last_used
+
+    def is_idle(self):
+        return self.gpt != None and self.gpt.is_idle()
+
+    def when_idle(self, callback):
+        # See Gpt.when_idle, never called for a destroyed session
+        if self.gpt != None:
+            self.gpt.when_idle(callback)
+
+    def get_snapshot(self):
+        """
+        What is needed to restore the session in another Session, see SnapshotStore.
+        """
+        return {
+            "id": self.id,
+            "settings": self.model_settings,
+            "history": self.gpt.get_history() if self.gpt != None else [],
+            "last_used": self.last_used
+        }
+
+    def restore(self, snapshot:dict):
+        if self.gpt != None:
+            self.gpt.set_history(snapshot["history"])
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+SNAPSHOT_VERSION = 1
+
+class SnapshotStore:
+    """
+    Sessions evicted from memory, stored as one JSON file per session id so they can
+    be restored when they are resumed. Snapshots expire like the sessions would have,
+    max_idle_session_duration after they were last used.
+    """
+
+    def __init__(self, path:str, max_idle_session_duration:int):
+        self.path = path
+        self.max_idle = max_idle_session_duration / 1000
+        os.makedirs(self.path, exist_ok=True)
+
+    def save(self, session_id:str, snapshot:dict):
+        snapshot = dict(snapshot, version=SNAPSHOT_VERSION)
+        filename = self._filename(session_id)
+        if filename == None:
+            return False
+
+        # Written next to the snapshot first, so a crash never leaves a truncated file
+        try:
+            with open(filename + ".tmp", "w") as f:
+                json.dump(snapshot, f)
+            os.replace(filename + ".tmp", filename)
+        except OSError as e:
+            logger.warning(f"Failed to save a snapshot of session {session_id} ({e})")
+            return False
+        return True
+
+    def load(self, session_id:str):
+        """
+        Returns the snapshot of a session and removes it, or None if there is none or it expired.
+        """
+        filename = self._filename(session_id)
+        if filename == None:
+            return None
+
+        try:
+            with open(filename, "r") as f:
+                snapshot = json.load(f)
+            os.remove(filename)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Failed to load the snapshot of session {session_id} ({e})")
+            return None
+
+        if snapshot.get("version") != SNAPSHOT_VERSION or time.time() > snapshot["last_used"] + self.max_idle:
+            return None
+        return snapshot
+
+    def prune(self):
+        """
+        Removes expired snapshots, returns the number removed.
+        """
+        removed = 0
+        deadline = time.time() - self.max_idle
+        try:
+            entries = list(os.scandir(self.path))
+        except OSError as e:
+            logger.warning(f"Failed to list session snapshots in {self.path} ({e})")
+            return 0
+
+        for entry in entries:
+            # Files are written after the session was last used
+            if not entry.name.endswith(".json") or entry.stat().st_mtime > deadline:
+                continue
+            try:
+                with open(entry.path, "r") as f:
+                    last_used = json.load(f)["last_used"]
+                if last_used <= deadline:
+                    os.remove(entry.path)
+                    removed += 1
+            except (OSError, ValueError, KeyError):
+                pass
+        return removed
+
+    def _filename(self, session_id:str):
+        # Session ids come from clients, never let them name other files
+        if not isinstance(session_id, str) or not session_id.isalnum():
+            return None
+        return os.path.join(self.path, session_id + ".json")
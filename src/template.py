@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import sys
+import json
+import hashlib
+import logging
+import platform
+import threading
+from string import Formatter
+
+logger = logging.getLogger(__name__)
+CMD_PREFIX = "#!#CMD_START#!#"
+CMD_SUFFIX = "#!#CMD_END#!#"
+
+# The prefix must only use facts that are the same for every request (name, model, platform, python),
+# so it can be evaluated once per model and shared. Anything that changes goes into the context.
+DEFAULT_TEMPLATE = {
+    "prefix": """### System:
+Your name is {name}.
+You are a LLM model.
+Your model file is {model}.
+You are running on {platform}.
+The current prompt software is running on Python {python}.
+You have no direct access to the file-system or internet.
+gpt4all-box is a gpt4all User Interface and Command-Line Interface service packaged in a containerized environment.
+
+### Instruction:
+The prompt below is a question to answer, a task to complete, or a conversation
+to respond to; decide which and write an appropriate response.
+
+""",
+    "context": """### Context:
+Your model seed is {seed}.
+The current date is {date}.
+The current time is {time}.
+Your local IP Address is {local_ip} and public IP Address is {public_ip}.
+
+""",
+    "user": "### Prompt: \n{content}\n",
+    "assistant": "### Response: {content}\n",
+    "response": "### Response: "
+}
+
+# Not part of any template yet, responses are not parsed for commands
+COMMAND_PROMPT = f"""If the user requests that you:
+
+1. Make a HTTP GET request to a URL.
+2. Change your name.
+
+You may do so by responding in the following format,
+by first responding with the string `{CMD_PREFIX}`,
+then insert a new-line, then write `URL ` (notice the space) and then the URL the user specified.
+Or if the user wants you to change your name, instead of `WEB `, write `NAME ` and then the desired
+name the user specified. Finally insert a new line, and then write `{CMD_SUFFIX}`
+and insert a new-line again. You can then type out your response to the user.
+An example of this would look like:
+
+```
+{CMD_PREFIX}
+URL https://example.com
+{CMD_SUFFIX}
+
+I have successfully made a HTTP GET request to [https://example.com](https://example.com).
+```
+
+or for a name change to Bob:
+
+```
+{CMD_PREFIX}
+NAME Bob
+{CMD_SUFFIX}
+```
+
+My name is now Bob.
+"""
+
+_templates = {}
+_lock = threading.Lock()
+
+class _CompiledString:
+    """
+    A format string parsed once into literal and field parts, so rendering is a single join.
+    """
+
+    def __init__(self, text:str):
+        self.parts = []
+        self.fields = set()
+        for literal, field, spec, conversion in Formatter().parse(text):
+            if literal:
+                self.parts.append((literal, None))
+            if field != None:
+                if spec or conversion:
+                    raise ValueError(f"format specs are not supported in prompt templates ({field})")
+                self.parts.append((None, field))
+                self.fields.add(field)
+
+    def render(self, values:dict):
+        return "".join([literal if field == None else str(values[field]) for literal, field in self.parts])
+
+class PromptTemplate:
+
+    def __init__(self, name:str, template:dict):
+        self.name = name
+        self.prefix = _CompiledString(template["prefix"])
+        self.context = _CompiledString(template["context"])
+        self.user = _CompiledString(template["user"])
+        self.assistant = _CompiledString(template["assistant"])
+        self.response = template["response"]
+        self.prefixes = {}
+
+    def get_prefix(self, name:str, model:str):
+        """
+        Returns the static prefix and its hash, rendered once per agent name and model.
+        """
+        key = (name, model)
+        prefix = self.prefixes.get(key)
+        if prefix == None:
+            text = self.prefix.render({
+                "name": name,
+                "model": model,
+                "platform": f"{sys.platform.title()} {platform.release()}",
+                "python": f"{sys.version_info.major}.{sys.version_info.minor}.{sys.version_info.micro}"
+            })
+            prefix = (text, hashlib.sha1(text.encode("utf-8")).hexdigest())
+            self.prefixes[key] = prefix
+        return prefix
+
+    def render_context(self, values:dict):
+        return self.context.render(values)
+
+    def render_message(self, role:str, content:str):
+        if role == "user":
+            return self.user.render({"content": content})
+        return self.assistant.render({"content": content})
+
+    def render_turn(self, content:str):
+        # Continues a conversation right after the last generated response
+        return "\n" + self.user.render({"content": content}) + self.response
+
+def load_templates(path:str=None):
+    """
+    Load prompt templates from a JSON file mapping model file names (or "default") to
+    template keys overriding DEFAULT_TEMPLATE.
+    """
+    templates = {"default": PromptTemplate("default", DEFAULT_TEMPLATE)}
+
+    if path != None:
+        with open(path, "r") as f:
+            config = json.load(f)
+        for model, overrides in config.items():
+            template = dict(DEFAULT_TEMPLATE)
+            if model != "default" and "default" in config:
+                template.update(config["default"])
+            template.update(overrides)
+            templates[model] = PromptTemplate(model, template)
+            logger.info(f"Loaded prompt template for {model}")
+
+    with _lock:
+        _templates.clear()
+        _templates.update(templates)
+
+def get_template(model:str) -> PromptTemplate:
+    with _lock:
+        if len(_templates) == 0:
+            _templates["default"] = PromptTemplate("default", DEFAULT_TEMPLATE)
+        if model in _templates:
+            return _templates[model]
+        return _templates["default"]
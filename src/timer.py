@@ -1,6 +1,5 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from time import sleep
 from typing import Callable
 from threading import Thread, Event
 
@@ -28,4 +27,4 @@ class Timer(_StoppableThread):
     def run(self):
         while not self.stop_event.is_set():
             self._worker_func()
-            sleep(self._interval)
\ No newline at end of file
+            self.stop_event.wait(self._interval)
\ No newline at end of file
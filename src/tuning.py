@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import glob
+import logging
+import threading
+import statistics
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+DEFAULT_N_BATCH = 8 # prompt tokens evaluated at once, unless the session or the tuner picks one
+N_BATCH_CANDIDATES = (32, 64, 128, 256, 512)
+TRIALS = 3 # prompts measured per candidate before one is picked
+MIN_SAMPLE_TOKENS = 64 # shorter prompts say little about the evaluation speed
+THREADS_PER_SLOT = 4 # cores each inference slot gets when all of them generate
+RATE_SMOOTHING = 0.2 # weight of the latest generation in the reported speeds
+
+def probe():
+    """
+    Returns the CPUs this process may run on, the physical cores and NUMA nodes behind
+    them and the load average of the last minute, as far as the platform tells.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(os.cpu_count() or 1))
+
+    cores = set()
+    nodes = set()
+    for cpu in cpus:
+        topology = f"/sys/devices/system/cpu/cpu{cpu}/topology/"
+        try:
+            with open(topology + "physical_package_id") as f:
+                package = f.read().strip()
+            with open(topology + "core_id") as f:
+                core = f.read().strip()
+            cores.add((package, core))
+        except OSError:
+            # Every CPU counts as a core of its own
+            cores.add((None, cpu))
+        for node in glob.glob(f"/sys/devices/system/cpu/cpu{cpu}/node*"):
+            nodes.add(os.path.basename(node))
+
+    try:
+        load = os.getloadavg()[0]
+    except (AttributeError, OSError):
+        load = 0.0
+
+    return {
+        "cpus": len(cpus),
+        "cores": len(cores),
+        "numa_nodes": max(1, len(nodes)),
+        "load": round(load, 2)
+    }
+
+def get_idle_cores(facts:dict):
+    # Physical cores not busy with other processes, load is counted in CPUs
+    busy = min(1.0, facts["load"] / facts["cpus"])
+    return max(1, round(facts["cores"] * (1 - busy)))
+
+def get_slots(facts:dict, processes:int=1):
+    """
+    Inference slots per process, so that every slot has THREADS_PER_SLOT cores when all are busy.
+    """
+    return max(1, get_idle_cores(facts) // max(1, processes) // THREADS_PER_SLOT)
+
+class _ModelTuning:
+    """
+    The prompt evaluation batch size of one model, picked by trying each candidate on a
+    few prompts, and the speeds it was last measured at.
+    """
+
+    def __init__(self):
+        self.samples = dict([(n_batch, []) for n_batch in N_BATCH_CANDIDATES])
+        self.n_batch = None
+        self.threads = None
+        self.prompt_rate = None
+        self.generation_rate = None
+
+    def get_n_batch(self, n_ctx:int):
+        if self.n_batch == None:
+            for n_batch, samples in self.samples.items():
+                if len(samples) < TRIALS:
+                    return min(n_batch, n_ctx)
+        return min(self.n_batch, n_ctx)
+
+    def record(self, threads:int, n_batch:int, prompt_rate:float, generation_rate:float, sample:bool):
+        """
+        Returns True if the batch size was picked with this measurement.
+        """
+        self.threads = threads
+        self.prompt_rate = _smooth(self.prompt_rate, prompt_rate)
+        self.generation_rate = _smooth(self.generation_rate, generation_rate)
+
+        if not sample or self.n_batch != None or n_batch not in self.samples or len(self.samples[n_batch]) >= TRIALS:
+            return False
+        self.samples[n_batch].append(prompt_rate)
+        if any([len(samples) < TRIALS for samples in self.samples.values()]):
+            return False
+        self.n_batch = max(self.samples, key=lambda n: statistics.median(self.samples[n]))
+        return True
+
+    def to_dict(self):
+        return {
+            "n_batch": self.n_batch,
+            "threads": self.threads,
+            "prompt_tokens_per_second": round(self.prompt_rate, 1) if self.prompt_rate != None else None,
+            "generation_tokens_per_second": round(self.generation_rate, 1) if self.generation_rate != None else None
+        }
+
+def _smooth(average:float, value:float):
+    if value == None:
+        return average
+    if average == None:
+        return value
+    return average + (value - average) * RATE_SMOOTHING
+
+class Tuner:
+    """
+    Picks the threads and prompt evaluation batch size of each generation. The cores of the
+    process are split between the generations running at the same time, a lone generation
+    gets the cores of one NUMA node. Sessions that don't set n_batch get the fastest one
+    measured for their model.
+
+    When disabled, the model keeps the thread count it was loaded with and sessions get
+    DEFAULT_N_BATCH, but the speeds are still measured and reported.
+    """
+
+    def __init__(self, enabled:bool, share:int=1):
+        self.enabled = enabled
+        self.facts = probe()
+        # Cores for the generations of this process, worker processes share the host
+        self.cores = max(1, get_idle_cores(self.facts) // max(1, share))
+        self.max_threads = max(1, self.cores // self.facts["numa_nodes"])
+        self.active = 0
+        self.models = {}
+        self.lock = threading.Lock()
+
+        if enabled:
+            logger.info(f"Host has {self.facts['cpus']} CPUs, {self.facts['cores']} physical cores on {self.facts['numa_nodes']} NUMA nodes and a load of {self.facts['load']}, generations use up to {self.max_threads} of {self.cores} cores")
+
+    def get_threads(self):
+        # Threads to load models with
+        return self.max_threads
+
+    @contextmanager
+    def generating(self, model_name:str, n_batch:int, n_ctx:int):
+        """
+        Yields the threads (None to leave them) and n_batch of a generation, which is counted
+        as running until the block ends. n_batch is the session's, 0 if it didn't set one.
+        """
+        with self.lock:
+            self.active += 1
+            threads = None
+            if self.enabled:
+                threads = max(1, min(self.max_threads, self.cores // self.active))
+            if n_batch <= 0:
+                n_batch = self._get_model(model_name).get_n_batch(n_ctx) if self.enabled else DEFAULT_N_BATCH
+        try:
+            yield threads, n_batch
+        finally:
+            with self.lock:
+                self.active -= 1
+
+    def record(self, model_name:str, threads:int, n_batch:int, prompt_tokens:int, prompt_seconds:float, tokens:int, generation_seconds:float):
+        prompt_rate = prompt_tokens / prompt_seconds if prompt_seconds > 0 else None
+        generation_rate = (tokens - 1) / generation_seconds if tokens > 1 and generation_seconds > 0 else None
+        with self.lock:
+            model = self._get_model(model_name)
+            picked = model.record(threads, n_batch, prompt_rate, generation_rate, self.enabled and prompt_rate != None and prompt_tokens >= MIN_SAMPLE_TOKENS)
+        if picked:
+            logger.info(f"Tuned model {model_name} to n_batch {model.n_batch}, {model.prompt_rate:.1f} prompt tokens/s")
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.facts)
+            stats.update({
+                "enabled": self.enabled,
+                "threads": self.max_threads if self.enabled else None,
+                "active": self.active,
+                "models": dict([(name, model.to_dict()) for name, model in self.models.items()])
+            })
+            return stats
+
+    def _get_model(self, model_name:str):
+        # Must be called with the lock held
+        model = self.models.get(model_name)
+        if model == None:
+            model = _ModelTuning()
+            self.models[model_name] = model
+        return model
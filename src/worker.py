@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import uuid
+import logging
+import threading
+import multiprocessing
+
+import logs
+import metrics
+from packet import Packet
+from codec import Codec
+from timer import Timer
+
+logger = logging.getLogger(__name__)
+
+def parse_cpus(spec:str, workers:int):
+    """
+    Returns the set of CPUs to pin each worker to (or None per worker for no pinning).
+    spec is either "auto" to split the available CPUs evenly, or a list of CPU ranges
+    per worker separated by ';', for example "0-7;8-15".
+    """
+    if spec == None or spec == "":
+        return [None] * workers
+
+    if spec == "auto":
+        if not hasattr(os, "sched_getaffinity"):
+            return [None] * workers
+        cpus = sorted(os.sched_getaffinity(0))
+        size = max(1, len(cpus) // workers)
+        return [set(cpus[i * size:(i + 1) * size]) or None for i in range(workers)]
+
+    groups = spec.split(";")
+    result = []
+    for i in range(workers):
+        cpus = set()
+        for part in groups[i % len(groups)].split(","):
+            if "-" in part:
+                first, last = part.split("-")
+                cpus.update(range(int(first), int(last) + 1))
+            elif part.strip() != "":
+                cpus.add(int(part))
+        result.append(cpus or None)
+    return result
+
+class _Connection:
+    """
+    A pipe end that may be sent to from several threads.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+
+    def send(self, item):
+        with self.lock:
+            self.conn.send(item)
+
+    def recv(self):
+        return self.conn.recv()
+
+class _RemoteClient:
+    """
+    Stands in for a Client of the front process inside a worker process.
+    """
+
+    def __init__(self, client_id:int, address:str, port:int, protocol:str, connection:_Connection):
+        self.id = client_id
+        self.address = address
+        self.port = port
+        self.codec = Codec(protocol)
+        self.connection = connection
+        self.session = None
+        self.name = f"Client #{client_id} ({address}:{port})"
+
+    def __str__(self):
+        return self.name
+
+    def set_session(self, session):
+        self.session = session
+        if session != None:
+            session.get_gpt()
+
+    def get_session(self):
+        return self.session
+
+    def get_protocol(self):
+        return self.codec.get_protocol()
+
+    def send(self, packet:Packet, content:dict=None, context_id:str=None):
+        if context_id == None:
+            context_id = uuid.uuid4().hex
+        self.send_raw(self.codec.encode(packet, content, context_id))
+
+    def send_raw(self, payload):
+        # Serialized here so the front process only has to forward it
+        self.connection.send(("send", self.id, payload))
+
+    def disconnect(self):
+        self.connection.send(("disconnect", self.id, None))
+
+    def get_id(self):
+        return self.id
+
+    def get_address(self):
+        return self.address
+
+    def get_port(self):
+        return self.port
+
+def _worker_main(index:int, conn, config:dict, cpus:set, log_level:int, log_config:dict, heartbeat_interval:int):
+    listener = logs.setup(log_level, log_config["format"], f"[worker {index}] ", {"worker": index})
+    logs.configure(log_config["debug_clients"], log_config["sample_rate"], log_config["prompts"])
+
+    if cpus != None and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+        logger.info(f"Pinned to CPUs {sorted(cpus)}")
+
+    # Imported here so the front process never loads the model backend
+    import host
+    from core import Core
+    from template import load_templates
+
+    config = dict(config)
+    # Every worker has its own response cache
+    if config["response_cache_path"] != None:
+        config["response_cache_path"] += f".{index}"
+    load_templates(config.pop("prompt_templates"))
+    host.resolve(config.pop("public_ip_lookup"), config.pop("public_ip_timeout"))
+
+    connection = _Connection(conn)
+    core = Core(**config)
+    clients = {}
+
+    def heartbeat():
+        core.heartbeat()
+        connection.send(("stats", index, core.get_stats(), metrics.REGISTRY.collect()))
+
+    timer = Timer(heartbeat, heartbeat_interval / 1000)
+    timer.start()
+
+    while True:
+        try:
+            item = connection.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+
+        if item[0] == "message":
+            kind, client_id, address, port, protocol, msg, session_id = item
+            client = clients.get(client_id)
+            if client == None:
+                client = _RemoteClient(client_id, address, port, protocol, connection)
+                clients[client_id] = client
+            try:
+                if msg["msg"] == Packet.SESSION:
+                    core.on_session(client, msg, session_id)
+                elif msg["msg"] == Packet.BATCH:
+                    core.on_batch(client, msg)
+                else:
+                    core.on_chat(client, msg)
+            except Exception as e:
+                connection.send(("disconnect", client_id, str(e)))
+        elif item[0] == "disconnect":
+            client = clients.pop(item[1], None)
+            if client != None:
+                core.on_disconnect(client)
+        elif item[0] == "drain":
+            core.drain()
+            # Tells the front process right away whether requests are in flight
+            connection.send(("stats", index, core.get_stats(), metrics.REGISTRY.collect()))
+        elif item[0] == "stop":
+            break
+
+    timer.stop()
+    core.stop()
+    listener.stop()
+
+class WorkerPool:
+    """
+    Runs a Core in each of several worker processes and routes the session and chat
+    packets of the front process' clients to them. A session always lives in the
+    worker chosen by its id, so it can be resumed from any connection.
+
+    Model weights are memory mapped by the backend, so the page cache holding them
+    is shared by all workers that load the same model file.
+    """
+
+    def __init__(self, workers:int, config:dict, cpus:str, heartbeat_interval:int, clients):
+        self.clients = clients
+        self.connections = []
+        self.processes = []
+        self.stats = [{} for i in range(workers)]
+        self.metrics = [[] for i in range(workers)]
+        # Worker holding the session of each client
+        self.affinity = {}
+        self.lock = threading.Lock()
+        self.stopping = False
+        self.draining = False
+
+        context = multiprocessing.get_context("spawn")
+        pinning = parse_cpus(cpus, workers)
+
+        for i in range(workers):
+            parent, child = context.Pipe()
+            process = context.Process(target=_worker_main, name=f"worker-{i}", args=(i, child, config, pinning[i], logging.getLogger().getEffectiveLevel(), logs.get_config(), heartbeat_interval), daemon=True)
+            process.start()
+            child.close()
+            self.connections.append(_Connection(parent))
+            self.processes.append(process)
+            threading.Thread(target=self._read, args=(i,), name=f"worker-{i}-reader", daemon=True).start()
+
+        logger.info(f"Started {workers} worker processes")
+
+    def route(self, session_id:str):
+        try:
+            return int(session_id, 16) % len(self.processes)
+        except (TypeError, ValueError):
+            return hash(session_id) % len(self.processes)
+
+    def on_session(self, client, msg:dict):
+        request = msg["content"]["request"]
+        session_id = None
+
+        if request == "create":
+            session_id = uuid.uuid4().hex
+            index = self.route(session_id)
+            with self.lock:
+                self.affinity[client.get_id()] = index
+        elif request == "resume":
+            index = self.route(msg["content"]["session_id"])
+            with self.lock:
+                self.affinity[client.get_id()] = index
+        elif request == "status":
+            index = self.route(msg["content"]["session_id"])
+        elif request == "destroy":
+            with self.lock:
+                index = self.affinity.get(client.get_id(), 0)
+        else:
+            raise Exception("invalid session.content.status type")
+
+        self._forward(index, client, msg, session_id)
+
+    def on_chat(self, client, msg:dict):
+        with self.lock:
+            index = self.affinity.get(client.get_id())
+        if index == None:
+            raise Exception("chat without starting or resuming a session")
+        self._forward(index, client, msg)
+
+    def on_batch(self, client, msg:dict):
+        # Runs next to the client's session, so its prompts can be cancelled like chat messages
+        with self.lock:
+            index = self.affinity.get(client.get_id())
+            if index == None:
+                index = self.route(msg["cid"])
+                self.affinity[client.get_id()] = index
+        self._forward(index, client, msg)
+
+    def on_disconnect(self, client):
+        with self.lock:
+            self.affinity.pop(client.get_id(), None)
+        # Status requests may have reached any worker
+        for connection in self.connections:
+            connection.send(("disconnect", client.get_id()))
+
+    def heartbeat(self):
+        for i, process in enumerate(self.processes):
+            if not process.is_alive():
+                logger.error(f"Worker process {i} exited with code {process.exitcode}")
+
+    def drain(self):
+        self.draining = True
+        for connection in self.connections:
+            connection.send(("drain",))
+
+    def is_draining(self):
+        # Once every worker saved its idle sessions and reported back
+        with self.lock:
+            return self.draining and all([worker.get("draining", False) for worker in self.stats])
+
+    def is_drained(self):
+        # As of the last heartbeat of each worker since it started draining
+        with self.lock:
+            return all([worker.get("draining", False) and worker.get("requests", 0) == 0 for worker in self.stats])
+
+    def stop(self):
+        self.stopping = True
+        for connection in self.connections:
+            try:
+                connection.send(("stop",))
+            except (BrokenPipeError, OSError):
+                pass
+        # Workers save their sessions before they exit
+        for process in self.processes:
+            process.join(10)
+
+    def is_ready(self):
+        # As of each worker's last heartbeat
+        with self.lock:
+            return not self.draining and all([worker.get("ready", False) for worker in self.stats])
+
+    def get_stats(self):
+        with self.lock:
+            stats = {"ready": not self.draining and all([worker.get("ready", False) for worker in self.stats]), "draining": self.draining, "sessions": 0, "requests": 0}
+            for worker in self.stats:
+                stats["sessions"] += worker.get("sessions", 0)
+                stats["requests"] += worker.get("requests", 0)
+            stats["workers"] = [dict(worker) for worker in self.stats]
+            return stats
+
+    def get_metrics(self):
+        # As of each worker's last heartbeat
+        with self.lock:
+            families = []
+            for worker in self.metrics:
+                families.extend(worker)
+            return families
+
+    def _forward(self, index:int, client, msg:dict, session_id:str=None):
+        self.connections[index].send(("message", client.get_id(), client.get_address(), client.get_port(), client.get_protocol(), msg, session_id))
+
+    def _read(self, index:int):
+        connection = self.connections[index]
+        while True:
+            try:
+                item = connection.recv()
+            except (EOFError, OSError):
+                if not self.stopping:
+                    logger.warning(f"Lost connection to worker process {index}")
+                return
+
+            if item[0] == "send":
+                client = self.clients.get(item[1])
+                if client != None:
+                    client.send_raw(item[2])
+            elif item[0] == "disconnect":
+                client = self.clients.get(item[1])
+                if client != None:
+                    logger.warning(f"{client} attempted an invalid action ({item[2]})")
+                    client.disconnect()
+            elif item[0] == "stats":
+                with self.lock:
+                    self.stats[item[1]] = item[2]
+                    self.metrics[item[1]] = metrics.label(item[3], "worker", str(item[1]))